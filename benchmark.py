@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+
+
+# Offline benchmark for the orchestration overhead of build.py.
+#
+# Generates tiny autotools style, meson and cmake projects, serves them as
+# tarballs (with checksum files) from a local HTTP server and as bare git
+# repositories on disk, and builds them with synthetic Builder subclasses.
+# Every package count is measured in three scenarios:
+#
+# * cold: empty root directory; everything is downloaded, unpacked and built
+# * warm: the same root directory again; all steps are unchanged
+# * incremental: one source file of every package was modified, rebuilt with -i
+#
+# No network access is needed. Example call:
+#   ./benchmark.py --counts 1 4 16 --kinds autotools meson -j 4 -P 4
+
+
+import os, sys, shutil, tarfile, io, hashlib, argparse, functools, threading, subprocess, tempfile, time, json, contextlib
+import http.server
+import build
+from build import msg, error, mkdir_p
+
+
+
+# Number of C source files of every synthetic project
+num_sources = 4
+
+
+def generate_sources(name, revision = 0):
+	# Returns a dict mapping file names to the contents of the
+	# C sources that are common to all project kinds.
+	files = {}
+	for i in range(num_sources):
+		files['src{}.c'.format(i)] = 'int {}_func{}(int x) {{ return x * {} + {}; }}\n'.format(name, i, i + 1, revision)
+	calls = ' + '.join(['{}_func{}({})'.format(name, i, i) for i in range(num_sources)])
+	declarations = ''.join(['int {}_func{}(int x);\n'.format(name, i) for i in range(num_sources)])
+	files['main.c'] = '#include <stdio.h>\n{}int main(void) {{ printf("%d\\n", {}); return 0; }}\n'.format(declarations, calls)
+	return files
+
+
+def generate_autotools_project(name):
+	# Not generated by autoconf (which would make the benchmark depend on
+	# the installed autotools), but it behaves like a configure script as
+	# far as build.py is concerned.
+	files = generate_sources(name)
+	sources = ' '.join(sorted(files.keys()))
+	files['configure'] = '\n'.join([
+		'#!/bin/sh',
+		'prefix=/usr/local',
+		'for arg in "$@"; do case "$arg" in --prefix=*) prefix="${arg#--prefix=}";; esac; done',
+		'srcdir=$(dirname "$0")',
+		'printf "prefix=%s\\nsrcdir=%s\\nVPATH=%s\\n" "$prefix" "$srcdir" "$srcdir" > Makefile',
+		'cat "$srcdir/Makefile.in" >> Makefile',
+		'echo "configured" > config.status',
+		''
+	])
+	files['Makefile.in'] = '\n'.join([
+		'OBJS = {}'.format(' '.join([s[:-2] + '.o' for s in sources.split()])),
+		'all: {}'.format(name),
+		'{}: $(OBJS)'.format(name),
+		'\t$(CC) $(LDFLAGS) -o $@ $(OBJS)',
+		'%.o: %.c',
+		'\t$(CC) $(CFLAGS) -c -o $@ $<',
+		'install: {}'.format(name),
+		'\tmkdir -p $(DESTDIR)$(prefix)/bin',
+		'\tcp {} $(DESTDIR)$(prefix)/bin/{}'.format(name, name),
+		''
+	])
+	return files
+
+
+def generate_meson_project(name):
+	files = generate_sources(name)
+	sources = ', '.join(["'{}'".format(s) for s in sorted(files.keys())])
+	files['meson.build'] = "project('{}', 'c')\nexecutable('{}', [{}], install: true)\n".format(name, name, sources)
+	return files
+
+
+def generate_cmake_project(name):
+	files = generate_sources(name)
+	files['CMakeLists.txt'] = 'cmake_minimum_required(VERSION 3.5)\nproject({} C)\nadd_executable({} {})\ninstall(TARGETS {} DESTINATION bin)\n'.format(name, name, ' '.join(sorted(files.keys())), name)
+	return files
+
+
+project_generators = {
+	'autotools': generate_autotools_project,
+	'meson': generate_meson_project,
+	'cmake': generate_cmake_project,
+}
+
+required_tools = {
+	'autotools': ['make', 'cc'],
+	'meson': ['meson', 'ninja', 'cc'],
+	'cmake': ['cmake', 'make', 'cc'],
+}
+
+
+def write_tarball(files, basename, dest):
+	# Fixed modification times keep the archives (and their checksums)
+	# identical across benchmark runs.
+	with tarfile.open(dest, 'w:gz') as tf:
+		for fname, content in sorted(files.items()):
+			data = content.encode('utf-8')
+			info = tarfile.TarInfo('{}/{}'.format(basename, fname))
+			info.size = len(data)
+			info.mode = 0o755 if fname == 'configure' else 0o644
+			info.mtime = 1000000000
+			tf.addfile(info, io.BytesIO(data))
+	with open(dest, 'rb') as f:
+		digest = hashlib.sha256(f.read()).hexdigest()
+	with open(dest + '.sha256sum', 'w') as f:
+		f.write('{}  {}\n'.format(digest, os.path.basename(dest)))
+
+
+def write_bare_git_repo(files, dest):
+	worktree = tempfile.mkdtemp(prefix = 'worktree-', dir = os.path.dirname(dest))
+	for fname, content in files.items():
+		with open(os.path.join(worktree, fname), 'w') as f:
+			f.write(content)
+		if fname == 'configure':
+			os.chmod(os.path.join(worktree, fname), 0o755)
+	success = True
+	for cmd in [['git', 'init', '--quiet'], ['git', 'add', '.'], ['git', 'commit', '--quiet', '-m', 'Initial commit'], ['git', 'clone', '--quiet', '--bare', worktree, dest]]:
+		success = success and (0 == subprocess.call(cmd, cwd = worktree))
+	shutil.rmtree(worktree)
+	return success
+
+
+def start_http_server(directory):
+	class QuietHandler(http.server.SimpleHTTPRequestHandler):
+		def log_message(self, *args):
+			pass
+	server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(QuietHandler, directory = directory))
+	threading.Thread(target = server.serve_forever, daemon = True).start()
+	return server, 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+
+
+class SyntheticBuilder(build.Builder):
+	# Builds one of the generated projects, either from a tarball
+	# (any version other than "git") or from a bare git repository.
+
+	def __init__(self, ctx, kind, name, url, git_repo):
+		super(SyntheticBuilder, self).__init__(ctx)
+		self.kind = kind
+		self.name = name
+		self.url = url
+		self.git_repo = git_repo
+
+	def desc(self):
+		return 'synthetic {} project'.format(self.kind)
+
+	def get_basename(self, package_version):
+		return '{}-{}'.format(self.name, package_version)
+
+	def fetch(self, ctx, package_version):
+		basename = self.get_basename(package_version)
+		if package_version == 'git':
+			return self.clone_git_repo('file://' + self.git_repo, basename)
+		archive_filename = basename + '.tar.gz'
+		archive_dest = os.path.join(ctx.dl_dir, archive_filename)
+		link = '{}/{}'.format(self.url, archive_filename)
+		return self.fetch_package_file(archive_filename, archive_dest, archive_dest + '.sha256sum', link, link + '.sha256sum')
+
+	def check(self, ctx, package_version):
+		if package_version == 'git':
+			return True
+		basename = self.get_basename(package_version)
+		return self.check_package(name = basename, basename = basename, hashcall = 'sha256sum', dest_hash = os.path.join(ctx.dl_dir, basename + '.tar.gz.sha256sum'))
+
+	def unpack(self, ctx, package_version):
+		if package_version == 'git':
+			return True
+		basename = self.get_basename(package_version)
+		return self.unpack_package(basename, os.path.join(ctx.dl_dir, basename + '.tar.gz'))
+
+	def build(self, ctx, package_version):
+		basename = self.get_basename(package_version)
+		if self.kind == 'autotools':
+			return self.do_config_make_build(basename = basename, use_autogen = False) and self.do_make_install(basename = basename)
+		elif self.kind == 'meson':
+			return self.do_meson_ninja_build(basename = basename)
+		else:
+			staging = os.path.join(ctx.staging_dir, basename)
+			builddir = self.get_build_dir(staging, 'build')
+			variant_options = ctx.get_variant_options('cmake')
+			def build():
+				mkdir_p(builddir)
+				success = True
+				success = success and (0 == ctx.call_with_env(['cmake', staging, '-DCMAKE_INSTALL_PREFIX=' + ctx.inst_dir] + variant_options + ctx.get_cmake_launcher_options(), cwd = builddir))
+				success = success and (0 == ctx.call_with_env(['make'] + ctx.make_jobs_arg(), cwd = builddir))
+				success = success and self.staged_install(basename, lambda destdir: 0 == ctx.call_with_env(['make', 'install', 'DESTDIR=' + destdir], cwd = builddir))
+				return success
+			return self.run_step(basename, 'build', [ctx.inst_dir] + variant_options, staging, build)
+
+
+
+class Benchmark(object):
+	def __init__(self, workdir, args):
+		self.workdir = workdir
+		self.args = args
+		self.sources_dir = os.path.join(workdir, 'sources')
+		self.git_dir = os.path.join(workdir, 'git')
+		self.log_filename = os.path.join(workdir, 'benchmark.log')
+		self.results = []
+
+	def generate_projects(self, kinds, count):
+		# Generates count projects, distributed round robin over the given
+		# kinds. Returns a list of (kind, name) tuples.
+		mkdir_p(self.sources_dir)
+		mkdir_p(self.git_dir)
+		projects = []
+		for i in range(count):
+			kind = kinds[i % len(kinds)]
+			name = 'bench{}{}'.format(kind, i)
+			projects += [(kind, name)]
+			archive = os.path.join(self.sources_dir, '{}-1.0.tar.gz'.format(name))
+			if not os.path.exists(archive):
+				files = project_generators[kind](name)
+				write_tarball(files, '{}-1.0'.format(name), archive)
+				if not write_bare_git_repo(files, os.path.join(self.git_dir, name + '.git')):
+					raise RuntimeError('could not create git repository for {}'.format(name))
+		return projects
+
+	def create_context(self, rootdir, projects, url):
+		ctx = build.Context(rootdir)
+		ctx.write_env_script()
+		ctx.num_jobs = self.args.num_jobs
+		ctx.fetch_jobs = self.args.fetch_jobs
+		ctx.package_jobs = self.args.package_jobs
+		ctx.setup_jobserver()
+		for kind, name in projects:
+			ctx.package_builders[name] = SyntheticBuilder(ctx, kind, name, url, os.path.join(self.git_dir, name + '.git'))
+		return ctx
+
+	@contextlib.contextmanager
+	def redirected_output(self):
+		# The output of build.py and the build tools goes to the log file,
+		# so that only the results are printed.
+		sys.stdout.flush()
+		sys.stderr.flush()
+		saved_fds = [os.dup(1), os.dup(2)]
+		with open(self.log_filename, 'a') as log:
+			os.dup2(log.fileno(), 1)
+			os.dup2(log.fileno(), 2)
+			try:
+				yield
+			finally:
+				sys.stdout.flush()
+				sys.stderr.flush()
+				os.dup2(saved_fds[0], 1)
+				os.dup2(saved_fds[1], 2)
+				for fd in saved_fds:
+					os.close(fd)
+
+	def run_scenario(self, scenario, rootdir, projects, url, version, incremental = False):
+		ctx = self.create_context(rootdir, projects, url)
+		ctx.incremental = incremental
+		# Modifications of unpacked tarballs are only detected through
+		# the local git repository.
+		ctx.local_git = (version != 'git')
+		packages = [[name, version] for kind, name in projects]
+		start_time = time.monotonic()
+		with self.redirected_output():
+			success = ctx.fetch_packages(packages)
+			fetch_time = time.monotonic() - start_time
+			success = success and ctx.build_packages(packages)
+		total_time = time.monotonic() - start_time
+		commands = sum([len(phase['commands']) for phase in ctx.metrics.phases])
+		ctx.verify_executor.shutdown()
+		return {
+			'scenario': scenario,
+			'source': 'git' if version == 'git' else 'tarball',
+			'packages': len(projects),
+			'success': success,
+			'fetch_time': fetch_time,
+			'total_time': total_time,
+			'commands': commands
+		}
+
+	def modify_sources(self, rootdir, projects, version):
+		for kind, name in projects:
+			fname = os.path.join(rootdir, 'staging', '{}-{}'.format(name, version), 'src0.c')
+			with open(fname, 'w') as f:
+				f.write(generate_sources(name, revision = 1)['src0.c'])
+
+	def run(self, kinds, counts, sources):
+		server, url = start_http_server(self.sources_dir)
+		try:
+			for count in counts:
+				projects = self.generate_projects(kinds, count)
+				for source in sources:
+					version = 'git' if source == 'git' else '1.0'
+					for repetition in range(self.args.repeat):
+						rootdir = os.path.join(self.workdir, 'root-{}-{}'.format(source, count))
+						shutil.rmtree(rootdir, ignore_errors = True)
+						for scenario in ['cold', 'warm', 'incremental']:
+							if scenario == 'incremental':
+								self.modify_sources(rootdir, projects, version)
+							result = self.run_scenario(scenario, rootdir, projects, url, version, incremental = (scenario == 'incremental'))
+							self.print_result(result)
+							self.results += [result]
+							if not result['success']:
+								error('benchmark run failed - see {} for details'.format(self.log_filename))
+								return False
+		finally:
+			server.shutdown()
+		return True
+
+	def print_result(self, result):
+		print('{:<12} {:<8} {:>8} {:>10.3f} {:>10.3f} {:>9}'.format(result['scenario'], result['source'], result['packages'], result['fetch_time'], result['total_time'], result['commands']))
+		sys.stdout.flush()
+
+
+
+def main():
+	parser = argparse.ArgumentParser(description = 'Measures the overhead of build.py with synthetic packages, without network access')
+	parser.add_argument('--counts', dest = 'counts', metavar = 'N', type = int, nargs = '+', default = [1, 4, 16], help = 'Numbers of packages to benchmark (default: 1 4 16)')
+	parser.add_argument('--kinds', dest = 'kinds', metavar = 'KIND', nargs = '+', default = ['autotools', 'meson', 'cmake'], choices = sorted(project_generators.keys()), help = 'Kinds of projects to generate (default: all kinds whose tools are installed)')
+	parser.add_argument('--sources', dest = 'sources', metavar = 'SOURCE', nargs = '+', default = ['tarball', 'git'], choices = ['tarball', 'git'], help = 'Where the sources are fetched from (default: tarball git)')
+	parser.add_argument('--repeat', dest = 'repeat', metavar = 'N', type = int, default = 1, help = 'Number of times every measurement is repeated (default: 1)')
+	parser.add_argument('-j', '--jobs', dest = 'num_jobs', metavar = 'JOBS', type = int, default = 1, help = 'Same as -j of build.py')
+	parser.add_argument('-P', '--package-jobs', dest = 'package_jobs', metavar = 'JOBS', type = int, default = 1, help = 'Same as -P of build.py')
+	parser.add_argument('--fetch-jobs', dest = 'fetch_jobs', metavar = 'JOBS', type = int, default = 4, help = 'Same as --fetch-jobs of build.py')
+	parser.add_argument('--work-dir', dest = 'work_dir', metavar = 'DIR', default = None, help = 'Directory for the generated projects and root directories; kept after the benchmark (default: a temporary directory that is removed afterwards)')
+	parser.add_argument('--output', dest = 'output', metavar = 'FILE', default = None, help = 'Write the results to FILE as JSON')
+	args = parser.parse_args()
+
+	kinds = [kind for kind in args.kinds if all([shutil.which(tool) for tool in required_tools[kind]])]
+	for kind in sorted(set(args.kinds) - set(kinds)):
+		msg('skipping {} projects: {} not installed'.format(kind, ' / '.join(required_tools[kind])))
+	if not kinds:
+		error('none of the required tools are installed - cannot continue')
+		sys.exit(1)
+
+	# Commits are made in the generated repositories and (for tarballs)
+	# in the local git repositories; these must not depend on the git
+	# configuration of the user.
+	for name in ['GIT_AUTHOR_NAME', 'GIT_COMMITTER_NAME']:
+		os.environ.setdefault(name, 'benchmark')
+	for name in ['GIT_AUTHOR_EMAIL', 'GIT_COMMITTER_EMAIL']:
+		os.environ.setdefault(name, 'benchmark@localhost')
+
+	if args.work_dir:
+		workdir = os.path.abspath(args.work_dir)
+		mkdir_p(workdir)
+	else:
+		workdir = tempfile.mkdtemp(prefix = 'build-py-benchmark-')
+
+	benchmark = Benchmark(workdir, args)
+	print('{:<12} {:<8} {:>8} {:>10} {:>10} {:>9}'.format('scenario', 'source', 'packages', 'fetch [s]', 'total [s]', 'commands'))
+	try:
+		success = benchmark.run(kinds, args.counts, args.sources)
+	finally:
+		if args.output:
+			with open(args.output, 'w') as f:
+				json.dump({'kinds': kinds, 'num_jobs': args.num_jobs, 'package_jobs': args.package_jobs, 'fetch_jobs': args.fetch_jobs, 'results': benchmark.results}, f, indent = '\t')
+		if not args.work_dir:
+			shutil.rmtree(workdir, ignore_errors = True)
+	if not success:
+		sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
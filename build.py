@@ -1,12 +1,79 @@
 #!/usr/bin/env python3
 
 
-import os, subprocess, sys, hashlib, argparse, shutil
+import os, subprocess, sys, hashlib, argparse, shutil, threading, functools, concurrent.futures, contextlib, tempfile, select, re, atexit
+import urllib.request, urllib.error, http.client, fcntl, time, uuid, queue, resource, json, shlex, string, collections
+import sqlite3, socket, statistics, tarfile, posixpath, copy
 
 
 def mkdir_p(path):
-	if not os.path.exists(path):
-		os.makedirs(path)
+	# exist_ok, since directories may be created by concurrent builds.
+	os.makedirs(path, exist_ok = True)
+
+def run_concurrently(funcs, max_workers = None):
+	# Runs the given callables in separate threads and waits until all of
+	# them are finished. The callables are expected to return True on success,
+	# just like the builder functions do. Returns True if all of them succeeded.
+	if not funcs:
+		return True
+	if max_workers is None:
+		max_workers = len(funcs)
+	with concurrent.futures.ThreadPoolExecutor(max_workers = max_workers) as executor:
+		futures = [executor.submit(inherit_metrics_scope(func)) for func in funcs]
+		results = [future.result() for future in futures]
+	return all(results)
+
+def run_dependency_graph(nodes, dependencies, func, max_workers):
+	# Calls func for every node (in separate threads), as soon as func returned
+	# True for all nodes it depends on; dependencies maps every node to the set
+	# of nodes it depends on. Up to max_workers calls run at the same time.
+	# Among the nodes that are ready, the order of the nodes list decides which
+	# one starts first. Once a call failed, no more calls are started, but the
+	# running ones are waited for. Returns True if func succeeded for all nodes.
+	pending = list(nodes)
+	running = {}
+	finished = set()
+	failed = False
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers = max_workers) as executor:
+		while True:
+			if not failed:
+				for node in list(pending):
+					if len(running) >= max_workers:
+						break
+					if dependencies[node] <= finished:
+						pending.remove(node)
+						running[executor.submit(inherit_metrics_scope(functools.partial(func, node)))] = node
+			if not running:
+				break
+			done, not_done = concurrent.futures.wait(running, return_when = concurrent.futures.FIRST_COMPLETED)
+			for future in done:
+				node = running.pop(future)
+				if future.result():
+					finished.add(node)
+				else:
+					failed = True
+
+	if pending and not failed:
+		error('could not run: {}'.format(', '.join([str(node) for node in pending])))
+	return (not failed) and (not pending)
+
+def get_critical_path(nodes, dependencies, durations):
+	# Returns the duration and the nodes of the longest chain of nodes in the
+	# dependency graph (see run_dependency_graph()), where every node takes
+	# durations[node] seconds. Dependencies which are not in nodes are ignored.
+	# This is the minimum time it takes to run all nodes, no matter how many
+	# of them run at the same time.
+	paths = {}
+	def visit(node):
+		if node not in paths:
+			longest = (0.0, [])
+			for dep in dependencies[node]:
+				if dep in nodes:
+					longest = max(longest, visit(dep), key = lambda path: path[0])
+			paths[node] = (longest[0] + durations[node], longest[1] + [node])
+		return paths[node]
+	return max([visit(node) for node in nodes] + [(0.0, [])], key = lambda path: path[0])
 
 def msg(text, level = 3):
 	sys.stdout.write(('#' * level) + ' ' + text + '\n')
@@ -14,6 +81,120 @@ def error(text):
 	sys.stderr.write('!!!!!! ' + text + '\n')
 
 
+# The environment for building packages and for using the installation. Commands
+# are run with it (see Context.call_with_env()), and env.sh is generated from it
+# (see generate_env_script()). Values are written in shell syntax; they may refer
+# to the installation directory ($installation_dir), to variables defined earlier,
+# and to the previous value of the variable itself.
+environment_definition = [
+	('PATH', '$installation_dir/bin:$PATH'),
+	('CFLAGS', '-I$installation_dir/include'),
+	('CCFLAGS', '-I$installation_dir/include'),
+	('CXXFLAGS', '-I$installation_dir/include'),
+	('LDFLAGS', '-L$installation_dir/lib'),
+	('PKG_CONFIG_PATH', '$installation_dir/lib/pkgconfig'),
+	('ACLOCAL_FLAGS', '-I $installation_dir/share/aclocal'),
+	('GST_PLUGINS_DIR', '$installation_dir/lib/gstreamer-1.0'),
+	('GST_PLUGIN_PATH', '$GST_PLUGINS_DIR'),
+	('GST_REGISTRY', '$installation_dir/gst-registry.bin'),
+	('GST_PLUGIN_SYSTEM_PATH', '$installation_dir/lib/gstreamer-1.0'),
+	('LD_LIBRARY_PATH', '$installation_dir/lib'),
+	('PIPEWIRE_RUNTIME_DIR', '$installation_dir/run'),
+]
+
+# Build variants (see --variant). Every variant is installed into a directory
+# of its own (installation-<variant>), and built out of tree from the same
+# source trees as the other variants. "cflags" and "ldflags" are appended to
+# CFLAGS/CXXFLAGS and LDFLAGS of the environment, which autotools, Meson and
+# CMake builds pick up. The other entries are the arguments that select the
+# variant in build systems which have their own way of doing that.
+build_variants = {
+	'release': {
+		'cflags': '-O2',
+		'ldflags': '',
+		'meson': '--buildtype=release',
+		'cmake': '-DCMAKE_BUILD_TYPE=Release',
+		'qt': '-release',
+		'ffmpeg': '',
+		'b2': 'variant=release',
+	},
+	'debug': {
+		'cflags': '-O0 -g',
+		'ldflags': '',
+		'meson': '--buildtype=debug',
+		'cmake': '-DCMAKE_BUILD_TYPE=Debug',
+		'qt': '-debug',
+		'ffmpeg': '--disable-optimizations --disable-stripping',
+		'b2': 'variant=debug',
+	},
+	'asan': {
+		'cflags': '-O1 -g -fsanitize=address -fno-omit-frame-pointer',
+		'ldflags': '-fsanitize=address',
+		'meson': '--buildtype=debugoptimized -Db_sanitize=address',
+		'cmake': '-DCMAKE_BUILD_TYPE=RelWithDebInfo',
+		'qt': '-release -force-debug-info -sanitize address',
+		'ffmpeg': '--toolchain=gcc-asan --disable-stripping',
+		'b2': 'variant=debug "cflags=-fsanitize=address -fno-omit-frame-pointer" "cxxflags=-fsanitize=address -fno-omit-frame-pointer" linkflags=-fsanitize=address',
+	},
+}
+
+env_script_header = '''#!/usr/bin/env sh
+
+
+# BASH shell script for building local library installations
+# Copyright (C) 2013  Carlos Rafael Giani
+# 
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+'''
+
+env_script_installation_dir = '''if [ -n "${{ROOTDIR}}" ]
+then
+	installation_dir="${{ROOTDIR}}/{0}"
+else
+	installation_dir="$(pwd)/{0}"
+fi
+
+'''
+
+def expand_variables(value, variables):
+	# Expands $NAME and ${NAME} like the shell does; unset
+	# variables are expanded to an empty string.
+	return string.Template(value).substitute(collections.defaultdict(str, variables))
+
+def generate_env_script(installation_subdir = 'installation'):
+	lines = ['export {}="{}"'.format(name, value) for name, value in environment_definition]
+	return env_script_header + env_script_installation_dir.format(installation_subdir) + '\n'.join(lines) + '\n'
+
+def format_command(args, env = None):
+	# Returns a command line for log output that could be pasted into a shell.
+	# The values of environment variables are in shell syntax already.
+	assignments = ['{}="{}"'.format(name, value) for name, value in (env or {}).items()]
+	return ' '.join(assignments + [shlex.quote(arg) for arg in args])
+
+def extract_checksum_entries(src, dest, filename):
+	# Copies the lines of the checksum file src that refer to filename to dest.
+	try:
+		with open(src) as f:
+			lines = [line for line in f if filename in line]
+		with open(dest, 'w') as f:
+			f.writelines(lines)
+	except (IOError, OSError) as e:
+		error('could not extract the checksum of {} from {}: {}'.format(filename, src, e))
+
 def hashfile_blk(afile, hasher, blocksize=65536):
 	buf = afile.read(blocksize)
 	while len(buf) > 0:
@@ -26,39 +207,1963 @@ def hashfile(fname, hashfuncname):
 	with open(fname, 'rb') as f:
 		return hashfile_blk(f, hashfunc())
 
+# Maps the checksum tools that the builders refer to
+# to the corresponding hashlib hash function names.
+hashcall_funcs = {
+	'md5sum': 'md5',
+	'sha1sum': 'sha1',
+	'sha256sum': 'sha256',
+}
+
+def read_checksum_file(fname):
+	# Parses a checksum file in the format used by sha256sum & co. Returns
+	# a list of (hexdigest, filename) tuples. Lines that are not checksum
+	# entries (for example PGP signature blocks) are ignored.
+	entries = []
+	with open(fname, 'r', errors = 'replace') as f:
+		for line in f:
+			entry_match = re.match(r'^([0-9a-fA-F]{32,128})\s+\*?(.+?)\s*$', line)
+			if entry_match:
+				entries += [(entry_match.group(1).lower(), entry_match.group(2))]
+	return entries
+
+def download_file(link, dest, hashfuncnames = ['md5', 'sha1', 'sha256'], stream_consumer = None, segments = None, max_retries = None):
+	# Downloads link to dest. The data is written to a temporary file first,
+	# which is renamed to dest once the download is complete, so dest never
+	# contains partial downloads. The digests of the downloaded data are
+	# computed as the data streams in. If stream_consumer is set, it is called
+	# with every block of downloaded data as well. If segments is set instead,
+	# the file is downloaded with up to that many connections at the same time,
+	# and an interrupted download is resumed (see SegmentedDownload), which
+	# computes the digests in order as contiguous data becomes available.
+	# max_retries overrides the number of retries of every segment. Returns a dict
+	# that maps the hash function names to the digests, or None if the
+	# download failed.
+	if (segments is not None) and (stream_consumer is None):
+		download = SegmentedDownload(link, dest, segments, max_retries, hashfuncnames)
+		if download.prepare():
+			if not download.run():
+				return None
+			return download.get_digests()
+		# The server does not support range requests; fall back to
+		# downloading the file in one piece.
+	hashers = [(hashfuncname, hashlib.new(hashfuncname)) for hashfuncname in hashfuncnames]
+	dest_part = dest + '.part'
+	request = urllib.request.Request(link, headers = {'User-Agent': 'build.py'})
+	try:
+		with urllib.request.urlopen(request, timeout = 60) as response, open(dest_part, 'wb') as f:
+			while True:
+				buf = response.read(1024 * 1024)
+				if not buf:
+					break
+				for hashfuncname, hasher in hashers:
+					hasher.update(buf)
+				if stream_consumer:
+					stream_consumer(buf)
+				f.write(buf)
+			# http.client does not complain if the connection is closed
+			# before Content-Length bytes were received.
+			if response.length:
+				raise http.client.IncompleteRead(b'', response.length)
+	except (urllib.error.URLError, http.client.HTTPException, OSError) as e:
+		error('downloading {} failed: {}'.format(link, e))
+		return None
+	os.rename(dest_part, dest)
+	return dict([(hashfuncname, hasher.hexdigest()) for hashfuncname, hasher in hashers])
+
+class SegmentedDownload(object):
+	# Downloads a file with several connections at the same time, each of which
+	# fetches one segment of the file with HTTP range requests. The data is
+	# written to dest.part, and the progress of every segment to the sidecar
+	# file dest.part.state, so a download that was interrupted continues where
+	# it stopped the next time it is started. dest only appears once all
+	# segments are complete. If a connection fails, only its segment is retried
+	# (with exponential backoff); a segment gives up once it failed max_retries
+	# times in a row without making progress. The ETag (or Last-Modified date)
+	# of the file is sent along with every request, so a file that changed on
+	# the server is never assembled from pieces of different versions.
+	#
+	# The digests are computed in file order, while the file is downloaded.
+	# The blocks of the first segment that is not complete yet are hashed as
+	# they come in. Once it is complete, the data of the following segments
+	# that arrived in the meantime is read back from dest.part (usually from
+	# the page cache) to catch up. Data that was downloaded in an earlier,
+	# interrupted attempt is read back the same way.
+
+	min_segment_size = 4 * 1024 * 1024
+	max_retries = 5
+	retry_delay = 1.0
+	max_retry_delay = 30.0
+	state_save_interval = 1.0
+
+	def __init__(self, link, dest, num_segments, max_retries = None, hashfuncnames = ['md5', 'sha1', 'sha256']):
+		self.link = link
+		self.dest = dest
+		self.dest_part = dest + '.part'
+		self.state_file = dest + '.part.state'
+		self.num_segments = max(1, num_segments)
+		if max_retries is not None:
+			self.max_retries = max_retries
+		self.size = None
+		self.validator = None
+		self.segments = []
+		self.fd = None
+		self.failed = False
+		self.lock = threading.Lock()
+		self.last_state_save = 0.0
+		self.hashers = [(hashfuncname, hashlib.new(hashfuncname)) for hashfuncname in hashfuncnames]
+		self.hashed_size = 0
+		self.hashing = False
+		self.hash_lock = threading.Lock()
+
+	def open_url(self, headers):
+		request = urllib.request.Request(self.link, headers = dict(headers, **{'User-Agent': 'build.py'}))
+		return urllib.request.urlopen(request, timeout = 60)
+
+	def prepare(self):
+		# Picks up the state of an earlier attempt, or asks the server for the
+		# size of the file and splits it into segments. Returns False if the
+		# server does not support range requests.
+		if self.load_state():
+			present = sum([segment['done'] for segment in self.segments])
+			msg('resuming download of {} ({} of {} bytes present)'.format(os.path.basename(self.dest), present, self.size))
+			return True
+		try:
+			with self.open_url({'Range': 'bytes=0-0'}) as response:
+				range_match = re.match(r'^bytes 0-0/(\d+)$', response.headers.get('Content-Range', ''))
+				if (response.status != 206) or (not range_match):
+					return False
+				self.size = int(range_match.group(1))
+				self.validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
+		except (urllib.error.URLError, http.client.HTTPException, OSError):
+			return False
+		num_segments = max(1, min(self.num_segments, self.size // self.min_segment_size))
+		bounds = [self.size * i // num_segments for i in range(num_segments + 1)]
+		self.segments = [{'start': bounds[i], 'end': bounds[i + 1], 'done': 0} for i in range(num_segments)]
+		with open(self.dest_part, 'wb') as f:
+			f.truncate(self.size)
+		self.save_state()
+		return True
+
+	def load_state(self):
+		try:
+			with open(self.state_file) as f:
+				state = json.load(f)
+			if (state['link'] == self.link) and (os.path.getsize(self.dest_part) == state['size']):
+				self.size = state['size']
+				self.validator = state['validator']
+				self.segments = state['segments']
+				return True
+		except (IOError, OSError, ValueError, KeyError):
+			pass
+		self.discard()
+		return False
+
+	def save_state(self, force = True):
+		# Called with every block of data; unless forced, the state file is
+		# only rewritten every state_save_interval seconds.
+		with self.lock:
+			if (not force) and (time.monotonic() - self.last_state_save < self.state_save_interval):
+				return
+			self.last_state_save = time.monotonic()
+			state = {'link': self.link, 'size': self.size, 'validator': self.validator, 'segments': self.segments}
+			with open(self.state_file + '.tmp', 'w') as f:
+				json.dump(state, f)
+			os.rename(self.state_file + '.tmp', self.state_file)
+
+	def discard(self):
+		for fname in [self.dest_part, self.state_file]:
+			if os.path.exists(fname):
+				os.unlink(fname)
+
+	def run(self):
+		# Downloads all segments that are not complete yet. Returns True
+		# once the file is complete and renamed to dest.
+		self.fd = os.open(self.dest_part, os.O_RDWR)
+		try:
+			with concurrent.futures.ThreadPoolExecutor(max_workers = len(self.segments)) as executor:
+				results = list(executor.map(self.fetch_segment, self.segments))
+			if all(results):
+				self.update_digests()
+			os.fsync(self.fd)
+		finally:
+			os.close(self.fd)
+			if os.path.exists(self.dest_part):
+				self.save_state()
+		if not all(results):
+			return False
+		os.rename(self.dest_part, self.dest)
+		os.unlink(self.state_file)
+		return True
+
+	def fetch_segment(self, segment):
+		failures = 0
+		while (segment['done'] < segment['end'] - segment['start']) and not self.failed:
+			done = segment['done']
+			try:
+				if not self.read_segment(segment):
+					# The file changed on the server; the data that is present
+					# is useless, so the next attempt starts from scratch.
+					with self.lock:
+						if not self.failed:
+							error('{} changed on the server during the download'.format(self.link))
+							self.failed = True
+							self.discard()
+					return False
+			except (urllib.error.URLError, http.client.HTTPException, OSError) as e:
+				if isinstance(e, urllib.error.HTTPError) and (e.code < 500) and (e.code not in [408, 429]):
+					failures = self.max_retries
+				elif segment['done'] > done:
+					failures = 0
+				failures += 1
+				description = 'bytes {}-{} of {}'.format(segment['start'] + segment['done'], segment['end'] - 1, self.link)
+				if failures > self.max_retries:
+					error('downloading {} failed: {}'.format(description, e))
+					self.failed = True
+					return False
+				delay = min(self.retry_delay * (2 ** (failures - 1)), self.max_retry_delay)
+				msg('downloading {} failed: {} - retrying in {:.0f}s'.format(description, e, delay))
+				time.sleep(delay)
+		return not self.failed
+
+	def read_segment(self, segment):
+		# Reads the missing part of the segment. Returns False if the server
+		# did not send the requested range, which means that the file
+		# does not match the validator anymore.
+		offset = segment['start'] + segment['done']
+		headers = {'Range': 'bytes={}-{}'.format(offset, segment['end'] - 1)}
+		if self.validator:
+			headers['If-Range'] = self.validator
+		with self.open_url(headers) as response:
+			if (response.status != 206) or (not response.headers.get('Content-Range', '').startswith('bytes {}-'.format(offset))):
+				return False
+			while (segment['done'] < segment['end'] - segment['start']) and not self.failed:
+				buf = response.read(min(1024 * 1024, segment['end'] - offset))
+				if not buf:
+					raise http.client.IncompleteRead(b'', segment['end'] - offset)
+				os.pwrite(self.fd, buf, offset)
+				segment['done'] += len(buf)
+				self.update_digests(buf, offset)
+				offset += len(buf)
+				self.save_state(force = False)
+		return True
+
+	def get_contiguous_size(self):
+		# Returns the number of bytes at the beginning of the file
+		# that are downloaded completely.
+		for segment in self.segments:
+			if segment['done'] < segment['end'] - segment['start']:
+				return segment['start'] + segment['done']
+		return self.size
+
+	def update_digests(self, buf = None, offset = None):
+		# Feeds the data at the beginning of the file that was not hashed yet
+		# into the hashers. buf (written at offset) is used directly if it
+		# continues the hashed data; everything else is read back from the file.
+		# Only one thread hashes at a time, without holding hash_lock, so the
+		# other segments keep downloading while it catches up. Other threads
+		# return right away; the hashing thread picks up their data as well,
+		# since it only stops once it finds no more contiguous data under the
+		# lock.
+		with self.hash_lock:
+			if self.hashing:
+				return
+			self.hashing = True
+		try:
+			while True:
+				with self.hash_lock:
+					available_size = self.get_contiguous_size()
+					if self.hashed_size >= available_size:
+						self.hashing = False
+						return
+				if (buf is not None) and (offset == self.hashed_size):
+					data = buf
+				else:
+					data = os.pread(self.fd, min(1024 * 1024, available_size - self.hashed_size), self.hashed_size)
+					if not data:
+						raise IOError('{} is shorter than expected'.format(self.dest_part))
+				buf = None
+				for hashfuncname, hasher in self.hashers:
+					hasher.update(data)
+				self.hashed_size += len(data)
+		except:
+			with self.hash_lock:
+				self.hashing = False
+			raise
+
+	def get_digests(self):
+		return dict([(hashfuncname, hasher.hexdigest()) for hashfuncname, hasher in self.hashers])
+
+def get_tar_decompression_option(filename):
+	# Returns the tar option for decompressing the given archive, or
+	# None if the file name does not refer to a known archive type.
+	for ext, option in [('.tar.gz', '-z'), ('.tgz', '-z'), ('.tar.bz2', '-j'), ('.tar.xz', '-J'), ('.tar', '')]:
+		if filename.endswith(ext):
+			return option
+	return None
+
+
+
+class StreamingUnpacker(object):
+	# Unpacks a tar archive while it is being downloaded. The downloaded blocks
+	# are passed to feed(), which hands them over to a writer thread through a
+	# bounded queue. The writer thread pipes them into a tar process, so that
+	# decompression and extraction overlap with the download. If they cannot
+	# keep up with the download, the full queue throttles the download.
+
+	def __init__(self, filename, unpack_dir, queue_size = 16):
+		tar_cmdline = ['tar', '-x'] + [x for x in [get_tar_decompression_option(filename)] if x] + ['-f', '-', '-C', unpack_dir]
+		self.queue = queue.Queue(maxsize = queue_size)
+		self.broken_pipe = False
+		self.process = subprocess.Popen(tar_cmdline, stdin = subprocess.PIPE)
+		self.writer = threading.Thread(target = self.write_blocks)
+		self.writer.start()
+
+	def write_blocks(self):
+		while True:
+			buf = self.queue.get()
+			if buf is None:
+				break
+			# If tar exits early, the rest of the data is dropped; the
+			# download itself must continue regardless.
+			if not self.broken_pipe:
+				try:
+					self.process.stdin.write(buf)
+				except (IOError, OSError):
+					self.broken_pipe = True
+		try:
+			self.process.stdin.close()
+		except (IOError, OSError):
+			self.broken_pipe = True
+
+	def feed(self, buf):
+		self.queue.put(buf)
+
+	def finish(self):
+		# Waits until tar is done. Returns True if unpacking succeeded.
+		self.queue.put(None)
+		self.writer.join()
+		return (0 == self.process.wait()) and (not self.broken_pipe)
+
+
+
+def get_git_ident():
+	# Returns "Name <email>" of the git user, or a generic identity
+	# if git does not know who the user is.
+	try:
+		ident = subprocess.check_output(['git', 'var', 'GIT_COMMITTER_IDENT'], stderr = subprocess.DEVNULL).decode('utf-8', 'replace')
+		return ident.rsplit(' ', 2)[0]
+	except (subprocess.CalledProcessError, OSError):
+		return 'build.py <build.py@localhost>'
+
+def quote_git_path(path):
+	return '"' + path.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+
+def import_archive_into_git(archive, git_dir, basename):
+	# Creates the git repository git_dir, with one commit that contains the
+	# files below basename/ in the archive. The files are read from the
+	# archive and piped into git fast-import, which is much faster than
+	# scanning and hashing the unpacked tree again with "git add". The index
+	# is not populated here. Returns True on success.
+	if 0 != call_process(['git', 'init', '--quiet', '--bare', git_dir]):
+		return False
+	ref = subprocess.check_output(['git', '--git-dir', git_dir, 'symbolic-ref', 'HEAD']).decode().strip()
+	process = subprocess.Popen(['git', '--git-dir', git_dir, 'fast-import', '--quiet', '--done'], stdin = subprocess.PIPE)
+	# Maps the names of the archive members to their modes and blob marks.
+	# Hardlinks in the archive refer to members by name.
+	blobs = {}
+	files = []
+	next_mark = 1
+	try:
+		with tarfile.open(archive, 'r|*') as tar:
+			for member in tar:
+				name = posixpath.normpath(member.name)
+				if not name.startswith(basename + '/'):
+					continue
+				path = name[len(basename) + 1:]
+				if '.git' in path.split('/'):
+					continue
+				mark = next_mark
+				if member.isfile():
+					# The size is known in advance, so the contents are
+					# copied in chunks instead of being read into memory.
+					mode = '100755' if (member.mode & 0o111) else '100644'
+					process.stdin.write(b'blob\nmark :%d\ndata %d\n' % (mark, member.size))
+					shutil.copyfileobj(tar.extractfile(member), process.stdin)
+					process.stdin.write(b'\n')
+				elif member.issym():
+					data = member.linkname.encode('utf-8', 'surrogateescape')
+					mode = '120000'
+					process.stdin.write(b'blob\nmark :%d\ndata %d\n' % (mark, len(data)) + data + b'\n')
+				elif member.islnk() and (posixpath.normpath(member.linkname) in blobs):
+					blobs[name] = blobs[posixpath.normpath(member.linkname)]
+					files += [(blobs[name], path)]
+					continue
+				else:
+					continue
+				next_mark += 1
+				blobs[name] = (mode, mark)
+				files += [(blobs[name], path)]
+		ident = '{} {} +0000'.format(get_git_ident(), int(time.time()))
+		message = 'Initial commit\n\nSigned-off-by: {}\n'.format(ident.rsplit(' ', 2)[0]).encode('utf-8')
+		commands = ['commit {}'.format(ref), 'author ' + ident, 'committer ' + ident]
+		process.stdin.write(('\n'.join(commands) + '\ndata {}\n'.format(len(message))).encode('utf-8') + message)
+		for (mode, mark), path in files:
+			process.stdin.write('M {} :{} {}\n'.format(mode, mark, quote_git_path(path)).encode('utf-8', 'surrogateescape'))
+		process.stdin.write(b'\ndone\n')
+		process.stdin.close()
+	except (tarfile.TarError, IOError, OSError) as e:
+		error('could not import {} into git: {}'.format(archive, e))
+		process.kill()
+		process.wait()
+		return False
+	return 0 == process.wait()
+
+def parse_size(text):
+	# Parses sizes like "500M" or "20G" into a number of bytes.
+	size_match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([kKmMgGtT]?)i?[bB]?\s*$', text)
+	if not size_match:
+		raise ValueError('invalid size "{}"'.format(text))
+	factor = 1024 ** ' kmgt'.index(size_match.group(2).lower() or ' ')
+	return int(float(size_match.group(1)) * factor)
+
+def format_duration(seconds):
+	seconds = int(round(seconds))
+	if seconds >= 3600:
+		return '{}h {:02d}m {:02d}s'.format(seconds // 3600, (seconds // 60) % 60, seconds % 60)
+	elif seconds >= 60:
+		return '{}m {:02d}s'.format(seconds // 60, seconds % 60)
+	else:
+		return '{}s'.format(seconds)
+
+def clone_file(src, dest, allow_hardlink = True):
+	# Makes dest a copy of src as cheaply as possible: as a reflink on
+	# filesystems that support it (btrfs, xfs), otherwise as a hardlink
+	# (unless allow_hardlink is False), and only as a last resort as a real
+	# copy. Returns "reflink", "hardlink" or "copy" accordingly.
+	FICLONE = 0x40049409
+	try:
+		with open(src, 'rb') as src_file, open(dest, 'wb') as dest_file:
+			fcntl.ioctl(dest_file.fileno(), FICLONE, src_file.fileno())
+		return 'reflink'
+	except (IOError, OSError):
+		if os.path.exists(dest):
+			os.unlink(dest)
+	if allow_hardlink:
+		try:
+			os.link(src, dest)
+			return 'hardlink'
+		except OSError:
+			pass
+	shutil.copy2(src, dest)
+	return 'copy'
+
+def copy_tree(src, dest, allow_hardlinks):
+	# Recreates the directory src as dest (which must not exist yet), using
+	# clone_file() for the files. Reflinked and copied files are writable and
+	# keep the modification time of the original, since build systems like
+	# make compare them; hardlinked files share everything with the original.
+	os.mkdir(dest)
+	for entry in os.scandir(src):
+		dest_path = os.path.join(dest, entry.name)
+		if entry.is_symlink():
+			os.symlink(os.readlink(entry.path), dest_path)
+		elif entry.is_dir():
+			copy_tree(entry.path, dest_path, allow_hardlinks)
+		elif clone_file(entry.path, dest_path, allow_hardlinks) != 'hardlink':
+			st = entry.stat()
+			os.chmod(dest_path, st.st_mode | 0o200)
+			os.utime(dest_path, ns = (st.st_atime_ns, st.st_mtime_ns))
+	shutil.copystat(src, dest)
+
+@contextlib.contextmanager
+def locked_file(fname, exclusive = True):
+	# Holds an flock() based lock on the given file. Since every call opens
+	# the file anew, this works across threads as well as across processes.
+	with open(fname, 'a') as f:
+		fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+		try:
+			yield
+		finally:
+			fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def compute_fingerprint(items):
+	# Computes a fingerprint (a SHA-256 hex digest) out of a list of items.
+	hasher = hashlib.sha256()
+	for item in items:
+		if not isinstance(item, bytes):
+			item = str(item).encode('utf-8')
+		hasher.update(str(len(item)).encode('utf-8') + b':' + item)
+	return hasher.hexdigest()
+
+def read_stamp(fname):
+	try:
+		with open(fname, 'r') as f:
+			return f.read().strip()
+	except (IOError, OSError):
+		return None
+
+def write_stamp(fname, content):
+	mkdir_p(os.path.dirname(fname))
+	fname_tmp = '{}.tmp-{}-{}'.format(fname, os.getpid(), threading.get_ident())
+	with open(fname_tmp, 'w') as f:
+		f.write(content + '\n')
+	os.rename(fname_tmp, fname)
+
+def get_tool_version(cmdline, pattern):
+	# Runs the given version query command and returns the version number
+	# matched by the pattern as a tuple of ints, or None if the tool is
+	# not available or the output could not be parsed.
+	try:
+		output = subprocess.check_output(cmdline.split(), stderr = subprocess.DEVNULL).decode('utf-8', 'replace')
+	except (subprocess.CalledProcessError, OSError):
+		return None
+	ver_match = re.search(pattern, output)
+	if not ver_match:
+		return None
+	return tuple([int(x) for x in ver_match.groups()])
+
+def is_autoconf_configure(fname):
+	# autoconf puts a "Generated by GNU Autoconf" comment into the
+	# first lines of the configure scripts it generates.
+	try:
+		with open(fname, 'rb') as f:
+			return b'Generated by GNU Autoconf' in f.read(4096)
+	except (IOError, OSError):
+		return False
+
+
+def read_process_io(pid):
+	# Returns the I/O counters of a process from /proc/<pid>/io, or an
+	# empty dict if they are not available.
+	try:
+		with open('/proc/{}/io'.format(pid)) as f:
+			return dict([(key.strip(), int(value)) for key, value in [line.split(':', 1) for line in f if ':' in line]])
+	except (IOError, OSError, ValueError):
+		return {}
+
+def call_process(args, **kwargs):
+	# Works like subprocess.call(), but additionally records the wall time,
+	# CPU time, peak RSS and I/O of the process (including all of its
+	# descendants) in the metrics of the current thread (see BuildMetrics).
+	start_time = time.monotonic()
+	process = subprocess.Popen(args, **kwargs)
+	try:
+		# Wait for the process to exit without reaping it, so that its I/O
+		# counters can still be read. These include the I/O of all the
+		# descendants the process reaped. Then reap it with wait4(), which
+		# returns the resource usage of the process and its descendants.
+		io_counters = {}
+		if hasattr(os, 'waitid'):
+			os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+			io_counters = read_process_io(process.pid)
+		pid, status, rusage = os.wait4(process.pid, 0)
+	except:
+		process.kill()
+		process.wait()
+		raise
+	process.returncode = os.waitstatus_to_exitcode(status)
+	record_command_metrics(args, process.returncode, time.monotonic() - start_time, rusage, io_counters)
+	return process.returncode
+
+def read_ccache_statslog(fname):
+	# Sums up a ccache stats log (see CCACHE_STATSLOG), which contains one
+	# line with the result of every compiler invocation, and comment lines
+	# with the names of the compiled files.
+	counters = {}
+	try:
+		with open(fname) as f:
+			for line in f:
+				line = line.strip()
+				if line and not line.startswith('#'):
+					counters[line] = counters.get(line, 0) + 1
+	except (IOError, OSError):
+		pass
+	hits = sum([count for counter, count in counters.items() if counter.endswith('_cache_hit')])
+	return {'hits': hits, 'misses': counters.get('cache_miss', 0), 'counters': counters}
+
+metrics_scope = threading.local()
+
+def record_command_metrics(args, returncode, wall_time, rusage, io_counters):
+	phase_metrics = getattr(metrics_scope, 'phase_metrics', None)
+	if phase_metrics is None:
+		return
+	phase_metrics['commands'].append({
+		'cmdline': args if isinstance(args, str) else format_command(args),
+		'subpackage': getattr(metrics_scope, 'subpackage', None),
+		'returncode': returncode,
+		'wall_time': wall_time,
+		'user_time': rusage.ru_utime,
+		'system_time': rusage.ru_stime,
+		'max_rss_kb': rusage.ru_maxrss,
+		'read_bytes': io_counters.get('read_bytes', 0),
+		'write_bytes': io_counters.get('write_bytes', 0),
+		'rchar': io_counters.get('rchar', 0),
+		'wchar': io_counters.get('wchar', 0)
+	})
+
+def record_skipped_step(name):
+	# Notes that a build step was skipped since it was up to date. The
+	# duration of such a phase says nothing about the time the package
+	# actually takes to build (see BuildHistory).
+	phase_metrics = getattr(metrics_scope, 'phase_metrics', None)
+	if phase_metrics is not None:
+		phase_metrics['skipped_steps'].append(name)
+
+def inherit_metrics_scope(func):
+	# Returns a callable that runs func with the metrics scope of the current
+	# thread, so the commands run by func in another thread are counted
+	# towards the same package phase and sub-package.
+	phase_metrics = getattr(metrics_scope, 'phase_metrics', None)
+	subpackage = getattr(metrics_scope, 'subpackage', None)
+	def run():
+		metrics_scope.phase_metrics = phase_metrics
+		metrics_scope.subpackage = subpackage
+		return func()
+	return run
+
+@contextlib.contextmanager
+def subpackage_metrics_scope(subpackage):
+	# Attributes all commands that are run in this scope to the given
+	# sub-package (for example one GStreamer module).
+	previous = getattr(metrics_scope, 'subpackage', None)
+	metrics_scope.subpackage = subpackage
+	try:
+		yield
+	finally:
+		metrics_scope.subpackage = previous
+
+
+
+class Jobserver(object):
+	# A GNU make jobserver shared by all builds of a run. It owns a FIFO that
+	# initially contains num_jobs - 1 tokens; the remaining job is the implicit
+	# one that every jobserver client has. GNU make (and ninja starting with
+	# version 1.13) join it through MAKEFLAGS, and only run additional jobs
+	# after they have read a token from the FIFO. This way, the -j value is a
+	# limit for the whole run, even if several builds run at the same time.
+	#
+	# Each concurrently running build needs an implicit job of its own. The
+	# first build uses the jobserver's implicit job; all others have to acquire
+	# a token first (see acquire() and release()). Builds that wait for a token
+	# also wait for the implicit job to be released; release() wakes them up
+	# through a pipe, since the FIFO itself does not become readable then.
+	#
+	# make versions older than 4.4 do not support the FIFO style. With those,
+	# the FIFO is passed on as an inherited file descriptor instead.
+
+	def __init__(self, num_jobs):
+		self.num_jobs = num_jobs
+		self.lock = threading.Lock()
+		self.implicit_job_taken = False
+		self.num_waiters = 0
+		self.wakeup_fds = os.pipe()
+		os.set_blocking(self.wakeup_fds[0], False)
+		self.tmpdir = tempfile.mkdtemp(prefix = 'build-py-jobserver-')
+		self.fifo_path = os.path.join(self.tmpdir, 'fifo')
+		os.mkfifo(self.fifo_path, 0o600)
+		# Opening the FIFO for reading and writing does not block, and keeps
+		# it open even when no child process is currently connected to it.
+		self.fd = os.open(self.fifo_path, os.O_RDWR)
+		os.set_inheritable(self.fd, True)
+		os.write(self.fd, b'+' * (num_jobs - 1))
+
+		make_version = get_tool_version('make --version', r'GNU Make (\d+)\.(\d+)')
+		ninja_version = get_tool_version('ninja --version', r'(\d+)\.(\d+)')
+		self.fifo_style = (make_version is None) or (make_version >= (4, 4))
+		self.ninja_support = self.fifo_style and (ninja_version is not None) and (ninja_version >= (1, 13))
+		atexit.register(self.close)
+
+	def close(self):
+		if self.fd is not None:
+			os.close(self.fd)
+			self.fd = None
+			for fd in self.wakeup_fds:
+				os.close(fd)
+			shutil.rmtree(self.tmpdir, ignore_errors = True)
+
+	def get_makeflags(self):
+		if self.fifo_style:
+			return '-j{} --jobserver-auth=fifo:{}'.format(self.num_jobs, self.fifo_path)
+		else:
+			return '-j{} --jobserver-auth={fd},{fd}'.format(self.num_jobs, fd = self.fd)
+
+	def get_pass_fds(self):
+		if self.fifo_style:
+			return ()
+		else:
+			return (self.fd,)
+
+	def acquire(self):
+		# Acquires the implicit job of a build. Blocks until a token is
+		# available. Returns the token, which has to be passed to release().
+		with self.lock:
+			if not self.implicit_job_taken:
+				self.implicit_job_taken = True
+				return None
+			self.num_waiters += 1
+		# make versions that get the FIFO as an inherited file descriptor
+		# switch it to non-blocking mode, so wait for a token with select().
+		# Another reader may still get the token (or the implicit job) first.
+		try:
+			while True:
+				readable, writable, exceptional = select.select([self.fd, self.wakeup_fds[0]], [], [])
+				if self.wakeup_fds[0] in readable:
+					try:
+						os.read(self.wakeup_fds[0], 1)
+					except BlockingIOError:
+						pass
+					with self.lock:
+						if not self.implicit_job_taken:
+							self.implicit_job_taken = True
+							return None
+				if self.fd in readable:
+					try:
+						return os.read(self.fd, 1)
+					except BlockingIOError:
+						pass
+		finally:
+			with self.lock:
+				self.num_waiters -= 1
+
+	def release(self, token):
+		if token is None:
+			with self.lock:
+				self.implicit_job_taken = False
+				if self.num_waiters > 0:
+					os.write(self.wakeup_fds[1], b'+')
+		else:
+			os.write(self.fd, token)
+
+	def borrow(self, max_tokens):
+		# Takes up to max_tokens tokens without blocking. This is used for
+		# tools that cannot join the jobserver by themselves (like b2); they
+		# get a -j value that corresponds to the borrowed tokens instead.
+		if max_tokens <= 0:
+			return b''
+		readable, writable, exceptional = select.select([self.fd], [], [], 0)
+		if not readable:
+			return b''
+		try:
+			return os.read(self.fd, max_tokens)
+		except BlockingIOError:
+			return b''
+
+	def give_back(self, tokens):
+		if tokens:
+			os.write(self.fd, tokens)
+
+
+
+class DownloadCache(object):
+	# A download cache that can be shared between several root directories.
+	# Files are stored by the SHA-256 digest of their content in objects/.
+	# The index/ directory maps file names to digests. Since the same content
+	# is stored only once, the cache size is limited by evicting the least
+	# recently used objects. The usage times are tracked with separate stamp
+	# files in used/, since the objects themselves are linked into download
+	# directories, and touching them would modify these files as well.
+	# Concurrent access by several build.py instances is synchronized with
+	# a lock file; lookups take a shared lock, modifications an exclusive one.
+
+	def __init__(self, cache_dir, max_size):
+		self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+		self.max_size = max_size
+		self.objects_dir = os.path.join(self.cache_dir, 'objects')
+		self.index_dir = os.path.join(self.cache_dir, 'index')
+		self.used_dir = os.path.join(self.cache_dir, 'used')
+		self.lock_file = os.path.join(self.cache_dir, 'lock')
+		mkdir_p(self.objects_dir)
+		mkdir_p(self.index_dir)
+		mkdir_p(self.used_dir)
+
+	def get_object_path(self, digest):
+		return os.path.join(self.objects_dir, digest[:2], digest)
+
+	def get_index_path(self, key):
+		return os.path.join(self.index_dir, key.replace('/', '_'))
+
+	def mark_used(self, digest):
+		with open(os.path.join(self.used_dir, digest), 'a'):
+			pass
+		os.utime(os.path.join(self.used_dir, digest))
+
+	def get(self, key, dest):
+		# Links the cached file with the given key to dest. Returns the
+		# SHA-256 digest of the file, or None if it is not in the cache.
+		with locked_file(self.lock_file, exclusive = False):
+			try:
+				with open(self.get_index_path(key), 'r') as f:
+					digest = f.read().strip()
+			except (IOError, OSError):
+				return None
+			object_path = self.get_object_path(digest)
+			if not os.path.exists(object_path):
+				return None
+			dest_tmp = '{}.cache-tmp-{}'.format(dest, os.getpid())
+			clone_file(object_path, dest_tmp)
+			os.rename(dest_tmp, dest)
+			self.mark_used(digest)
+		return digest
+
+	def put(self, key, src, digest):
+		# Adds the file src to the cache under the given key. digest is
+		# the SHA-256 digest of the file's content.
+		with locked_file(self.lock_file, exclusive = True):
+			object_path = self.get_object_path(digest)
+			if not os.path.exists(object_path):
+				mkdir_p(os.path.dirname(object_path))
+				object_tmp = '{}.tmp-{}'.format(object_path, os.getpid())
+				clone_file(src, object_tmp)
+				os.rename(object_tmp, object_path)
+			index_path = self.get_index_path(key)
+			index_tmp = '{}.tmp-{}'.format(index_path, os.getpid())
+			with open(index_tmp, 'w') as f:
+				f.write(digest + '\n')
+			os.rename(index_tmp, index_path)
+			self.mark_used(digest)
+			self.evict()
+
+	def evict(self):
+		# Must be called with the exclusive lock held.
+		objects = []
+		total_size = 0
+		for subdir in os.listdir(self.objects_dir):
+			for digest in os.listdir(os.path.join(self.objects_dir, subdir)):
+				if '.tmp-' in digest:
+					continue
+				size = os.path.getsize(self.get_object_path(digest))
+				try:
+					last_used = os.path.getmtime(os.path.join(self.used_dir, digest))
+				except OSError:
+					last_used = 0
+				objects += [(last_used, digest, size)]
+				total_size += size
+		objects.sort()
+		# Index entries of evicted objects are left behind; get()
+		# treats entries whose object is missing as cache misses.
+		while (total_size > self.max_size) and objects:
+			last_used, digest, size = objects.pop(0)
+			msg('Evicting {} from the download cache'.format(digest))
+			os.unlink(self.get_object_path(digest))
+			if os.path.exists(os.path.join(self.used_dir, digest)):
+				os.unlink(os.path.join(self.used_dir, digest))
+			total_size -= size
+
+
+
+class GitMirrorStore(object):
+	# A store of bare mirrors of upstream git repositories, keyed by their URL.
+	# Every run fetches new commits from upstream into the mirrors. Checkouts in
+	# the staging directory are clones of the mirror that share its objects (see
+	# "git clone --shared"), so several checkouts of the same repository (for
+	# example in different root directories) need the history only once, and
+	# updating them does not need any network access. Since these clones rely
+	# on the mirror's objects, unreachable objects in mirrors are never pruned.
+
+	def __init__(self, mirror_dir):
+		self.mirror_dir = os.path.abspath(os.path.expanduser(mirror_dir))
+		self.updated_links = set()
+		self.updated_links_lock = threading.Lock()
+		mkdir_p(self.mirror_dir)
+
+	def get_mirror_path(self, link):
+		name = re.sub(r'[^A-Za-z0-9._-]+', '_', link.split('://')[-1]).strip('_')
+		return os.path.join(self.mirror_dir, '{}-{}.git'.format(name, hashlib.sha1(link.encode('utf-8')).hexdigest()[:8]))
+
+	def update_mirror(self, link):
+		# Creates the mirror of the given upstream repository or fetches
+		# new commits into it (once per run). Returns the path to the
+		# mirror, or None if this failed.
+		mirror = self.get_mirror_path(link)
+		with locked_file(mirror + '.lock', exclusive = True):
+			with self.updated_links_lock:
+				if link in self.updated_links:
+					return mirror
+			if os.path.exists(mirror):
+				msg('Fetching {} into git mirror {}'.format(link, mirror))
+				success = (0 == call_process(['git', '--git-dir', mirror, 'fetch', '--prune', '--quiet']))
+			else:
+				msg('Creating git mirror {} of {}'.format(mirror, link))
+				mirror_tmp = mirror + '.tmp'
+				if os.path.exists(mirror_tmp):
+					shutil.rmtree(mirror_tmp)
+				success = True
+				success = success and (0 == call_process(['git', 'clone', '--mirror', link, mirror_tmp]))
+				success = success and (0 == call_process(['git', '--git-dir', mirror_tmp, 'config', 'gc.pruneExpire', 'never']))
+				if success:
+					os.rename(mirror_tmp, mirror)
+			if not success:
+				error('could not update git mirror of {}'.format(link))
+				return None
+			with self.updated_links_lock:
+				self.updated_links.add(link)
+		return mirror
+
+	def checkout(self, link, staging, checkout = None):
+		mirror = self.update_mirror(link)
+		if mirror is None:
+			return False
+
+		if not os.path.exists(staging):
+			msg('Directory {} not present - cloning from git mirror {}'.format(staging, mirror))
+			branch_options = ['-b', checkout] if checkout else []
+			success = True
+			success = success and (0 == call_process(['git', 'clone', '--shared'] + branch_options + [mirror, staging]))
+			success = success and (0 == call_process(['git', 'remote', 'set-url', 'origin', link], cwd = staging))
+			return success
+
+		msg('Directory {} present - updating it from git mirror {}'.format(staging, mirror))
+		if 0 != call_process(['git', 'fetch', '--quiet', '--tags', mirror, '+refs/heads/*:refs/remotes/origin/*'], cwd = staging):
+			return False
+
+		# Never touch checkouts with local modifications.
+		if subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd = staging).strip():
+			msg('Directory {} contains local modifications - not updating the checkout'.format(staging))
+			return True
+
+		if checkout and (0 == call_process(['git', 'show-ref', '--verify', '--quiet', 'refs/tags/' + checkout], cwd = staging)):
+			return (0 == call_process(['git', 'checkout', '--quiet', '--detach', 'refs/tags/' + checkout], cwd = staging))
+
+		current_branch = subprocess.check_output(['git', 'rev-parse', '--abbrev-ref', 'HEAD'], cwd = staging).decode('utf-8').strip()
+		branch = checkout or current_branch
+		if branch != current_branch:
+			msg('Directory {} has branch {} checked out instead of {} - not updating the checkout'.format(staging, current_branch, branch))
+			return True
+		if 0 != call_process(['git', 'merge', '--ff-only', '--quiet', 'refs/remotes/origin/' + branch], cwd = staging):
+			msg('Branch {} in directory {} cannot be fast-forwarded - not updating the checkout'.format(branch, staging))
+		return True
+
+
+
+class SourceStore(object):
+	# A store of pristine unpacked source trees, one per archive, keyed by the
+	# SHA-256 digest of the archive. An archive is only unpacked once; after
+	# that, its tree is copied to the staging directory with copy_tree(),
+	# which takes next to no time with reflinks (btrfs, xfs). On other file
+	# systems, the files are hardlinked if allow_hardlinks is set, and copied
+	# otherwise. Since hardlinked files are shared with the store, the files
+	# in the store are read-only, so that builds cannot modify them in place.
+	# Like the download cache, the store can be shared between root directories.
+
+	def __init__(self, store_dir, allow_hardlinks):
+		self.store_dir = os.path.abspath(os.path.expanduser(store_dir))
+		self.allow_hardlinks = allow_hardlinks
+		mkdir_p(self.store_dir)
+
+	def get_tree_path(self, digest):
+		return os.path.join(self.store_dir, digest[:2], digest)
+
+	def add_tree(self, archive, digest):
+		# Unpacks the archive into the store, unless it is already there.
+		# The tree is unpacked into a temporary directory first and renamed
+		# once it is complete, so the store never contains partial trees.
+		tree = self.get_tree_path(digest)
+		mkdir_p(os.path.dirname(tree))
+		with locked_file(tree + '.lock', exclusive = True):
+			if os.path.exists(tree):
+				return True
+			tree_tmp = tempfile.mkdtemp(prefix = digest + '-', dir = os.path.dirname(tree))
+			msg('Unpacking {} into the source store'.format(os.path.basename(archive)))
+			if 0 != call_process(['tar', 'xf', archive, '-C', tree_tmp]):
+				shutil.rmtree(tree_tmp)
+				return False
+			for dirpath, dirnames, filenames in os.walk(tree_tmp):
+				for filename in filenames:
+					path = os.path.join(dirpath, filename)
+					if not os.path.islink(path):
+						os.chmod(path, os.stat(path).st_mode & ~0o222)
+			os.rename(tree_tmp, tree)
+		return True
+
+	def materialize(self, archive, digest, dest):
+		# Copies the contents of the tree of the archive into the
+		# directory dest, which must exist and be empty.
+		if not self.add_tree(archive, digest):
+			return False
+		tree = self.get_tree_path(digest)
+		msg('Copying the tree of {} from the source store'.format(os.path.basename(archive)))
+		os.rmdir(dest)
+		copy_tree(tree, dest, self.allow_hardlinks)
+		return True
+
+
+
+class ConfigureCache(object):
+	# A cache file for configure scripts (see autoconf's --cache-file) that is
+	# shared by all packages with autoconf generated configure scripts, so the
+	# checks that all of them do (compiler characteristics, system headers and
+	# functions etc.) are only done once. There is one cache file per toolchain
+	# fingerprint. Every configure run works on a private copy of it (see
+	# checkout()), whose results are merged back afterwards (see merge()),
+	# since packages are configured concurrently.
+	#
+	# The cache is kept in the installation directory, and tied to the
+	# contents of that directory: once a package got installed, checks whose
+	# result may depend on it are done again. These are the checks that
+	# failed (the package may provide what was missing) and the paths of
+	# programs (they may be found in the installation now). Some entries are
+	# never shared: the values of the "precious" variables of a configure
+	# run (ac_cv_env_*), which configure compares with the environment, and
+	# pkg-config results (pkg_cv_*), which are stored under variable names
+	# that mean different things in different packages.
+
+	entry_pattern = re.compile(r'^(?:test "\$\{(\w+)\+set\}" = set \|\| )?(\w+_cv_\w+)=')
+
+	def __init__(self, cache_dir, inst_dir):
+		self.cache_dir = cache_dir
+		self.inst_dir = inst_dir
+
+	def get_cache_path(self, toolchain_fingerprint):
+		return os.path.join(self.cache_dir, toolchain_fingerprint + '.cache')
+
+	def get_installation_fingerprint(self):
+		# Covers the names, sizes and modification times of all installed
+		# files; the stamps, caches etc. in the top-level dot directories
+		# of the installation directory are not part of it.
+		items = []
+		for dirpath, dirnames, filenames in os.walk(self.inst_dir):
+			if dirpath == self.inst_dir:
+				dirnames[:] = [dirname for dirname in dirnames if not dirname.startswith('.')]
+			dirnames.sort()
+			for filename in sorted(filenames):
+				path = os.path.join(dirpath, filename)
+				try:
+					st = os.lstat(path)
+				except OSError:
+					continue
+				items += [os.path.relpath(path, self.inst_dir), st.st_size, st.st_mtime_ns]
+		return compute_fingerprint(items)
+
+	def read_entries(self, fname):
+		# Returns the entries of a cache file as an ordered dict which maps
+		# the cache variable names to the lines that set them.
+		entries = collections.OrderedDict()
+		try:
+			with open(fname) as f:
+				lines = f.read().splitlines()
+		except (IOError, OSError):
+			return entries
+		name = None
+		for line in lines:
+			match = self.entry_pattern.match(line)
+			if match:
+				name = match.group(2)
+				entries[name] = line
+			elif name is not None:
+				# Continuation of a value that contains newlines.
+				entries[name] += '\n' + line
+		return entries
+
+	def filter_entries(self, entries, installation_changed):
+		filtered = collections.OrderedDict()
+		for name, line in entries.items():
+			if name.startswith('ac_cv_env_') or name.startswith('pkg_cv_'):
+				continue
+			if installation_changed:
+				if name.startswith('ac_cv_path_') or name.startswith('ac_cv_prog_'):
+					continue
+				if re.search(r"=(no|'no')\}?$", line):
+					continue
+			filtered[name] = line
+		return filtered
+
+	def write_entries(self, fname, entries):
+		fname_tmp = '{}.tmp-{}-{}'.format(fname, os.getpid(), threading.get_ident())
+		with open(fname_tmp, 'w') as f:
+			f.write('# Shared configure cache, written by build.py\n')
+			f.writelines([line + '\n' for line in entries.values()])
+		os.rename(fname_tmp, fname)
+
+	def checkout(self, toolchain_fingerprint, dest):
+		# Writes the shared entries that are still valid to dest, the private
+		# cache file of a configure run. Returns the fingerprint of the
+		# installation, which has to be passed to merge() later.
+		cache_path = self.get_cache_path(toolchain_fingerprint)
+		mkdir_p(self.cache_dir)
+		with locked_file(cache_path + '.lock', exclusive = True):
+			installation_fingerprint = self.get_installation_fingerprint()
+			installation_changed = read_stamp(cache_path + '.installation') != installation_fingerprint
+			entries = self.filter_entries(self.read_entries(cache_path), installation_changed)
+		self.write_entries(dest, entries)
+		msg('configure cache: {} shared results'.format(len(entries)))
+		return installation_fingerprint
+
+	def merge(self, toolchain_fingerprint, src, installation_fingerprint):
+		# Adds the results of a configure run, which used the private cache
+		# file src, to the shared cache. installation_fingerprint is the one
+		# checkout() returned. If packages got installed in the meantime, the
+		# results are filtered like those of the shared cache itself.
+		cache_path = self.get_cache_path(toolchain_fingerprint)
+		with locked_file(cache_path + '.lock', exclusive = True):
+			current_fingerprint = self.get_installation_fingerprint()
+			entries = self.filter_entries(self.read_entries(cache_path), read_stamp(cache_path + '.installation') != current_fingerprint)
+			entries.update(self.filter_entries(self.read_entries(src), installation_fingerprint != current_fingerprint))
+			self.write_entries(cache_path, entries)
+			write_stamp(cache_path + '.installation', current_fingerprint)
+
+	def discard(self, toolchain_fingerprint):
+		# Called if a configure run only succeeded without the shared results;
+		# one of them is probably wrong, so the cache starts over.
+		cache_path = self.get_cache_path(toolchain_fingerprint)
+		with locked_file(cache_path + '.lock', exclusive = True):
+			for fname in [cache_path, cache_path + '.installation']:
+				if os.path.exists(fname):
+					os.unlink(fname)
+
+
+
+class InstallManifests(object):
+	# Packages are not installed into the installation directory directly.
+	# They are installed into a staging directory (with DESTDIR or the like)
+	# first, whose contents are then merged into the installation directory
+	# by merge(). Merging is serialized with a lock, so packages that are
+	# built at the same time can still be installed at the same time; a
+	# failed install leaves nothing behind in the installation directory.
+	#
+	# Every package has a manifest in .manifests/<package>.json, which lists
+	# the installed files of each of its sub-packages (or of the package
+	# itself, if it has no sub-packages) together with the package version
+	# they were installed for. The manifests are used for detecting files
+	# that are installed by more than one package, for removing the files
+	# of an older version once a package was upgraded (see finish_package()),
+	# and for uninstalling packages (see uninstall()). Files that are not
+	# listed in any manifest (installed by earlier versions of this script)
+	# are simply overwritten.
+
+	# Files that several packages are expected to install; they are
+	# not checked for conflicts.
+	shared_files = [os.path.join('share', 'info', 'dir')]
+	# Directories created by Context.set_variant(); these are kept even
+	# if uninstalling leaves them empty.
+	base_dirs = ['bin', 'include', 'lib', os.path.join('lib', 'pkgconfig'), 'share', os.path.join('share', 'aclocal'), 'run']
+
+	def __init__(self, inst_dir):
+		self.inst_dir = inst_dir
+		self.manifests_dir = os.path.join(inst_dir, '.manifests')
+
+	def get_manifest_path(self, package_name):
+		return os.path.join(self.manifests_dir, package_name + '.json')
+
+	def load_manifest(self, package_name):
+		try:
+			with open(self.get_manifest_path(package_name)) as f:
+				return json.load(f)
+		except (IOError, OSError, ValueError):
+			return {'package': package_name, 'version': None, 'subpackages': {}}
+
+	def save_manifest(self, manifest):
+		fname = self.get_manifest_path(manifest['package'])
+		if not manifest['subpackages']:
+			if os.path.exists(fname):
+				os.unlink(fname)
+			return
+		fname_tmp = '{}.tmp-{}-{}'.format(fname, os.getpid(), threading.get_ident())
+		with open(fname_tmp, 'w') as f:
+			json.dump(manifest, f, indent = '\t', sort_keys = True)
+		os.rename(fname_tmp, fname)
+
+	def get_owners(self, excluded_package = None):
+		# Maps every file listed in a manifest to the set of packages
+		# that installed it, except for excluded_package.
+		owners = {}
+		if not os.path.isdir(self.manifests_dir):
+			return owners
+		for fname in sorted(os.listdir(self.manifests_dir)):
+			if not fname.endswith('.json'):
+				continue
+			package_name = fname[:-len('.json')]
+			if package_name == excluded_package:
+				continue
+			for entry in self.load_manifest(package_name)['subpackages'].values():
+				for path in entry['files']:
+					owners.setdefault(path, set()).add(package_name)
+		return owners
+
+	def get_staged_files(self, staged_dir):
+		# Returns the paths (relative to staged_dir) of all files and
+		# symlinks in staged_dir. Directories are not listed; they are
+		# created as needed when the files are merged.
+		files = []
+		for dirpath, dirnames, filenames in os.walk(staged_dir):
+			for dirname in dirnames:
+				path = os.path.join(dirpath, dirname)
+				if os.path.islink(path):
+					files += [os.path.relpath(path, staged_dir)]
+			for filename in filenames:
+				files += [os.path.relpath(os.path.join(dirpath, filename), staged_dir)]
+		return sorted(files)
+
+	@contextlib.contextmanager
+	def lock(self):
+		mkdir_p(self.manifests_dir)
+		with locked_file(os.path.join(self.manifests_dir, '.lock'), exclusive = True):
+			yield
+
+	def merge(self, package_name, package_version, subpackage, destdir):
+		# Merges the files that were installed into destdir into the
+		# installation directory, and records them in the manifest of the
+		# package. Fails without changing anything if one of the files
+		# belongs to another package.
+		staged_dir = os.path.join(destdir, self.inst_dir.lstrip(os.sep))
+		outside_files = [path for path in self.get_staged_files(destdir) if not os.path.join(destdir, path).startswith(staged_dir + os.sep)]
+		if outside_files:
+			msg('{}: files outside of the installation directory are not installed: {}'.format(subpackage, ', '.join([os.sep + path for path in outside_files[:10]])))
+		files = self.get_staged_files(staged_dir) if os.path.isdir(staged_dir) else []
+
+		with self.lock():
+			owners = self.get_owners(excluded_package = package_name)
+			conflicts = [path for path in files if (path in owners) and (path not in self.shared_files)]
+			if conflicts:
+				for path in conflicts[:10]:
+					error('{}: {} is already installed by {}'.format(subpackage, path, ', '.join(sorted(owners[path]))))
+				error('{}: {} file(s) conflict with other packages - not installing anything'.format(subpackage, len(conflicts)))
+				return False
+			for path in files:
+				dest = os.path.join(self.inst_dir, path)
+				if os.path.isdir(dest) and not os.path.islink(dest):
+					error('{}: cannot install {}, since it is a directory in the installation'.format(subpackage, path))
+					return False
+
+			# Until the merge is complete, the manifest lists both the files of
+			# the previous install and the new ones, so the files of a merge
+			# that gets interrupted can still be removed.
+			manifest = self.load_manifest(package_name)
+			previous_entry = manifest['subpackages'].get(subpackage)
+			previous_files = previous_entry['files'] if previous_entry else []
+			manifest['version'] = package_version
+			manifest['subpackages'][subpackage] = {'version': package_version, 'files': sorted(set(previous_files) | set(files))}
+			self.save_manifest(manifest)
+
+			for path in files:
+				src = os.path.join(staged_dir, path)
+				dest = os.path.join(self.inst_dir, path)
+				mkdir_p(os.path.dirname(dest))
+				try:
+					os.replace(src, dest)
+				except OSError:
+					# The staging directory is on another file system.
+					if os.path.lexists(dest):
+						os.unlink(dest)
+					shutil.copy2(src, dest, follow_symlinks = False)
+			msg('{}: {} file(s) installed'.format(subpackage, len(files)))
+
+			# Files of the previous install that are not part of this one.
+			manifest['subpackages'][subpackage] = {'version': package_version, 'files': files}
+			self.remove_files(set(previous_files) - self.get_files(manifest) - set(owners))
+			self.save_manifest(manifest)
+		return True
+
+	def get_files(self, manifest):
+		files = set()
+		for entry in manifest['subpackages'].values():
+			files.update(entry['files'])
+		return files
+
+	def finish_package(self, package_name, package_version):
+		# Called once a package was built successfully. Removes the files of
+		# sub-packages that were installed for another version of the package
+		# (and not installed again for this one), for example after upgrading.
+		with self.lock():
+			manifest = self.load_manifest(package_name)
+			obsolete = [subpackage for subpackage, entry in manifest['subpackages'].items() if entry['version'] != package_version]
+			if not obsolete:
+				return
+			obsolete_files = set()
+			for subpackage in obsolete:
+				obsolete_files.update(manifest['subpackages'].pop(subpackage)['files'])
+			obsolete_files -= self.get_files(manifest)
+			obsolete_files -= set(self.get_owners(excluded_package = package_name))
+			msg('{}: removing {} file(s) of {}'.format(package_name, len(obsolete_files), ', '.join(sorted(obsolete))))
+			# The manifest is only updated once the files are removed, so they
+			# are not forgotten if this gets interrupted.
+			self.remove_files(obsolete_files)
+			self.save_manifest(manifest)
+
+	def uninstall(self, package_name):
+		# Removes all files of the package, except for those that
+		# other packages installed as well. Returns False if the
+		# package is not installed (or has no manifest).
+		with self.lock():
+			manifest = self.load_manifest(package_name)
+			if not manifest['subpackages']:
+				return False
+			files = self.get_files(manifest) - set(self.get_owners(excluded_package = package_name))
+			msg('{}: removing {} file(s)'.format(package_name, len(files)))
+			self.remove_files(files)
+			manifest['subpackages'] = {}
+			self.save_manifest(manifest)
+		return True
+
+	def remove_files(self, files):
+		# Removes the given files (paths relative to the installation
+		# directory), and the directories that become empty as a result.
+		dirs = set()
+		for path in files:
+			full_path = os.path.join(self.inst_dir, path)
+			if os.path.lexists(full_path):
+				os.unlink(full_path)
+			dirs.add(os.path.dirname(path))
+		for path in sorted(dirs, key = lambda path: -path.count(os.sep)):
+			while path and (path not in self.base_dirs):
+				try:
+					os.rmdir(os.path.join(self.inst_dir, path))
+				except OSError:
+					break
+				path = os.path.dirname(path)
+
+
+
+class MirrorSelector(object):
+	# Picks the mirror to download files from. Mirror lists map an origin (the
+	# beginning of the download links of an upstream site, for example
+	# GLibBuilder.glib_source) to base URLs that have the same directory layout
+	# below them. Before the first download from an origin, all of its mirrors
+	# (and the origin itself) are probed concurrently by fetching the first
+	# probe_size bytes of the file. They are ranked by the time it would take
+	# them to deliver reference_size bytes, based on the latency until the
+	# response arrived and the throughput of the probe. The ranking is cached
+	# in a file for ranking_ttl seconds. Downloads go to the best mirror first,
+	# and fail over to the next one if it fails or stalls; a mirror that failed
+	# is moved to the end of the cached ranking.
+
+	probe_size = 256 * 1024
+	probe_timeout = 10
+	reference_size = 16 * 1024 * 1024
+	ranking_ttl = 24 * 60 * 60
+
+	def __init__(self, mirrors, ranking_file):
+		self.mirrors = mirrors
+		self.ranking_file = ranking_file
+		self.lock = threading.Lock()
+		self.origin_locks = {}
+		try:
+			with open(self.ranking_file) as f:
+				self.rankings = json.load(f)
+		except (IOError, OSError, ValueError):
+			self.rankings = {}
+
+	def get_links(self, link, link_hash):
+		# Returns the (link, link_hash) pairs to try, best mirror first. Links
+		# that do not start with one of the origins are returned as they are.
+		origins = [origin for origin in self.mirrors if link.startswith(origin + '/')]
+		if not origins:
+			return [(link, link_hash)]
+		origin = max(origins, key = len)
+		bases = self.mirrors[origin]
+		def relocate(base, url):
+			return (base + url[len(origin):]) if (url is not None) and url.startswith(origin) else url
+		ranked_bases = self.get_ranking(origin, bases, link[len(origin):])
+		return [(relocate(base, link), relocate(base, link_hash)) for base in ranked_bases]
+
+	def get_ranking(self, origin, bases, path):
+		with self.lock:
+			origin_lock = self.origin_locks.setdefault(origin, threading.Lock())
+		# Concurrent downloads from the same origin (like the GStreamer
+		# modules) wait for the first one to probe the mirrors.
+		with origin_lock:
+			with self.lock:
+				ranking = self.rankings.get(origin)
+			if ranking and (time.time() - ranking['time'] < self.ranking_ttl) and (sorted([entry['url'] for entry in ranking['mirrors']]) == sorted(bases)):
+				return [entry['url'] for entry in ranking['mirrors']]
+			msg('probing {} mirror(s) of {}'.format(len(bases), origin))
+			with concurrent.futures.ThreadPoolExecutor(max_workers = len(bases)) as executor:
+				results = list(executor.map(lambda base: self.probe(base + path), bases))
+			entries = []
+			for base, result in zip(bases, results):
+				entry = {'url': base, 'latency': None, 'throughput': None, 'score': None}
+				if result:
+					entry['latency'], entry['throughput'] = result
+					entry['score'] = entry['latency'] + self.reference_size / max(entry['throughput'], 1.0)
+				entries += [entry]
+			# Mirrors that could not be probed go last, in the configured order.
+			entries.sort(key = lambda entry: (entry['score'] is None, entry['score'] or 0.0))
+			for entry in entries:
+				if entry['score'] is None:
+					msg('mirror {}: not reachable or file missing'.format(entry['url']))
+				else:
+					msg('mirror {}: latency {:.0f} ms, {:.1f} MB/s'.format(entry['url'], entry['latency'] * 1000, entry['throughput'] / (1024 * 1024)))
+			self.set_ranking(origin, entries)
+			return [entry['url'] for entry in entries]
+
+	def probe(self, link):
+		# Returns the latency and the throughput (in bytes per second) of a
+		# mirror, or None if it does not deliver the file.
+		request = urllib.request.Request(link, headers = {'User-Agent': 'build.py', 'Range': 'bytes=0-{}'.format(self.probe_size - 1)})
+		start_time = time.monotonic()
+		try:
+			with urllib.request.urlopen(request, timeout = self.probe_timeout) as response:
+				latency = time.monotonic() - start_time
+				size = len(response.read(self.probe_size))
+		except (urllib.error.URLError, http.client.HTTPException, OSError):
+			return None
+		return (latency, size / max(time.monotonic() - start_time - latency, 1e-6))
+
+	def report_failure(self, link):
+		# Moves the mirror that link refers to to the end of its ranking.
+		with self.lock:
+			for origin, ranking in self.rankings.items():
+				for entry in ranking['mirrors']:
+					if link.startswith(entry['url'] + '/'):
+						ranking['mirrors'].remove(entry)
+						ranking['mirrors'].append(entry)
+						break
+		self.set_ranking(None, None)
+
+	def set_ranking(self, origin, entries):
+		with self.lock:
+			if origin is not None:
+				self.rankings[origin] = {'time': time.time(), 'mirrors': entries}
+			mkdir_p(os.path.dirname(self.ranking_file))
+			with open(self.ranking_file + '.tmp', 'w') as f:
+				json.dump(self.rankings, f, indent = '\t', sort_keys = True)
+			os.rename(self.ranking_file + '.tmp', self.ranking_file)
+
+
+
+def read_mirror_config(fname):
+	# Reads a mirror configuration file. Every line consists of an origin,
+	# followed by the mirrors of that origin, separated by whitespace. Empty
+	# lines and lines starting with # are ignored. Returns a dict which maps
+	# the origins to lists of mirrors.
+	mirrors = {}
+	with open(fname) as f:
+		for line in f:
+			fields = line.split()
+			if fields and not fields[0].startswith('#'):
+				mirrors[fields[0].rstrip('/')] = [field.rstrip('/') for field in fields[1:]]
+	return mirrors
+
+
+
+class BuildMetrics(object):
+	# Collects the resource usage of every phase (fetch, check, unpack, build)
+	# of every package, and of every command that is run during these phases,
+	# and writes it to a JSON report. The report contains the raw data as well
+	# as totals per package and sub-package.
+
+	totals_keys = ['wall_time', 'user_time', 'system_time', 'read_bytes', 'write_bytes', 'rchar', 'wchar']
+
+	def __init__(self):
+		self.start_time = time.time()
+		self.phases = []
+		self.lock = threading.Lock()
+
+	@contextlib.contextmanager
+	def phase(self, package_name, package_version, phase):
+		# Everything that runs in the current thread within this scope is
+		# counted towards the given phase. The CPU time of the thread itself
+		# (hashing downloads etc.) is included as well.
+		phase_metrics = {
+			'package': package_name,
+			'version': package_version,
+			'phase': phase,
+			'commands': [],
+			'skipped_steps': [],
+			'success': False
+		}
+		previous = getattr(metrics_scope, 'phase_metrics', None)
+		metrics_scope.phase_metrics = phase_metrics
+		start_time = time.monotonic()
+		start_rusage = self.get_thread_rusage()
+		try:
+			yield phase_metrics
+		finally:
+			end_rusage = self.get_thread_rusage()
+			phase_metrics['wall_time'] = time.monotonic() - start_time
+			phase_metrics['thread_user_time'] = end_rusage[0] - start_rusage[0]
+			phase_metrics['thread_system_time'] = end_rusage[1] - start_rusage[1]
+			metrics_scope.phase_metrics = previous
+			with self.lock:
+				self.phases.append(phase_metrics)
+
+	def get_thread_rusage(self):
+		if hasattr(resource, 'RUSAGE_THREAD'):
+			usage = resource.getrusage(resource.RUSAGE_THREAD)
+			return (usage.ru_utime, usage.ru_stime)
+		else:
+			return (0.0, 0.0)
+
+	def sum_commands(self, commands, totals = None):
+		if totals is None:
+			totals = dict([(key, 0) for key in self.totals_keys + ['max_rss_kb', 'commands']])
+		for command in commands:
+			for key in self.totals_keys:
+				if key != 'wall_time':
+					totals[key] += command[key]
+			totals['max_rss_kb'] = max(totals['max_rss_kb'], command['max_rss_kb'])
+			totals['commands'] += 1
+		return totals
+
+	def get_phase_totals(self, phase_metrics):
+		totals = self.sum_commands(phase_metrics['commands'])
+		totals['wall_time'] = phase_metrics['wall_time']
+		totals['user_time'] += phase_metrics['thread_user_time']
+		totals['system_time'] += phase_metrics['thread_system_time']
+		totals['success'] = phase_metrics['success']
+		for key in ['ccache', 'predicted_wall_time', 'slower_than_history']:
+			if key in phase_metrics:
+				totals[key] = phase_metrics[key]
+		return totals
+
+	def get_report(self):
+		with self.lock:
+			phases = list(self.phases)
+		packages = {}
+		for phase_metrics in phases:
+			package = packages.setdefault(phase_metrics['package'], {'version': phase_metrics['version'], 'phases': {}, 'subpackages': {}})
+			package['phases'][phase_metrics['phase']] = self.get_phase_totals(phase_metrics)
+			for command in phase_metrics['commands']:
+				if command['subpackage']:
+					subpackage_totals = package['subpackages'].get(command['subpackage'])
+					package['subpackages'][command['subpackage']] = self.sum_commands([command], subpackage_totals)
+					package['subpackages'][command['subpackage']]['wall_time'] += command['wall_time']
+		for package in packages.values():
+			package['total'] = dict([(key, sum([totals[key] for totals in package['phases'].values()])) for key in self.totals_keys + ['commands']])
+			package['total']['max_rss_kb'] = max([totals['max_rss_kb'] for totals in package['phases'].values()])
+		return {
+			'start_time': self.start_time,
+			'wall_time': time.time() - self.start_time,
+			'packages': packages,
+			'phases': phases
+		}
+
+	def write_report(self, fname):
+		mkdir_p(os.path.dirname(fname))
+		fname_tmp = fname + '.tmp'
+		with open(fname_tmp, 'w') as f:
+			json.dump(self.get_report(), f, indent = '\t', sort_keys = True)
+		os.rename(fname_tmp, fname)
+
+
+
+class BuildHistory(object):
+	# Keeps the resource usage of the phases of past builds in an SQLite
+	# database, keyed by host, package, version, phase and number of jobs,
+	# and predicts the duration of phases from it. Only phases that did all
+	# of their work are recorded; the duration of a phase whose steps were
+	# skipped since they were up to date, or of an incremental rebuild,
+	# would make the predictions far too optimistic.
+
+	# A phase is flagged as slower than its history if it took at least
+	# slowdown_factor times as long as predicted, and at least
+	# slowdown_min_time seconds longer.
+	slowdown_factor = 1.5
+	slowdown_min_time = 30.0
+	# Number of most recent matching entries the predictions are based on.
+	sample_size = 5
+
+	def __init__(self, fname):
+		self.fname = os.path.abspath(os.path.expanduser(fname))
+		self.host = socket.gethostname()
+		self.lock = threading.Lock()
+		mkdir_p(os.path.dirname(self.fname))
+		# Phases are recorded by the threads that build the packages.
+		self.connection = sqlite3.connect(self.fname, timeout = 60, check_same_thread = False)
+		with self.lock, self.connection:
+			self.connection.execute('CREATE TABLE IF NOT EXISTS phases (time REAL, host TEXT, package TEXT, version TEXT, phase TEXT, jobs INTEGER, wall_time REAL, user_time REAL, system_time REAL, max_rss_kb INTEGER)')
+			self.connection.execute('CREATE INDEX IF NOT EXISTS phases_key ON phases (host, package, phase)')
+
+	def record(self, package_name, package_version, phase, num_jobs, totals):
+		with self.lock, self.connection:
+			self.connection.execute('INSERT INTO phases VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (time.time(), self.host, package_name, package_version, phase, num_jobs, totals['wall_time'], totals['user_time'], totals['system_time'], totals['max_rss_kb']))
+
+	def predict(self, package_name, package_version, phase, num_jobs):
+		# Returns the predicted wall time of a phase and a description of the
+		# entries the prediction is based on, or (None, None) if the phase
+		# was never recorded on this host. Entries of the same version and
+		# number of jobs are preferred. Without those, entries of other
+		# versions are used, so a new version is compared with the previous
+		# ones; for example, a minor version bump that doubles the compile
+		# time gets flagged (see is_slowdown()).
+		with self.lock:
+			rows = self.connection.execute('SELECT version, jobs, wall_time FROM phases WHERE host = ? AND package = ? AND phase = ? ORDER BY time DESC', (self.host, package_name, phase)).fetchall()
+		preferences = [
+			lambda version, jobs: (version == package_version) and (jobs == num_jobs),
+			lambda version, jobs: version == package_version,
+			lambda version, jobs: jobs == num_jobs,
+			lambda version, jobs: True
+		]
+		for matches in preferences:
+			selected = [row for row in rows if matches(row[0], row[1])][:self.sample_size]
+			if selected:
+				versions = ', '.join(sorted(set([row[0] for row in selected])))
+				jobs = ', '.join([str(jobs) for jobs in sorted(set([row[1] for row in selected]))])
+				basis = '{} earlier run(s) of version {} with -j {}'.format(len(selected), versions, jobs)
+				return (statistics.median([row[2] for row in selected]), basis)
+		return (None, None)
+
+	def is_slowdown(self, wall_time, predicted_wall_time):
+		if predicted_wall_time is None:
+			return False
+		return (wall_time >= predicted_wall_time * self.slowdown_factor) and (wall_time - predicted_wall_time >= self.slowdown_min_time)
+
 
 
 class Context:
-	def __init__(self, rootdir):
+	# The phases that are run for every package by build_packages().
+	package_phases = ['check', 'unpack', 'build']
+
+	def __init__(self, rootdir, variant = None):
 		self.rootdir = os.path.abspath(os.path.expanduser(rootdir))
 		self.dl_dir = os.path.join(self.rootdir, 'downloads')
 		self.staging_dir = os.path.join(self.rootdir, 'staging')
-		self.inst_dir = os.path.join(self.rootdir, 'installation')
-		self.allowed_paths = [self.dl_dir, self.staging_dir, self.inst_dir]
 		self.num_jobs = 1
+		self.fetch_jobs = 4
+		self.fetch_semaphore = threading.BoundedSemaphore(self.fetch_jobs)
+		self.download_segments = 4
+		self.mirrors = None
+		self.source_store = None
+		self.package_jobs = 1
+		self.jobserver = None
+		self.known_digests = {}
+		self.known_digests_lock = threading.Lock()
+		self.known_digests_file = os.path.join(self.dl_dir, '.verified-digests.json')
+		self.reverify = False
+		self.verify_executor = concurrent.futures.ThreadPoolExecutor(max_workers = os.cpu_count() or 1)
+		self.download_cache = None
+		self.git_clone_strategy = 'full'
+		self.git_mirrors = None
+		self.stream_unpack = False
+		self.streamed_unpacks = {}
+		self.ignore_stamps = False
+		self.incremental = False
+		self.use_configure_cache = False
 		self.local_git = False
-		self.package_builders = {}
+		self.metrics = BuildMetrics()
+		self.history = None
+		self.ccache_dir = None
+		self.reports_dir = os.path.join(self.rootdir, 'reports')
 		mkdir_p(self.dl_dir)
 		mkdir_p(self.staging_dir)
-		mkdir_p(self.inst_dir)
+		self.load_known_digests()
+		self.set_variant(variant)
+
+	def set_variant(self, variant):
+		# Sets the build variant (see build_variants; None is the default
+		# build) and everything that depends on it. Every variant has its own
+		# installation directory, environment, stamps and build state.
+		self.variant = variant
+		if variant:
+			self.inst_dir = os.path.join(self.rootdir, 'installation-' + variant)
+		else:
+			self.inst_dir = os.path.join(self.rootdir, 'installation')
+		self.allowed_paths = [self.dl_dir, self.staging_dir, self.inst_dir]
+		self.configure_cache = ConfigureCache(os.path.join(self.inst_dir, '.configure-cache'), self.inst_dir)
+		self.install_manifests = InstallManifests(self.inst_dir)
+		self.environment = None
+		self.package_fingerprints = {}
+		self.toolchain_fingerprint = None
+		self.toolchain_fingerprint_lock = threading.Lock()
+		self.package_builders = {}
+		self.predictions = {}
+		self.package_predictions = {}
+		self.build_dependencies = {}
+		self.package_start_times = {}
+		self.finished_packages = set()
+		self.slow_phases = []
+		self.progress_lock = threading.Lock()
 		mkdir_p(os.path.join(self.inst_dir, 'bin'))
 		mkdir_p(os.path.join(self.inst_dir, 'include'))
 		mkdir_p(os.path.join(self.inst_dir, 'lib', 'pkgconfig'))
 		mkdir_p(os.path.join(self.inst_dir, 'share', 'aclocal'))
 		mkdir_p(os.path.join(self.inst_dir, 'run'))
 
-	def call_with_env(self, cmd, extra_cmds = None):
-		# Avoid bashisms:
-		# * Use "." , not "source"
-		# * Use environment variable to pass on the rootdir
-		#   instead of script arguments
-		if extra_cmds:
-			cmdline = 'ROOTDIR="{}" . "{}/env.sh" ; {} ; {}'.format(self.rootdir, self.rootdir, extra_cmds, cmd)
+	def create_variant_context(self, variant):
+		# Returns a context for building the given variant. It shares the
+		# settings, the downloads, the source trees, the jobserver, the
+		# metrics and the build history with this context, so variants can
+		# be built at the same time without fetching or unpacking anything
+		# twice, and still keep to the -j limit.
+		ctx = copy.copy(self)
+		ctx.set_variant(variant)
+		for package_name, package_builder in self.package_builders.items():
+			ctx.package_builders[package_name] = package_builder.copy_for_context(ctx)
+		return ctx
+
+	def get_package_label(self, package_name):
+		# Identifies a package in messages, metrics and the build history;
+		# builds of a variant are kept apart from those of other variants.
+		if self.variant:
+			return '{}@{}'.format(package_name, self.variant)
+		else:
+			return package_name
+
+	def get_variant_options(self, build_system):
+		# Returns the arguments which select the variant in the given build
+		# system (see build_variants); none for the default build.
+		if self.variant:
+			return shlex.split(build_variants[self.variant].get(build_system, ''))
+		else:
+			return []
+
+	def setup_ccache(self, ccache_dir, max_size):
+		# Enables ccache for all C and C++ compilations. The size limit is
+		# stored in the configuration file of the cache directory, so it
+		# also applies when ccache cleans up the cache on its own.
+		if not shutil.which('ccache'):
+			error('ccache not found')
+			return False
+		self.ccache_dir = os.path.abspath(os.path.expanduser(ccache_dir))
+		mkdir_p(self.ccache_dir)
+		return 0 == subprocess.call(['ccache', '--max-size', max_size], env = dict(os.environ, CCACHE_DIR = self.ccache_dir), stdout = subprocess.DEVNULL)
+
+	def get_ccache_statslog(self, package_name):
+		return os.path.join(self.staging_dir, '.ccache-stats', package_name + '.log')
+
+	def get_compiler_launcher_env(self):
+		# Returns environment variables that make autotools and Meson
+		# based builds run the compilers through ccache.
+		if self.ccache_dir:
+			environment = self.get_environment()
+			return {'CC': 'ccache ' + (environment.get('CC') or 'cc'), 'CXX': 'ccache ' + (environment.get('CXX') or 'c++')}
+		else:
+			return {}
+
+	def get_cmake_launcher_options(self):
+		# CMake does not accept a launcher in CC and CXX; it has
+		# dedicated variables for that.
+		if self.ccache_dir:
+			return ['-DCMAKE_C_COMPILER_LAUNCHER=ccache', '-DCMAKE_CXX_COMPILER_LAUNCHER=ccache']
+		else:
+			return []
+
+	def setup_mirrors(self, config_file):
+		# Combines the mirror lists of the package builders with the ones in
+		# the configuration file (see read_mirror_config()). The mirrors from
+		# the file come first; the origin itself is always a candidate as well.
+		mirrors = {}
+		for package_builder in self.package_builders.values():
+			for origin, builder_mirrors in package_builder.source_mirrors.items():
+				mirrors.setdefault(origin, []).extend(builder_mirrors)
+		if config_file:
+			for origin, config_mirrors in read_mirror_config(config_file).items():
+				mirrors[origin] = config_mirrors + mirrors.get(origin, [])
+		for origin in mirrors:
+			mirrors[origin] = list(collections.OrderedDict.fromkeys(mirrors[origin] + [origin]))
+		self.mirrors = MirrorSelector(mirrors, os.path.join(self.dl_dir, '.mirror-ranking.json'))
+
+	def setup_jobserver(self, num_variants = 1):
+		# A jobserver is only needed if more than one job can run at a time.
+		if (self.num_jobs > 1) or (self.package_jobs > 1) or (num_variants > 1):
+			self.jobserver = Jobserver(max(1, self.num_jobs))
+
+	def make_jobs_arg(self):
+		# make joins the jobserver through MAKEFLAGS; an explicit
+		# -j argument would make it ignore the jobserver.
+		if self.jobserver:
+			return []
+		else:
+			return ['-j{}'.format(self.num_jobs)]
+
+	@contextlib.contextmanager
+	def job_slots(self, jobserver_aware = False):
+		# Yields the -j argument list for a child process. Tools that are
+		# jobserver aware get no explicit -j argument. Other tools get as
+		# many jobs as tokens can currently be borrowed from the jobserver
+		# (plus the implicit job of the build that runs them).
+		if not self.jobserver:
+			yield ['-j{}'.format(self.num_jobs)]
+		elif jobserver_aware:
+			yield []
+		else:
+			tokens = self.jobserver.borrow(self.num_jobs - 1)
+			try:
+				yield ['-j{}'.format(len(tokens) + 1)]
+			finally:
+				self.jobserver.give_back(tokens)
+
+	def get_environment(self, extra_env = None):
+		# Returns the environment defined by environment_definition, based on
+		# the environment of this process. It is computed only once. Values in
+		# extra_env are expanded like the values in environment_definition,
+		# so they can extend variables (for example "$CFLAGS -fPIC").
+		if self.environment is None:
+			environment = dict(os.environ)
+			variables = dict(environment, installation_dir = self.inst_dir)
+			for name, value in environment_definition:
+				environment[name] = variables[name] = expand_variables(value, variables)
+			if self.variant:
+				variant = build_variants[self.variant]
+				for name, key in [('CFLAGS', 'cflags'), ('CXXFLAGS', 'cflags'), ('LDFLAGS', 'ldflags')]:
+					environment[name] = (environment[name] + ' ' + variant[key]).strip()
+			self.environment = environment
+		environment = dict(self.environment)
+		for name, value in (extra_env or {}).items():
+			environment[name] = expand_variables(value, environment)
+		return environment
+
+	def write_env_script(self):
+		# env.sh (env-<variant>.sh for variants) is for using the
+		# installation from a shell; the script itself does not need it.
+		if self.variant:
+			fname = os.path.join(self.rootdir, 'env-{}.sh'.format(self.variant))
+		else:
+			fname = os.path.join(self.rootdir, 'env.sh')
+		content = generate_env_script(os.path.basename(self.inst_dir))
+		try:
+			with open(fname) as f:
+				if f.read() == content:
+					return
+		except (IOError, OSError):
+			pass
+		with open(fname + '.tmp', 'w') as f:
+			f.write(content)
+		os.chmod(fname + '.tmp', 0o755)
+		os.rename(fname + '.tmp', fname)
+
+	def call_with_env(self, args, extra_env = None, cwd = None):
+		# Runs a command (given as an argument list) with the environment of
+		# the installation (see get_environment()). No shell is involved, and
+		# the working directory is passed on to the child process instead of
+		# calling os.chdir(), since packages may be built concurrently.
+		msg('Executing: ' + format_command(args, extra_env) + (' (in {})'.format(cwd) if cwd else ''))
+		env = self.get_environment(extra_env)
+		pass_fds = ()
+		if self.jobserver:
+			env['MAKEFLAGS'] = self.jobserver.get_makeflags()
+			pass_fds = self.jobserver.get_pass_fds()
+		if self.ccache_dir:
+			env['CCACHE_DIR'] = self.ccache_dir
+			# The results of all compilations of a package are logged
+			# separately, so that they can be summed up per package.
+			phase_metrics = getattr(metrics_scope, 'phase_metrics', None)
+			if phase_metrics:
+				env['CCACHE_STATSLOG'] = self.get_ccache_statslog(phase_metrics['package'])
+		try:
+			return call_process(args, cwd = cwd, env = env, pass_fds = pass_fds)
+		except OSError as e:
+			error('could not run {}: {}'.format(args[0], e))
+			return 127
+
+	def get_file_identity(self, st):
+		# A file whose path, size, modification time and inode did not
+		# change is assumed to have the same content.
+		return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+	def load_known_digests(self):
+		# The known digests are kept in the download directory, so files that
+		# were verified in an earlier run do not have to be read again. Entries
+		# of files that do not exist anymore are dropped.
+		try:
+			with open(self.known_digests_file) as f:
+				known_digests = json.load(f)
+		except (IOError, OSError, ValueError):
+			return
+		for fname, (identity, digests) in known_digests.items():
+			if os.path.exists(fname):
+				self.known_digests[fname] = (identity, digests)
+
+	def save_known_digests(self):
+		# Must be called with known_digests_lock held.
+		fname_tmp = '{}.tmp-{}'.format(self.known_digests_file, os.getpid())
+		with open(fname_tmp, 'w') as f:
+			json.dump(self.known_digests, f, indent = '\t', sort_keys = True)
+		os.rename(fname_tmp, self.known_digests_file)
+
+	def add_known_digests(self, fname, digests):
+		# Records the digests of a file that were computed while it was being
+		# downloaded, together with the identity of the file, so that verifying
+		# the file later does not have to read it again.
+		st = os.stat(fname)
+		with self.known_digests_lock:
+			self.known_digests[fname] = (self.get_file_identity(st), digests)
+			self.save_known_digests()
+
+	def get_file_digest(self, fname, hashfuncname, use_known_digests = True):
+		st = os.stat(fname)
+		identity = self.get_file_identity(st)
+		with self.known_digests_lock:
+			entry = self.known_digests.get(fname)
+		if use_known_digests and entry and (entry[0] == identity) and (hashfuncname in entry[1]):
+			return entry[1][hashfuncname]
+		# hashlib releases the GIL while hashing, so this
+		# can run in parallel on the verification thread pool.
+		digest = hashfile(fname, hashfuncname)
+		with self.known_digests_lock:
+			entry = self.known_digests.get(fname)
+			if entry and (entry[0] == identity) and (entry[1].get(hashfuncname, digest) == digest):
+				entry[1][hashfuncname] = digest
+			else:
+				self.known_digests[fname] = (identity, {hashfuncname: digest})
+			self.save_known_digests()
+		return digest
+
+	def verify_file(self, fname, hashfuncname, expected_digest):
+		# With --reverify, the file is read again even if its digest is known.
+		try:
+			return self.get_file_digest(fname, hashfuncname, not self.reverify) == expected_digest
+		except (IOError, OSError) as e:
+			error('could not verify {}: {}'.format(fname, e))
+			return False
+
+	def get_git_clone_options(self):
+		# "shallow" clones only contain the commit that is checked out, "blobless"
+		# clones contain the full history, but file contents are only fetched
+		# on demand. Both only fetch the branch (or tag) that is checked out.
+		if self.git_clone_strategy == 'shallow':
+			return ['--depth', '1', '--single-branch']
+		elif self.git_clone_strategy == 'blobless':
+			return ['--filter=blob:none', '--single-branch']
 		else:
-			cmdline = 'ROOTDIR="{}" . "{}/env.sh" ; {}'.format(self.rootdir, self.rootdir, cmd)
-		msg("Executing: " + cmdline)
-		retval = subprocess.call(cmdline, shell = True)
-		return retval
+			return []
+
+	def get_stamps_dir(self):
+		# The stamps are stored in the installation directory, since they
+		# describe what was installed there. Deleting the installation
+		# directory therefore also deletes the stamps.
+		return os.path.join(self.inst_dir, '.stamps')
+
+	def get_toolchain_fingerprint(self):
+		with self.toolchain_fingerprint_lock:
+			if self.toolchain_fingerprint is None:
+				items = []
+				for cmdline in ['cc --version', 'c++ --version', 'make --version', 'meson --version', 'ninja --version', 'cmake --version']:
+					try:
+						output = subprocess.check_output(cmdline.split(), stderr = subprocess.DEVNULL)
+					except (subprocess.CalledProcessError, OSError):
+						output = b''
+					items += [cmdline, output]
+				for var in ['CC', 'CXX', 'CFLAGS', 'CXXFLAGS', 'LDFLAGS', 'PATH']:
+					items += [var, os.environ.get(var, '')]
+				items += [generate_env_script().encode('utf-8')]
+				if self.variant:
+					items += [self.variant, json.dumps(build_variants[self.variant], sort_keys = True)]
+				self.toolchain_fingerprint = compute_fingerprint(items)
+		return self.toolchain_fingerprint
+
+	def get_package_fingerprint(self, package_name):
+		# Returns the fingerprint of the package as built in this run, or, if it
+		# was not built in this run, as it was built the last time.
+		fingerprint = self.package_fingerprints.get(package_name)
+		if fingerprint is None:
+			fingerprint = read_stamp(os.path.join(self.get_stamps_dir(), package_name + '.fingerprint'))
+		return fingerprint
+
+	def uninstall_package(self, package_name):
+		# Removes the installed files of the package, as listed in its
+		# manifest, and its stamps, so the next build installs it again.
+		if not self.install_manifests.uninstall(package_name):
+			error('{}: package is not installed, or was installed without a manifest'.format(self.get_package_label(package_name)))
+			return False
+		shutil.rmtree(os.path.join(self.get_stamps_dir(), package_name), ignore_errors = True)
+		try:
+			os.unlink(os.path.join(self.get_stamps_dir(), package_name + '.fingerprint'))
+		except FileNotFoundError:
+			pass
+		self.package_fingerprints.pop(package_name, None)
+		return True
+
+	def get_initial_fingerprint(self, package_name, package_version):
+		# The fingerprint all build steps of a package start with. It covers
+		# the package version, the toolchain, and the fingerprints of the
+		# packages this one depends on, so that rebuilding a dependency
+		# causes this package to be rebuilt as well.
+		package_builder = self.package_builders[package_name]
+		items = [package_name, package_version, self.get_toolchain_fingerprint()]
+		for dep in sorted(package_builder.dependencies):
+			items += [dep, self.get_package_fingerprint(dep) or '']
+		return compute_fingerprint(items)
 
 	def checked_rm(self, options, filelist):
 		# first check if all entries in the filelist are OK
@@ -70,57 +2175,543 @@ class Context:
 		# then actually delete
 		subprocess.call('rm {} {}'.format(options, ' '.join(filelist)), shell = False)
 
+	def fetch_package(self, package_name, package_version):
+		try:
+			package_builder = self.package_builders[package_name]
+		except KeyError:
+			error('invalid package "{}"'.format(package_name))
+			return False
+
+		msg('calling fetch function for package {} version {}'.format(package_name, package_version), 6)
+		with self.metrics.phase(package_name, package_version, 'fetch') as phase_metrics:
+			if not package_builder.fetch(self, package_version):
+				error('fetching package {} version {} failed'.format(package_name, package_version))
+				return False
+			phase_metrics['success'] = True
+		return True
+
+	def fetch_packages(self, packages):
+		# Global fetch phase. The fetch functions of all packages run at the same
+		# time, so the archives and git repositories of all packages are downloaded
+		# concurrently instead of one after the other. The number of transfers that
+		# are actually in flight is limited by fetch_jobs; see fetch_package_file()
+		# and clone_git_repo() in the Builder class.
+		self.fetch_semaphore = threading.BoundedSemaphore(self.fetch_jobs)
+		# Remove trees that were unpacked while downloading in an earlier,
+		# interrupted run (see Builder.stream_package_file()).
+		shutil.rmtree(os.path.join(self.staging_dir, '.streamed'), ignore_errors = True)
+		# The same goes for staged installs (see Builder.staged_install()).
+		shutil.rmtree(os.path.join(self.staging_dir, '.destdir'), ignore_errors = True)
+		funcs = [functools.partial(self.fetch_package, pkg[0], pkg[1]) for pkg in packages]
+		return run_concurrently(funcs)
+
 	def build_package(self, package_name, package_version):
 		try:
 			package_builder = self.package_builders[package_name]
 		except KeyError:
 			error('invalid package "{}"'.format(package_name))
-			return
+			return False
+
+		# Every package that is being built occupies one job of the jobserver.
+		if self.jobserver:
+			token = self.jobserver.acquire()
+			try:
+				return self.run_package_functions(package_builder, package_name, package_version)
+			finally:
+				self.jobserver.release(token)
+		else:
+			return self.run_package_functions(package_builder, package_name, package_version)
 
-		for func in ['fetch', 'check', 'unpack', 'build']:
+	def run_package_functions(self, package_builder, package_name, package_version):
+		package_builder.begin_build_steps(package_name, package_version, self.get_initial_fingerprint(package_name, package_version))
+		package_label = self.get_package_label(package_name)
+		with self.progress_lock:
+			self.package_start_times[package_name] = time.monotonic()
+
+		# The fetch function is not called here, since all packages
+		# are fetched in advance by fetch_packages().
+		for func in self.package_phases:
 			print('')
-			msg('calling {} function for package {} version {}'.format(func, package_name, package_version), 6)
+			msg('calling {} function for package {} version {}'.format(func, package_label, package_version), 6)
 			try:
 				m = getattr(package_builder, func)
 			except AttributeError:
 				error('package builder has no {} function'.format(func))
-				exit(-1)
-			if not m(self, package_version):
-				error('function {} failed'.format(func))
-				exit(-1)
+				return False
+			with self.metrics.phase(package_label, package_version, func) as phase_metrics:
+				if (func == 'build') and self.ccache_dir:
+					ccache_statslog = self.get_ccache_statslog(package_label)
+					mkdir_p(os.path.dirname(ccache_statslog))
+					if os.path.exists(ccache_statslog):
+						os.unlink(ccache_statslog)
+				try:
+					if not m(self, package_version):
+						error('function {} failed for package {} version {}'.format(func, package_label, package_version))
+						return False
+					phase_metrics['success'] = True
+				finally:
+					if (func == 'build') and self.ccache_dir:
+						phase_metrics['ccache'] = read_ccache_statslog(ccache_statslog)
+						msg('ccache: {} hits, {} misses'.format(phase_metrics['ccache']['hits'], phase_metrics['ccache']['misses']))
+			self.finish_phase(package_name, package_version, func, phase_metrics)
+
+		self.install_manifests.finish_package(package_name, package_version)
+
+		# The fingerprint of the last build step covers all previous steps,
+		# so it serves as the fingerprint of the package as a whole.
+		fingerprint = package_builder.stamp_fingerprint
+		self.package_fingerprints[package_name] = fingerprint
+		write_stamp(os.path.join(self.get_stamps_dir(), package_name + '.fingerprint'), fingerprint)
+		with self.progress_lock:
+			self.finished_packages.add(package_name)
+		return True
+
+	def predict_build(self, packages, dependencies):
+		# Predicts the duration of the phases of all packages from the build
+		# history, and prints the predicted total time, the critical path
+		# through the dependency graph, and the resulting wall time of the
+		# run. Packages without history are left out of the estimates.
+		self.build_dependencies = dependencies
+		unknown_packages = []
+		for package_name, package_version in packages:
+			package_prediction = 0.0
+			for phase in self.package_phases:
+				predicted, basis = self.history.predict(self.get_package_label(package_name), package_version, phase, self.num_jobs)
+				self.predictions[(package_name, phase)] = (predicted, basis)
+				if predicted is None:
+					package_prediction = None
+				elif package_prediction is not None:
+					package_prediction += predicted
+			self.package_predictions[package_name] = package_prediction
+			if package_prediction is None:
+				unknown_packages += [self.get_package_label(package_name)]
+			else:
+				msg('predicted time for package {} version {}: {} (build phase based on {})'.format(self.get_package_label(package_name), package_version, format_duration(package_prediction), self.predictions[(package_name, 'build')][1]))
+		if len(unknown_packages) < len(packages):
+			durations = dict([(package_name, prediction or 0.0) for package_name, prediction in self.package_predictions.items()])
+			critical_time, critical_path = get_critical_path(set(durations), dependencies, durations)
+			msg('predicted build time: {} in total, critical path {} ({}), estimated wall time with -P {}: {}'.format(format_duration(sum(durations.values())), format_duration(critical_time), ' -> '.join(critical_path), self.package_jobs, format_duration(self.estimate_remaining_time())), 6)
+		if unknown_packages:
+			msg('no build history for: {} - not included in the prediction'.format(', '.join(unknown_packages)))
+
+	def estimate_remaining_time(self):
+		# The remaining time is at least the critical path through the
+		# packages which are not finished yet, and at least their remaining
+		# work divided by the number of packages that are built at the same
+		# time. (This does not account for packages slowing each other down
+		# by sharing the -j limit.)
+		now = time.monotonic()
+		remaining = {}
+		with self.progress_lock:
+			for package_name, prediction in self.package_predictions.items():
+				if package_name in self.finished_packages:
+					continue
+				start_time = self.package_start_times.get(package_name)
+				if start_time is None:
+					remaining[package_name] = prediction or 0.0
+				else:
+					remaining[package_name] = max(0.0, (prediction or 0.0) - (now - start_time))
+		critical_time, critical_path = get_critical_path(set(remaining), self.build_dependencies, remaining)
+		return max(critical_time, sum(remaining.values()) / self.package_jobs)
+
+	def finish_phase(self, package_name, package_version, phase, phase_metrics):
+		# Records a successful phase in the build history, flags it if it
+		# was significantly slower than predicted, and prints the ETA.
+		if not self.history:
+			return
+		wall_time = phase_metrics['wall_time']
+		predicted, basis = self.predictions.get((package_name, phase), (None, None))
+		if predicted is not None:
+			phase_metrics['predicted_wall_time'] = predicted
+			phase_metrics['slower_than_history'] = self.history.is_slowdown(wall_time, predicted)
+			if phase_metrics['slower_than_history']:
+				slow_phase = '{} phase of package {} version {} took {}, {:.1f} times as long as predicted from {}'.format(phase, self.get_package_label(package_name), package_version, format_duration(wall_time), wall_time / predicted, basis)
+				with self.progress_lock:
+					self.slow_phases += [slow_phase]
+				msg('SLOWER THAN HISTORY: ' + slow_phase, 6)
+		if phase_metrics['success'] and (not phase_metrics['skipped_steps']) and (not self.incremental):
+			self.history.record(self.get_package_label(package_name), package_version, phase, self.num_jobs, self.metrics.get_phase_totals(phase_metrics))
+		if any([prediction is not None for prediction in self.package_predictions.values()]):
+			msg('ETA: {}'.format(format_duration(self.estimate_remaining_time())))
+
+	def get_build_dependencies(self, packages):
+		# Returns a dict which maps each package name to the set of package names
+		# it has to wait for. Only dependencies which are part of this build run are
+		# considered; anything else is expected to be installed already.
+		package_names = [pkg[0] for pkg in packages]
+		dependencies = {}
+		for package_name in package_names:
+			package_builder = self.package_builders[package_name]
+			dependencies[package_name] = set([dep for dep in package_builder.dependencies if (dep in package_names) and (dep != package_name)])
+		return dependencies
+
+	def find_dependency_cycle(self, dependencies):
+		# Depth-first search over the dependency graph. Returns a list of
+		# package names that form a cycle, or None if the graph is acyclic.
+		visited = set()
+		path = []
+		def visit(package_name):
+			if package_name in path:
+				return path[path.index(package_name):] + [package_name]
+			if package_name in visited:
+				return None
+			visited.add(package_name)
+			path.append(package_name)
+			for dep in sorted(dependencies[package_name]):
+				cycle = visit(dep)
+				if cycle:
+					return cycle
+			path.pop()
+			return None
+		for package_name in dependencies:
+			cycle = visit(package_name)
+			if cycle:
+				return cycle
+		return None
+
+	def build_packages(self, packages):
+		# Builds the packages according to their dependency graph. A package is
+		# started as soon as all of its dependencies are installed, and up to
+		# package_jobs packages are built at the same time. Among the packages
+		# that are ready, the command line order decides which one starts first.
+		dependencies = self.get_build_dependencies(packages)
+		cycle = self.find_dependency_cycle(dependencies)
+		if cycle:
+			error('dependency cycle between packages: {}'.format(' -> '.join(cycle)))
+			return False
+
+		if self.history:
+			self.predict_build(packages, dependencies)
+
+		package_versions = dict(packages)
+		success = run_dependency_graph([pkg[0] for pkg in packages], dependencies, lambda package_name: self.build_package(package_name, package_versions[package_name]), self.package_jobs)
+		if self.slow_phases:
+			print('')
+			msg('phases that were significantly slower than their history:', 6)
+			for slow_phase in self.slow_phases:
+				msg(slow_phase)
+		return success
 
 
 
 class Builder(object):
+	# Names of other entries in ctx.package_builders which have to be
+	# installed before this package can be built. Subclasses override this.
+	dependencies = []
+	# Maps download origins to lists of mirrors with the same layout
+	# (see MirrorSelector). Subclasses override this.
+	source_mirrors = {}
+
 	def __init__(self, ctx):
 		self.ctx = ctx
+		self.package_name = None
+		self.package_version = None
+		self.stamp_fingerprint = ''
+		self.step_chains = threading.local()
+
+	def copy_for_context(self, ctx):
+		# Returns a builder with the same settings, for building in another
+		# context (see Context.create_variant_context()). The state of the
+		# build steps is not shared.
+		package_builder = copy.copy(self)
+		Builder.__init__(package_builder, ctx)
+		return package_builder
+
+	def begin_build_steps(self, package_name, package_version, fingerprint):
+		self.package_name = package_name
+		self.package_version = package_version
+		self.stamp_fingerprint = fingerprint
+
+	@contextlib.contextmanager
+	def separate_step_chain(self, fingerprint):
+		# Build steps that are run in this scope (by the current thread) form
+		# a separate chain of fingerprints that starts with the given one,
+		# instead of continuing the chain of the package. This is necessary
+		# for sub-packages that are built concurrently, since the order of
+		# their steps is not fixed. Yields a dict whose 'fingerprint' entry is
+		# the fingerprint of the last step of the chain.
+		chain = {'fingerprint': fingerprint}
+		previous = getattr(self.step_chains, 'chain', None)
+		self.step_chains.chain = chain
+		try:
+			yield chain
+		finally:
+			self.step_chains.chain = previous
+
+	def run_subpackage_graph(self, subpackages, dependencies, func):
+		# Calls func for every sub-package as soon as the sub-packages it
+		# depends on are done (see run_dependency_graph()). Every sub-package
+		# is built with a separate chain of step fingerprints, which starts
+		# with the fingerprints of the sub-packages it depends on. The first
+		# sub-package that runs uses the job of the package itself; each
+		# additional one that runs at the same time takes a job from the
+		# jobserver, so the -j limit is kept. Without a jobserver, the
+		# sub-packages are built one after the other.
+		base_fingerprint = self.stamp_fingerprint
+		fingerprints = {}
+		package_job = threading.Lock()
+
+		def run(subpackage):
+			fingerprint = compute_fingerprint([base_fingerprint, subpackage] + [fingerprints[dep] for dep in sorted(dependencies[subpackage])])
+			if package_job.acquire(blocking = False):
+				token = None
+			else:
+				token = self.ctx.jobserver.acquire()
+			try:
+				with self.separate_step_chain(fingerprint) as chain:
+					success = func(subpackage)
+			finally:
+				if token is None:
+					package_job.release()
+				else:
+					self.ctx.jobserver.release(token)
+			fingerprints[subpackage] = chain['fingerprint']
+			return success
+
+		max_workers = self.ctx.num_jobs if self.ctx.jobserver else 1
+		if not run_dependency_graph(subpackages, dependencies, run, max_workers):
+			return False
+		self.stamp_fingerprint = compute_fingerprint([base_fingerprint] + [fingerprints[subpackage] for subpackage in subpackages])
+		return True
+
+	def get_source_fingerprint(self, staging):
+		# Identifies the source tree in the staging directory: the archive it
+		# was unpacked from (see unpack_package()) and, for git repositories,
+		# the checked out commit plus any local modifications. Other trees are
+		# checked for local modifications with get_tree_fingerprint().
+		if not os.path.exists(staging):
+			return ''
+		items = [read_stamp(self.get_source_record(staging)) or '']
+		if os.path.exists(os.path.join(staging, '.git')):
+			try:
+				items += [subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd = staging, stderr = subprocess.DEVNULL)]
+				items += [subprocess.check_output(['git', 'diff', 'HEAD', '--binary', '--no-ext-diff'], cwd = staging, stderr = subprocess.DEVNULL)]
+			except (subprocess.CalledProcessError, OSError):
+				items += ['no-git-info']
+		else:
+			items += [self.get_tree_fingerprint(staging)]
+		return compute_fingerprint(items)
+
+	def get_tree_fingerprint(self, staging):
+		# Covers the names, sizes and modification times of all files in the
+		# source tree, without reading them. The build directories of all
+		# variants (see get_build_dir()) and the autogen.sh stamp are not
+		# part of it, since they change with every build.
+		excluded_dirs = set()
+		for build_subdir in self.build_subdirs:
+			excluded_dirs.add(build_subdir)
+			excluded_dirs.update(['{}-{}'.format(build_subdir, variant) for variant in build_variants])
+		items = []
+		for dirpath, dirnames, filenames in os.walk(staging):
+			if dirpath == staging:
+				dirnames[:] = [dirname for dirname in dirnames if dirname not in excluded_dirs]
+				filenames = [filename for filename in filenames if filename != '.autogen-stamp']
+			dirnames.sort()
+			for filename in sorted(filenames):
+				path = os.path.join(dirpath, filename)
+				try:
+					st = os.lstat(path)
+				except OSError:
+					continue
+				items += [os.path.relpath(path, staging), st.st_size, st.st_mtime_ns]
+		return compute_fingerprint(items)
+
+	def get_source_record(self, staging):
+		# Records are kept in the staging directory, so they
+		# vanish together with the unpacked source trees.
+		name = os.path.relpath(staging, self.ctx.staging_dir).replace(os.sep, '%')
+		return os.path.join(self.ctx.staging_dir, '.sources', name)
+
+	def run_step(self, subpackage, phase, inputs, staging, func):
+		# Runs one build step (func) of a (sub-)package, unless it was already
+		# done successfully with the same fingerprint. The fingerprint covers
+		# the given inputs (configuration options etc.), the source tree, and
+		# the fingerprint of the previous step, so everything after a changed
+		# step is redone as well. The stamp gets the fingerprint of the source
+		# tree as it is after the step, since steps like autogen.sh add files
+		# to the tree.
+		chain = getattr(self.step_chains, 'chain', None)
+		previous_fingerprint = chain['fingerprint'] if chain else self.stamp_fingerprint
+		get_fingerprint = lambda: compute_fingerprint([previous_fingerprint, subpackage, phase, self.get_source_fingerprint(staging)] + inputs)
+		fingerprint = get_fingerprint()
+		if self.package_name is None:
+			with subpackage_metrics_scope(subpackage):
+				return func()
+		stamp = os.path.join(self.ctx.get_stamps_dir(), self.package_name, '{}.{}'.format(subpackage, phase))
+		if (not self.ctx.ignore_stamps) and (read_stamp(stamp) == fingerprint):
+			msg('{} {}: unchanged since the last run - skipped'.format(subpackage, phase))
+			record_skipped_step('{} {}'.format(subpackage, phase))
+			self.advance_step_chain(chain, fingerprint)
+			return True
+		if os.path.exists(stamp):
+			os.unlink(stamp)
+		with subpackage_metrics_scope(subpackage):
+			if not func():
+				return False
+		fingerprint = get_fingerprint()
+		write_stamp(stamp, fingerprint)
+		self.advance_step_chain(chain, fingerprint)
+		return True
+
+	def advance_step_chain(self, chain, fingerprint):
+		if chain:
+			chain['fingerprint'] = fingerprint
+		else:
+			self.stamp_fingerprint = fingerprint
 
 	def get_staging_dir(self, basename, staging_subdir):
 		if staging_subdir:
-			return os.path.join(ctx.staging_dir, staging_subdir, basename)
+			return os.path.join(self.ctx.staging_dir, staging_subdir, basename)
+		else:
+			return os.path.join(self.ctx.staging_dir, basename)
+
+	# The build directories (build_subdir in get_build_dir()) that the
+	# builders use inside the source trees.
+	build_subdirs = ['_build', 'build', 'aom_build']
+
+	def get_build_dir(self, staging, build_subdir):
+		# Every variant is built in a build directory of its own inside the
+		# source tree, so the variants can share the source tree.
+		if self.ctx.variant:
+			return os.path.join(staging, '{}-{}'.format(build_subdir, self.ctx.variant))
 		else:
-			return os.path.join(ctx.staging_dir, basename)
+			return os.path.join(staging, build_subdir)
+
+	def get_source_lock(self, staging):
+		# Lock file for changes to a source tree (unpacking it, generating
+		# its configure script etc.), which may be shared by several builds.
+		return staging + '.lock'
+
+	def staged_install(self, subpackage, install):
+		# Calls install with a fresh staging directory, which it has to pass
+		# to the build system as DESTDIR (or the equivalent), and merges the
+		# installed files into the installation directory (see
+		# InstallManifests).
+		destdir_root = os.path.join(self.ctx.staging_dir, '.destdir')
+		mkdir_p(destdir_root)
+		destdir = tempfile.mkdtemp(prefix = subpackage + '-', dir = destdir_root)
+		try:
+			if not install(destdir):
+				return False
+			return self.ctx.install_manifests.merge(self.package_name or subpackage, self.package_version, subpackage, destdir)
+		finally:
+			shutil.rmtree(destdir, ignore_errors = True)
 
 	def fetch_package_file(self, filename, dest, dest_hash, link, link_hash):
 		if os.path.exists(dest):
 			msg('{} present - downloading skipped'.format(filename))
+		elif self.fetch_from_download_cache(filename, dest, dest_hash, link_hash):
+			msg('{} not present - taken from the download cache'.format(filename))
 		else:
-			msg('{} not present - downloading from {}'.format(filename, link))
-			wget_cmdline = 'wget -c -nc "{}" -O "{}"'
-			if 0 != subprocess.call(wget_cmdline.format(link, dest), shell = True):
-				return False
-			if (dest_hash != None) and (link_hash != None):
-				if 0 != subprocess.call(wget_cmdline.format(link_hash, dest_hash), shell = True):
+			with self.ctx.fetch_semaphore:
+				links = self.ctx.mirrors.get_links(link, link_hash) if self.ctx.mirrors else [(link, link_hash)]
+				for mirror_link, mirror_link_hash in links:
+					msg('{} not present - downloading from {}'.format(filename, mirror_link))
+					# With more mirrors left, a mirror that fails or stalls is
+					# given up on early instead of retrying it for a long time.
+					is_last = (mirror_link == links[-1][0])
+					digests = self.download_package_file(filename, dest, dest_hash, mirror_link, mirror_link_hash, None if is_last else 1)
+					if digests is not None:
+						break
+					if not is_last:
+						msg('downloading {} from {} failed - trying the next mirror'.format(filename, mirror_link))
+						self.ctx.mirrors.report_failure(mirror_link)
+				if digests is None:
 					return False
+			self.add_to_download_cache(filename, dest, digests['sha256'], dest_hash, link_hash)
 		return True
 
-	def check_package(self, name, basename, hashcall, dest_hash, staging_subdir = ''):
-		olddir = os.getcwd()
-		os.chdir(self.ctx.dl_dir)
-		retval = subprocess.call('{} -c "{}" --quiet >/dev/null 2>&1'.format(hashcall, dest_hash), shell = True)
-		os.chdir(olddir)
+	def download_package_file(self, filename, dest, dest_hash, link, link_hash, max_retries):
+		if self.ctx.stream_unpack and (get_tar_decompression_option(filename) is not None):
+			digests = self.stream_package_file(filename, dest, dest_hash, link, link_hash)
+			if digests is None:
+				return None
+			self.ctx.add_known_digests(dest, digests)
+		else:
+			digests = download_file(link, dest, segments = self.ctx.download_segments, max_retries = max_retries)
+			if digests is None:
+				return None
+			self.ctx.add_known_digests(dest, digests)
+			if (dest_hash != None) and (link_hash != None):
+				if download_file(link_hash, dest_hash, []) is None:
+					return None
+		return digests
+
+	def stream_package_file(self, filename, dest, dest_hash, link, link_hash):
+		# Downloads an archive and unpacks it into a temporary directory at the
+		# same time, instead of reading it again after the download finished.
+		# The checksum file is downloaded first, so that the unpacked tree can
+		# be discarded right away if the digest of the archive does not match.
+		# Otherwise, it is picked up by unpack_package() later. The archive
+		# itself is stored in the download directory as usual.
+		expected_digest = None
+		if (dest_hash != None) and (link_hash != None):
+			if download_file(link_hash, dest_hash, []) is None:
+				return None
+			for entry in read_checksum_file(dest_hash):
+				if os.path.basename(entry[1]) == filename:
+					expected_digest = entry[0]
+
+		streamed_dir = os.path.join(self.ctx.staging_dir, '.streamed')
+		mkdir_p(streamed_dir)
+		unpack_dir = tempfile.mkdtemp(prefix = filename + '-', dir = streamed_dir)
+		unpacker = StreamingUnpacker(filename, unpack_dir)
+		digests = download_file(link, dest, stream_consumer = unpacker.feed)
+		unpacked = unpacker.finish()
+
+		if digests is None:
+			shutil.rmtree(unpack_dir)
+			return None
+		if not unpacked:
+			msg('{} could not be unpacked while downloading - it will be unpacked later'.format(filename))
+			shutil.rmtree(unpack_dir)
+		elif (expected_digest is not None) and (expected_digest not in digests.values()):
+			msg('{} does not match its checksum - discarding the unpacked tree'.format(filename))
+			shutil.rmtree(unpack_dir)
+		else:
+			self.ctx.streamed_unpacks[dest] = unpack_dir
+		return digests
+
+	def fetch_from_download_cache(self, filename, dest, dest_hash, link_hash):
+		cache = self.ctx.download_cache
+		if not cache:
+			return False
+		# The checksum file is cached together with the archive (and not under
+		# its own name, which is often something generic like "SHA1SUMS"), so
+		# a cached archive always comes with a checksum file that covers it.
+		if (dest_hash != None) and (link_hash != None):
+			if cache.get(filename + '.checksums', dest_hash) is None:
+				return False
+		digest = cache.get(filename, dest)
+		if digest is None:
+			return False
+		# The object's name is the digest of its content, so there is no
+		# need to hash the archive again when it is checked.
+		self.ctx.add_known_digests(dest, {'sha256': digest})
+		return True
 
-		if 0 == retval:
+	def add_to_download_cache(self, filename, dest, dest_digest, dest_hash, link_hash):
+		cache = self.ctx.download_cache
+		if not cache:
+			return
+		if (dest_hash != None) and (link_hash != None):
+			cache.put(filename + '.checksums', dest_hash, hashfile(dest_hash, 'sha256'))
+		cache.put(filename, dest, dest_digest)
+
+	def check_package(self, name, basename, hashcall, dest_hash, staging_subdir = ''):
+		# Verifies all files listed in the checksum file. The actual hashing is
+		# done on the context's verification thread pool (unless the digest was
+		# already computed during the download).
+		hashfuncname = hashcall_funcs[hashcall]
+		try:
+			entries = read_checksum_file(dest_hash)
+		except (IOError, OSError) as e:
+			error('could not read checksum file {}: {}'.format(dest_hash, e))
+			entries = []
+		futures = [self.ctx.verify_executor.submit(self.ctx.verify_file, os.path.join(self.ctx.dl_dir, entry[1]), hashfuncname, entry[0]) for entry in entries]
+		results = [future.result() for future in futures]
+
+		if entries and all(results):
 			msg('{} checksum : OK'.format(name))
 		else:
 			msg('{} checksum : FAILED'.format(name))
@@ -130,99 +2721,307 @@ class Builder(object):
 
 	def clone_git_repo(self, link, basename, checkout = None, staging_subdir = ''):
 		staging = self.get_staging_dir(basename, staging_subdir)
+		if self.ctx.git_mirrors:
+			with self.ctx.fetch_semaphore:
+				return self.ctx.git_mirrors.checkout(link, staging, checkout)
 		if os.path.exists(staging):
 			msg('Directory {} present - not cloning anything'.format(staging))
 		else:
-			msg('Directory {} not present - cloning from {}'.format(staging, link))
-			if checkout:
-				if 0 != subprocess.call('git clone -b "{}" "{}" "{}"'.format(checkout, link, staging), shell = True):
-					return False
-			else:
-				if 0 != subprocess.call('git clone "{}" "{}"'.format(link, staging), shell = True):
-					return False
+			with self.ctx.fetch_semaphore:
+				msg('Directory {} not present - cloning from {}'.format(staging, link))
+				clone_options = self.ctx.get_git_clone_options()
+				if checkout:
+					if 0 != call_process(['git', 'clone'] + clone_options + ['-b', checkout, link, staging]):
+						return False
+				else:
+					if 0 != call_process(['git', 'clone'] + clone_options + [link, staging]):
+						return False
 		return True
 
 	def init_git_submodules(self, basename, staging_subdir = ''):
 		staging = self.get_staging_dir(basename, staging_subdir)
-		olddir = os.getcwd()
-		os.chdir(staging)
+		# Submodules are fetched concurrently, and use the same clone
+		# strategy as the repository they are part of.
+		update_options = ['--init', '--recursive', '--jobs', str(self.ctx.fetch_jobs)]
+		if self.ctx.git_clone_strategy == 'shallow':
+			update_options += ['--depth', '1']
+		elif self.ctx.git_clone_strategy == 'blobless':
+			update_options += ['--filter=blob:none']
 		success = True
-		success = success and (0 == ctx.call_with_env('git submodule init ; git submodule sync ; git submodule update'))
-		os.chdir(olddir)
+		success = success and (0 == self.ctx.call_with_env(['git', 'submodule', 'sync', '--recursive'], cwd = staging))
+		success = success and (0 == self.ctx.call_with_env(['git', 'submodule', 'update'] + update_options, cwd = staging))
 		return success
 
 	def unpack_package(self, basename, dest, staging_subdir = ''):
 		staging = self.get_staging_dir(basename, staging_subdir)
+		mkdir_p(os.path.dirname(staging))
+		# Builds of other variants may want to unpack the same tree.
+		with locked_file(self.get_source_lock(staging)):
+			return self.unpack_package_locked(basename, dest, staging, staging_subdir)
+
+	def unpack_package_locked(self, basename, dest, staging, staging_subdir):
 		if os.path.exists(staging):
 			msg('Directory {} present - unpacking skipped'.format(staging))
+			record_skipped_step('{} unpack'.format(basename))
 		else:
 			msg('Directory {} not present - unpacking'.format(staging))
 			unpack_rootdir = self.get_staging_dir('', staging_subdir)
 			mkdir_p(unpack_rootdir)
-			if 0 != subprocess.call('tar xf "{}" -C "{}"'.format(dest, unpack_rootdir), shell = True):
-				return False
-
+			# The archive is unpacked into a temporary directory next to the
+			# staging directory, and moved into place once it is complete,
+			# so an interrupted unpack never leaves a partial tree behind.
+			# Leftovers of interrupted unpacks are removed first.
+			unpack_prefix = '.unpack-{}-'.format(basename)
+			for entry in os.listdir(unpack_rootdir):
+				if entry.startswith(unpack_prefix):
+					shutil.rmtree(os.path.join(unpack_rootdir, entry))
+			unpack_dir = tempfile.mkdtemp(prefix = unpack_prefix, dir = unpack_rootdir)
+			def extract():
+				if self.move_streamed_unpack(dest, unpack_dir):
+					return True
+				elif self.ctx.source_store:
+					return self.ctx.source_store.materialize(dest, self.ctx.get_file_digest(dest, 'sha256'), unpack_dir)
+				else:
+					return 0 == call_process(['tar', 'xf', dest, '-C', unpack_dir])
+			# With --local-git, the git repository is created from the archive
+			# while the archive is being unpacked (see import_archive_into_git()).
+			# It is put into place once both are done.
+			git_dir = os.path.join(unpack_dir, '.git-import')
 			if self.ctx.local_git:
 				msg('Creating local git repository')
-				local_git_repo_dir = os.path.join(staging, '.git')
-				if not os.path.exists(local_git_repo_dir):
-					olddir = os.getcwd()
-					os.chdir(staging)
-					success = True
-					success = success and (0 == subprocess.call('git init', shell = True))
-					success = success and (0 == subprocess.call('git add .', shell = True))
-					success = success and (0 == subprocess.call('git commit -asm "Initial commit"', shell = True))
-					os.chdir(olddir)
-					if not success:
-						return False
+				success = run_concurrently([extract, lambda: import_archive_into_git(dest, git_dir, basename)])
+			else:
+				success = extract()
+			if success and self.ctx.local_git:
+				success = self.move_imported_git_dir(git_dir, os.path.join(unpack_dir, basename))
+			if not success:
+				shutil.rmtree(unpack_dir)
+				return False
+			# Usually, the archive contains nothing but the staging directory.
+			# If there is anything else, it is moved first (unless it exists
+			# already), so that the staging directory only appears once
+			# everything is in place.
+			entries = sorted(os.listdir(unpack_dir), key = lambda entry: entry == basename)
+			for entry in entries:
+				entry_dest = os.path.join(unpack_rootdir, entry)
+				if not os.path.lexists(entry_dest):
+					os.rename(os.path.join(unpack_dir, entry), entry_dest)
+			shutil.rmtree(unpack_dir)
+			# The record identifies the archive by its digest. The random part
+			# makes sure that a tree that was unpacked anew is always seen as
+			# a different tree (inode numbers get reused too quickly for that).
+			write_stamp(self.get_source_record(staging), '{} {} {}'.format(os.path.basename(dest), self.ctx.get_file_digest(dest, 'sha256'), uuid.uuid4().hex))
 		return True
 
-	def do_config_make_build(self, basename, use_autogen, extra_config = '', extra_cflags = '', extra_cxxflags = '', staging_subdir = '', noconfigure = True, use_noconfig_env = False):
-		staging = self.get_staging_dir(basename, staging_subdir)
-		olddir = os.getcwd()
-		os.chdir(staging)
+	def move_imported_git_dir(self, git_dir, tree):
+		# Turns the repository that was created by import_archive_into_git()
+		# into the repository of the unpacked tree, unless the archive comes
+		# with a repository of its own. The index is read from the commit
+		# without looking at the files; git refreshes it the first time it
+		# compares the index with the tree (for example in "git status").
+		local_git_repo_dir = os.path.join(tree, '.git')
+		if os.path.exists(local_git_repo_dir):
+			shutil.rmtree(git_dir)
+			return True
+		os.rename(git_dir, local_git_repo_dir)
 		success = True
-		if use_autogen:
-			if noconfigure:
-				if use_noconfig_env:
-					success = success and (0 == ctx.call_with_env('NOCONFIGURE=1 ./autogen.sh'))
+		success = success and (0 == call_process(['git', 'config', 'core.bare', 'false'], cwd = tree))
+		success = success and (0 == call_process(['git', 'read-tree', 'HEAD'], cwd = tree))
+		return success
+
+	def is_autotools_tree_configured(self, staging, builddir, config_cmdline):
+		# A build directory counts as configured if it was configured with the
+		# same options, and config.status is newer than the configure script
+		# and the files that the configure script is generated from.
+		if read_stamp(os.path.join(builddir, 'config-cmdline.log')) != config_cmdline:
+			return False
+		config_status = os.path.join(builddir, 'config.status')
+		if not os.path.exists(config_status):
+			return False
+		config_status_mtime = os.path.getmtime(config_status)
+		for config_input in ['configure', 'configure.ac', 'configure.in', 'autogen.sh']:
+			config_input = os.path.join(staging, config_input)
+			if os.path.exists(config_input) and (os.path.getmtime(config_input) > config_status_mtime):
+				return False
+		return True
+
+	def clean_in_tree_build(self, staging, markers):
+		# Out-of-tree builds are refused for source trees that were configured
+		# in the tree itself (by earlier versions of this script, or by an
+		# autogen.sh that runs configure). The markers are the files that such
+		# a configuration leaves behind. Must be called with the source lock
+		# of the tree held (see get_source_lock()).
+		if not any([os.path.exists(os.path.join(staging, marker)) for marker in markers]):
+			return True
+		msg('{} was configured in-tree - cleaning it for out-of-tree builds'.format(staging))
+		if 0 != self.ctx.call_with_env(['make', 'distclean'], cwd = staging):
+			error('could not clean {}; run "make distclean" there'.format(staging))
+			return False
+		return True
+
+	def prepare_autotools_tree(self, staging, autogen_args, autogen_env):
+		# Generates the configure script of a source tree with autogen.sh
+		# (unless autogen_args is None), and cleans the tree if it was
+		# configured in-tree. All variants share the tree, so autogen.sh is
+		# only run if the tree changed since it was last run; running it again
+		# could replace the configure script while another variant is running
+		# it.
+		with locked_file(self.get_source_lock(staging)):
+			if autogen_args is not None:
+				autogen_stamp = os.path.join(staging, '.autogen-stamp')
+				fingerprint = compute_fingerprint([self.get_source_fingerprint(staging), format_command(autogen_args, autogen_env)])
+				if (read_stamp(autogen_stamp) == fingerprint) and os.path.exists(os.path.join(staging, 'configure')):
+					msg('configure script of {} is up to date - autogen.sh skipped'.format(staging))
 				else:
-					success = success and (0 == ctx.call_with_env('./autogen.sh --noconfigure'))
-			else:
-				success = success and (0 == ctx.call_with_env('./autogen.sh --prefix="{}" {}'.format(ctx.inst_dir, extra_config), 'export CFLAGS="$CFLAGS {}" ; export CXXFLAGS="$CXXFLAGS {}" '.format(extra_cxxflags, extra_cxxflags)))
-		if (not use_autogen) or (use_autogen and noconfigure):
-				success = success and (0 == ctx.call_with_env('./configure --prefix="{}" {}'.format(ctx.inst_dir, extra_config), 'export CFLAGS="$CFLAGS {}" ; export CXXFLAGS="$CXXFLAGS {}" '.format(extra_cxxflags, extra_cxxflags)))
+					if os.path.exists(autogen_stamp):
+						os.unlink(autogen_stamp)
+					if 0 != self.ctx.call_with_env(autogen_args, autogen_env, cwd = staging):
+						return False
+					fingerprint = compute_fingerprint([self.get_source_fingerprint(staging), format_command(autogen_args, autogen_env)])
+					write_stamp(autogen_stamp, fingerprint)
+			return self.clean_in_tree_build(staging, ['config.status'])
+
+	def move_streamed_unpack(self, dest, target_dir):
+		# Moves the contents of the tree that was unpacked while downloading
+		# dest (if any) to target_dir, which must be empty. Returns False if
+		# there is no such tree.
+		unpack_dir = self.ctx.streamed_unpacks.pop(dest, None)
+		if not unpack_dir:
+			return False
+		msg('Using the tree that was unpacked while downloading {}'.format(os.path.basename(dest)))
+		for entry in os.listdir(unpack_dir):
+			os.rename(os.path.join(unpack_dir, entry), os.path.join(target_dir, entry))
+		os.rmdir(unpack_dir)
+		return True
 
-		success = success and (0 == ctx.call_with_env('make "-j{}"'.format(ctx.num_jobs)))
-		os.chdir(olddir)
-		return success
+	def do_config_make_build(self, basename, use_autogen, extra_config = '', extra_cflags = '', extra_cxxflags = '', staging_subdir = '', noconfigure = True, use_noconfig_env = False, use_configure_cache = True):
+		# The source tree is configured and built out of tree (in _build, or
+		# _build-<variant>), so the variants can be built from the same tree.
+		staging = self.get_staging_dir(basename, staging_subdir)
+		builddir = self.get_build_dir(staging, '_build')
+		inputs = [self.ctx.inst_dir, use_autogen, extra_config, extra_cflags, extra_cxxflags, noconfigure, use_noconfig_env, builddir]
+		# The compiler launcher is not part of the step inputs, since it does
+		# not affect the build results. The tree has to be configured again
+		# if it changes though, since configure stores the compilers.
+		config_env = dict(self.ctx.get_compiler_launcher_env(), CFLAGS = '$CFLAGS ' + extra_cflags, CXXFLAGS = '$CXXFLAGS ' + extra_cxxflags)
+		config_cmdline = ' '.join([str(x) for x in inputs] + [format_command([], config_env)])
+		# extra_config is split into arguments like a shell command line.
+		config_args = ['--prefix=' + self.ctx.inst_dir] + shlex.split(extra_config)
+
+		# Without noconfigure, autogen.sh runs configure in the source tree
+		# itself; prepare_autotools_tree() cleans that up again.
+		if not use_autogen:
+			autogen_args, autogen_env = None, None
+		elif not noconfigure:
+			autogen_args, autogen_env = ['./autogen.sh'], None
+		elif use_noconfig_env:
+			autogen_args, autogen_env = ['./autogen.sh'], {'NOCONFIGURE': '1'}
+		else:
+			autogen_args, autogen_env = ['./autogen.sh', '--noconfigure'], None
+
+		def configure():
+			mkdir_p(builddir)
+			configure_args = [os.path.join(staging, 'configure')] + config_args
+			# Only configure scripts generated by autoconf know --cache-file;
+			# hand-written ones (like the one of libvpx) reject it.
+			if not (self.ctx.use_configure_cache and use_configure_cache and is_autoconf_configure(configure_args[0])):
+				return 0 == self.ctx.call_with_env(configure_args, config_env, cwd = builddir)
+			# The results of the checks are shared with other packages (see
+			# ConfigureCache). If configure fails with them, it is run again
+			# without, in case a shared result does not fit this package.
+			# Since the script accepts --cache-file, a failure that goes away
+			# without the cache was caused by the shared results.
+			cache_file = os.path.join(builddir, 'shared-config.cache')
+			toolchain_fingerprint = self.ctx.get_toolchain_fingerprint()
+			installation_fingerprint = self.ctx.configure_cache.checkout(toolchain_fingerprint, cache_file)
+			if 0 == self.ctx.call_with_env(configure_args + ['--cache-file=' + cache_file], config_env, cwd = builddir):
+				self.ctx.configure_cache.merge(toolchain_fingerprint, cache_file, installation_fingerprint)
+				return True
+			msg('configure failed with the shared configure cache - trying again without it')
+			os.unlink(cache_file)
+			if 0 != self.ctx.call_with_env(configure_args, config_env, cwd = builddir):
+				return False
+			msg('configure succeeded without the shared configure cache - discarding the cache')
+			self.ctx.configure_cache.discard(toolchain_fingerprint)
+			return True
+
+		def build():
+			success = self.prepare_autotools_tree(staging, autogen_args, autogen_env)
+			if success and self.ctx.incremental and self.is_autotools_tree_configured(staging, builddir, config_cmdline):
+				msg('{} is already configured with the same options - configuration skipped'.format(builddir))
+			elif success:
+				success = configure()
+				if success:
+					write_stamp(os.path.join(builddir, 'config-cmdline.log'), config_cmdline)
+			success = success and (0 == self.ctx.call_with_env(['make'] + self.ctx.make_jobs_arg(), cwd = builddir))
+			return success
+
+		return self.run_step(basename, 'build', inputs, staging, build)
 
 	def do_make_install(self, basename, parallel = True, staging_subdir = ''):
 		staging = self.get_staging_dir(basename, staging_subdir)
-		olddir = os.getcwd()
-		os.chdir(staging)
-		if parallel:
-			success = (0 == ctx.call_with_env('make "-j{}" install'.format(ctx.num_jobs)))
-		else:
-			success = (0 == ctx.call_with_env('make install'))
-		os.chdir(olddir)
-		return success
+		builddir = self.get_build_dir(staging, '_build')
+
+		def install(destdir):
+			if parallel:
+				return (0 == self.ctx.call_with_env(['make'] + self.ctx.make_jobs_arg() + ['install', 'DESTDIR=' + destdir], cwd = builddir))
+			else:
+				return (0 == self.ctx.call_with_env(['make', 'install', 'DESTDIR=' + destdir], cwd = builddir))
+
+		return self.run_step(basename, 'install', [self.ctx.inst_dir], staging, lambda: self.staged_install(basename, install))
 
 	def do_meson_ninja_build(self, basename, extra_config = '', extra_cflags = '', extra_cxxflags = '', staging_subdir = '', build_subdir = 'build'):
 		staging = self.get_staging_dir(basename, staging_subdir)
-		builddir = os.path.join(staging, build_subdir)
-		if os.path.exists(builddir):
-			msg('Build subdirectory "{}" already exits; deleting to do a rebuild from scratch'.format(builddir))
-			shutil.rmtree(builddir)
-		os.makedirs(builddir)
-		meson_setup_cmdline = 'CFLAGS="$CFLAGS {}" CXXFLAGS="$CXXFLAGS {}" meson setup --prefix "{}" --libdir lib {} {} {}'.format(extra_cflags, extra_cxxflags, ctx.inst_dir, extra_config, builddir, staging)
-		with open(os.path.join(builddir, 'config-cmdline.log'), 'w') as f:
-			f.write(meson_setup_cmdline + '\n')
-		success = True
-		success = success and (0 == ctx.call_with_env(meson_setup_cmdline))
-		success = success and (0 == ctx.call_with_env('meson compile -C "{}" "-j{}"'.format(builddir, ctx.num_jobs)))
-		success = success and (0 == ctx.call_with_env('meson install -C "{}"'.format(builddir)))
-		return success
+		builddir = self.get_build_dir(staging, build_subdir)
+		# extra_config is split into arguments like a shell command line.
+		meson_setup_args = ['meson', 'setup', '--prefix', self.ctx.inst_dir, '--libdir', 'lib'] + self.ctx.get_variant_options('meson') + shlex.split(extra_config) + [builddir, staging]
+		meson_setup_env = {'CFLAGS': '$CFLAGS ' + extra_cflags, 'CXXFLAGS': '$CXXFLAGS ' + extra_cxxflags}
+		# Like CFLAGS, the compilers are only evaluated when the build
+		# directory is set up, but they do not affect the step inputs.
+		inputs = [format_command(meson_setup_args, meson_setup_env)]
+		meson_setup_env = dict(self.ctx.get_compiler_launcher_env(), **meson_setup_env)
+		meson_setup_cmdline = format_command(meson_setup_args, meson_setup_env)
+
+		def get_setup_args():
+			# Returns the arguments for configuring the build directory,
+			# or None if the existing configuration can be used as it is.
+			cmdline_log = os.path.join(builddir, 'config-cmdline.log')
+			coredata = os.path.join(builddir, 'meson-private', 'coredata.dat')
+			if self.ctx.incremental and os.path.exists(coredata):
+				previous_cmdline = read_stamp(cmdline_log) or ''
+				if previous_cmdline == meson_setup_cmdline:
+					msg('Build subdirectory "{}" is already configured with the same options; reusing it'.format(builddir))
+					return None
+				# Meson only evaluates CFLAGS etc. when a build directory is set up
+				# for the first time, so --reconfigure can only be used if these
+				# (which are at the start of the command line) did not change.
+				if previous_cmdline.split(' meson setup ')[0] == meson_setup_cmdline.split(' meson setup ')[0]:
+					msg('Configuration of build subdirectory "{}" changed; reconfiguring it'.format(builddir))
+					return meson_setup_args[:2] + ['--reconfigure'] + meson_setup_args[2:]
+			if os.path.exists(builddir):
+				msg('Build subdirectory "{}" already exits; deleting to do a rebuild from scratch'.format(builddir))
+				shutil.rmtree(builddir)
+			os.makedirs(builddir)
+			return meson_setup_args
+
+		def build():
+			success = True
+			setup_args = get_setup_args()
+			if setup_args:
+				cmdline_log = os.path.join(builddir, 'config-cmdline.log')
+				with open(cmdline_log, 'w') as f:
+					f.write(meson_setup_cmdline + '\n')
+				success = (0 == self.ctx.call_with_env(setup_args, meson_setup_env))
+				if not success:
+					# Make sure the next incremental build does not
+					# consider the build directory as configured.
+					os.unlink(cmdline_log)
+			with self.ctx.job_slots(jobserver_aware = self.ctx.jobserver and self.ctx.jobserver.ninja_support) as jobs_arg:
+				success = success and (0 == self.ctx.call_with_env(['meson', 'compile', '-C', builddir] + jobs_arg))
+			success = success and self.staged_install(basename, lambda destdir: 0 == self.ctx.call_with_env(['meson', 'install', '-C', builddir], {'DESTDIR': destdir}))
+			return success
+
+		return self.run_step(basename, 'build', inputs, staging, build)
 
 
 
@@ -248,7 +3047,7 @@ class OpusBuilder(Builder):
 		if not self.fetch_package_file(archive_filename, archive_dest, archive_dest_checksum_tmp, archive_link, archive_link_sha1sum):
 			return False
 
-		subprocess.call('grep "{}" "{}" >"{}"'.format(archive_filename, archive_dest_checksum_tmp, archive_dest_checksum), shell = True)
+		extract_checksum_entries(archive_dest_checksum_tmp, archive_dest_checksum, archive_filename)
 		return True
 
 	def check(self, ctx, package_version):
@@ -296,9 +3095,28 @@ class GStreamer10Builder(Builder):
 		'gst-plugins-ugly': ['gpl=enabled'],
 		'gst-omx': ['target=bellagio']
 	}
+	# Sub-packages (of release tarball builds) which have to be installed
+	# before a sub-package can be built. Sub-packages that do not depend on
+	# each other are built concurrently.
+	pkg_dependencies = {
+		'gstreamer': [],
+		'gst-plugins-base': ['gstreamer'],
+		'gst-plugins-good': ['gst-plugins-base'],
+		'gst-plugins-bad': ['gst-plugins-base'],
+		'gst-plugins-ugly': ['gst-plugins-base'],
+		'gst-libav': ['gst-plugins-base'],
+		'gst-rtsp-server': ['gst-plugins-base'],
+		'gstreamer-vaapi': ['gst-plugins-bad'],
+		'gst-python': ['gst-plugins-base'],
+		'gst-omx': ['gst-plugins-base'],
+	}
+	dependencies = ['orc', 'glib', 'opus', 'vpx', 'daala', 'x265', 'aom', 'dav1d', 'openh264', 'ffmpeg', 'soup', 'bluez', 'tinycompress']
 
 	def __init__(self, ctx):
 		super(GStreamer10Builder, self).__init__(ctx)
+		# If set, Meson based release builds build all modules as subprojects
+		# of one generated project (see build_superproject()).
+		self.use_superproject = False
 
 	def desc(self):
 		return "GStreamer 1.0"
@@ -308,40 +3126,48 @@ class GStreamer10Builder(Builder):
 			if not self.clone_git_repo(GStreamer10Builder.git_source, basename = 'gstreamer', checkout = 'main', staging_subdir = 'gstreamer1.0'):
 				return False
 		else:
-			for pkg in GStreamer10Builder.pkgs:
-				basename = '{}-{}'.format(pkg, package_version)
-				msg('GStreamer 1.0: fetching ' + basename, 4)
-				archive_filename = basename + '.' + GStreamer10Builder.pkg_ext
-				archive_link = GStreamer10Builder.pkg_source + '/' + pkg + '/' + archive_filename
-				archive_dest = os.path.join(ctx.dl_dir, archive_filename)
-				if not self.fetch_package_file(archive_filename, archive_dest, archive_dest + ".sha256sum", archive_link, archive_link + ".sha256sum"):
-					return False
+			# Fetch all sub-packages at once; the overall number of
+			# concurrent downloads is limited by ctx.fetch_jobs.
+			funcs = [functools.partial(self.fetch_pkg, ctx, pkg, package_version) for pkg in GStreamer10Builder.pkgs]
+			if not run_concurrently(funcs):
+				return False
 		return True
 
+	def fetch_pkg(self, ctx, pkg, package_version):
+		basename = '{}-{}'.format(pkg, package_version)
+		msg('GStreamer 1.0: fetching ' + basename, 4)
+		archive_filename = basename + '.' + GStreamer10Builder.pkg_ext
+		archive_link = GStreamer10Builder.pkg_source + '/' + pkg + '/' + archive_filename
+		archive_dest = os.path.join(ctx.dl_dir, archive_filename)
+		return self.fetch_package_file(archive_filename, archive_dest, archive_dest + ".sha256sum", archive_link, archive_link + ".sha256sum")
+
 	def check(self, ctx, package_version):
 		if package_version == 'git':
 			return True
-		for pkg in GStreamer10Builder.pkgs:
-			basename = '{}-{}'.format(pkg, package_version)
-			msg('GStreamer 1.0: checking ' + basename, 4)
-			archive_filename = basename + '.' + GStreamer10Builder.pkg_ext
-			archive_link = GStreamer10Builder.pkg_source + '/' + pkg + '/' + archive_filename
-			archive_dest = os.path.join(ctx.dl_dir, archive_filename)
-			archive_dest_checksum = archive_dest + '.' + GStreamer10Builder.pkg_checksum
-
-			if not self.check_package(name = pkg, basename = basename, hashcall = 'sha256sum', dest_hash = archive_dest_checksum, staging_subdir = 'gstreamer1.0'):
-				return False
-		return True
+		# Check all sub-packages at once, so their archives are
+		# hashed in parallel on the verification thread pool.
+		funcs = [functools.partial(self.check_pkg, ctx, pkg, package_version) for pkg in GStreamer10Builder.pkgs]
+		return run_concurrently(funcs)
+
+	def check_pkg(self, ctx, pkg, package_version):
+		basename = '{}-{}'.format(pkg, package_version)
+		msg('GStreamer 1.0: checking ' + basename, 4)
+		archive_filename = basename + '.' + GStreamer10Builder.pkg_ext
+		archive_dest = os.path.join(ctx.dl_dir, archive_filename)
+		archive_dest_checksum = archive_dest + '.' + GStreamer10Builder.pkg_checksum
+		return self.check_package(name = pkg, basename = basename, hashcall = 'sha256sum', dest_hash = archive_dest_checksum, staging_subdir = 'gstreamer1.0')
 
 	def unpack(self, ctx, package_version):
 		if package_version != 'git':
-			for pkg in GStreamer10Builder.pkgs:
+			# The modules are unpacked (and imported into their local git
+			# repositories, see unpack_package()) concurrently.
+			def unpack_pkg(pkg):
 				basename = '{}-{}'.format(pkg, package_version)
 				msg('GStreamer 1.0: unpacking ' + basename, 4)
 				archive_filename = basename + '.' + GStreamer10Builder.pkg_ext
 				archive_dest = os.path.join(ctx.dl_dir, archive_filename)
-				if not self.unpack_package(basename, archive_dest, staging_subdir = 'gstreamer1.0'):
-					return False
+				return self.unpack_package(basename, archive_dest, staging_subdir = 'gstreamer1.0')
+			return run_concurrently([functools.partial(unpack_pkg, pkg) for pkg in GStreamer10Builder.pkgs], max(1, ctx.num_jobs))
 		return True
 
 	def build(self, ctx, package_version):
@@ -372,46 +3198,98 @@ class GStreamer10Builder(Builder):
 				return False
 		else:
 			gst_version = self.get_gst_version(package_version)
-			if (gst_version['major'] >= 1) and (gst_version['minor'] >= 16) and (gst_version['rev'] >= 0):
-				# Use Meson for building GStreamer versions >= 1.16.
-				for pkg in GStreamer10Builder.pkgs:
-					basename = '{}-{}'.format(pkg, package_version)
-					msg('GStreamer 1.0: building ' + basename, 4)
-
-					config_options = []
-					if gst_version['minor'] == 16:
-						# This option got removed from release tarballs starting with GStreamer 1.18.
-						# The git monorepo has it to support some subprojects that still use gtk-doc.
-						config_options += ['gtk_doc=disabled']
-
-					try:
-						extra_options = GStreamer10Builder.extra_config_options[pkg]
-						config_options += extra_options
-					except KeyError:
-						pass
+			if self.use_superproject and self.is_meson_version(gst_version):
+				return self.build_superproject(ctx, package_version, gst_version)
+			dependencies = dict([(pkg, set(deps)) for pkg, deps in GStreamer10Builder.pkg_dependencies.items()])
+			build_pkg = functools.partial(self.build_pkg, ctx, package_version = package_version, gst_version = gst_version)
+			if not self.run_subpackage_graph(GStreamer10Builder.pkgs, dependencies, build_pkg):
+				return False
+		return True
 
-					extra_config = ' '.join(['--wrap-mode=nofallback'] + [('-D' + x) for x in config_options])
+	def build_pkg(self, ctx, pkg, package_version, gst_version):
+		basename = '{}-{}'.format(pkg, package_version)
+		msg('GStreamer 1.0: building ' + basename, 4)
+		if self.is_meson_version(gst_version):
+			# Use Meson for building GStreamer versions >= 1.16.
+			config_options = self.get_release_config_options(pkg, gst_version)
+			extra_config = ' '.join(['--wrap-mode=nofallback'] + [('-D' + x) for x in config_options])
 
-					if not self.do_meson_ninja_build(basename = basename, extra_config = extra_config, staging_subdir = 'gstreamer1.0'):
-						return False
-			else:
-				# Use Autotools for building GStreamer versions < 1.16.
-				for pkg in GStreamer10Builder.pkgs:
-					basename = '{}-{}'.format(pkg, package_version)
-					msg('GStreamer 1.0: building ' + basename, 4)
-					extra_config = '--disable-examples'
-					if pkg == 'gst-plugins-bad':
-						extra_config += ' --disable-directfb --disable-modplug --disable-openexr'
-					elif pkg == 'gstreamer':
-						extra_config += ' --with-bash-completion-dir=' + ctx.inst_dir
-					elif pkg == 'gst-omx':
-						extra_config += ' --with-omx-target=bellagio'
-
-					if not self.do_config_make_build(basename = basename, use_autogen = (package_version == 'git'), extra_config = extra_config, staging_subdir = 'gstreamer1.0'):
-						return False
-					if not self.do_make_install(basename, staging_subdir = 'gstreamer1.0'):
-						return False
-		return True
+			return self.do_meson_ninja_build(basename = basename, extra_config = extra_config, staging_subdir = 'gstreamer1.0')
+		else:
+			# Use Autotools for building GStreamer versions < 1.16.
+			extra_config = '--disable-examples'
+			if pkg == 'gst-plugins-bad':
+				extra_config += ' --disable-directfb --disable-modplug --disable-openexr'
+			elif pkg == 'gstreamer':
+				extra_config += ' --with-bash-completion-dir=' + ctx.inst_dir
+			elif pkg == 'gst-omx':
+				extra_config += ' --with-omx-target=bellagio'
+
+			if not self.do_config_make_build(basename = basename, use_autogen = (package_version == 'git'), extra_config = extra_config, staging_subdir = 'gstreamer1.0'):
+				return False
+			return self.do_make_install(basename, staging_subdir = 'gstreamer1.0')
+
+	def build_superproject(self, ctx, package_version, gst_version):
+		# Builds all modules as subprojects of a generated Meson project, just
+		# like the git monorepo does. ninja then gets one build graph for all
+		# modules, instead of setting up, building and installing one module
+		# after the other. The modules' options are passed as <module>:<option>,
+		# like for the monorepo.
+		basename = 'gst-superproject-{}'.format(package_version)
+		staging = self.get_staging_dir(basename, 'gstreamer1.0')
+		subprojects_dir = os.path.join(staging, 'subprojects')
+		mkdir_p(subprojects_dir)
+		# Builds of other variants set up the same superproject.
+		with locked_file(self.get_source_lock(staging)):
+			for pkg in GStreamer10Builder.pkgs:
+				link = os.path.join(subprojects_dir, pkg)
+				target = os.path.join('..', '..', '{}-{}'.format(pkg, package_version))
+				if os.path.lexists(link) and (os.readlink(link) != target):
+					os.unlink(link)
+				if not os.path.lexists(link):
+					os.symlink(target, link)
+
+			# Only rewrite meson.build if it changed, so incremental
+			# builds do not have to regenerate the build files.
+			meson_build = "project('gst-superproject', version: '{}')\n".format(package_version)
+			meson_build += ''.join(["subproject('{}')\n".format(pkg) for pkg in GStreamer10Builder.pkgs])
+			meson_build_filename = os.path.join(staging, 'meson.build')
+			existing_meson_build = None
+			if os.path.exists(meson_build_filename):
+				with open(meson_build_filename, 'r') as f:
+					existing_meson_build = f.read()
+			if existing_meson_build != meson_build:
+				with open(meson_build_filename, 'w') as f:
+					f.write(meson_build)
+
+			# The superproject has no sources of its own. Its source record
+			# identifies the module trees instead, so that the build step is
+			# redone if one of them changed.
+			module_fingerprints = [self.get_source_fingerprint(self.get_staging_dir('{}-{}'.format(pkg, package_version), 'gstreamer1.0')) for pkg in GStreamer10Builder.pkgs]
+			write_stamp(self.get_source_record(staging), compute_fingerprint(module_fingerprints))
+
+		config_options = []
+		for pkg in GStreamer10Builder.pkgs:
+			config_options += [(pkg + ':' + x) for x in self.get_release_config_options(pkg, gst_version)]
+		# The modules find each other as fallback subprojects, so fallbacks
+		# cannot be disabled; downloading other subprojects is still not allowed.
+		extra_config = ' '.join(['--wrap-mode=nodownload'] + [('-D' + x) for x in config_options])
+
+		msg('GStreamer 1.0: building all modules as one Meson project in ' + staging, 4)
+		return self.do_meson_ninja_build(basename = basename, extra_config = extra_config, staging_subdir = 'gstreamer1.0')
+
+	def get_release_config_options(self, pkg, gst_version):
+		config_options = []
+		if gst_version['minor'] == 16:
+			# This option got removed from release tarballs starting with GStreamer 1.18.
+			# The git monorepo has it to support some subprojects that still use gtk-doc.
+			config_options += ['gtk_doc=disabled']
+		config_options += GStreamer10Builder.extra_config_options.get(pkg, [])
+		return config_options
+
+	def is_meson_version(self, gst_version):
+		# Starting with version 1.16, GStreamer uses Meson.
+		return (gst_version['major'] >= 1) and (gst_version['minor'] >= 16) and (gst_version['rev'] >= 0)
 
 	def get_gst_version(self, package_version):
 		import re
@@ -464,23 +3342,27 @@ class EFLBuilder(Builder):
 		return "Enlightenment Foundation Libraries version 1.8 or newer"
 		
 	def fetch(self, ctx, package_version):
+		# All repositories / archives are fetched at once; the overall
+		# number of concurrent transfers is limited by ctx.fetch_jobs.
 		if package_version == 'git':
-			for repo in EFLBuilder.git_repos:
-				basename = repo[1] + "-git"
-				msg('EFL: fetching ' + basename, 4)
-				git_link = EFLBuilder.git_source + '/' + repo[0]
-				if not self.clone_git_repo(git_link, basename, staging_subdir = 'efl'):
-					return False
+			funcs = [functools.partial(self.fetch_git_repo, ctx, repo) for repo in EFLBuilder.git_repos]
 		else:
-			for pkg in EFLBuilder.pkgs:
-				basename = '{}-{}'.format(pkg[0], pkg[2])
-				msg('EFL: fetching ' + basename, 4)
-				archive_filename = basename + '.' + EFLBuilder.pkg_ext
-				archive_link = EFLBuilder.efl_source + ('/{}/{}/{}'.format(pkg[1], pkg[0], archive_filename))
-				archive_dest = os.path.join(ctx.dl_dir, archive_filename)
-				if not self.fetch_package_file(archive_filename, archive_dest, None, archive_link, None):
-					return False
-		return True
+			funcs = [functools.partial(self.fetch_pkg, ctx, pkg) for pkg in EFLBuilder.pkgs]
+		return run_concurrently(funcs)
+
+	def fetch_git_repo(self, ctx, repo):
+		basename = repo[1] + "-git"
+		msg('EFL: fetching ' + basename, 4)
+		git_link = EFLBuilder.git_source + '/' + repo[0]
+		return self.clone_git_repo(git_link, basename, staging_subdir = 'efl')
+
+	def fetch_pkg(self, ctx, pkg):
+		basename = '{}-{}'.format(pkg[0], pkg[2])
+		msg('EFL: fetching ' + basename, 4)
+		archive_filename = basename + '.' + EFLBuilder.pkg_ext
+		archive_link = EFLBuilder.efl_source + ('/{}/{}/{}'.format(pkg[1], pkg[0], archive_filename))
+		archive_dest = os.path.join(ctx.dl_dir, archive_filename)
+		return self.fetch_package_file(archive_filename, archive_dest, None, archive_link, None)
 
 	def check(self, ctx, package_version):
 		return True
@@ -522,6 +3404,8 @@ class EFLBuilder(Builder):
 
 class Qt5Builder(Builder):
 	qt5_source = "http://download.qt.io/official_releases/qt"
+	# Older releases are moved to the archive.
+	source_mirrors = {qt5_source: ['https://download.qt.io/archive/qt']}
 	pkg_ext = 'tar.xz'
 
 	def __init__(self, ctx):
@@ -543,7 +3427,7 @@ class Qt5Builder(Builder):
 		if not self.fetch_package_file(archive_filename, archive_dest, archive_dest_checksum_tmp, archive_link, archive_link_md5sums):
 			return False
 
-		subprocess.call('grep "{}" "{}" >"{}"'.format(archive_filename, archive_dest_checksum_tmp, archive_dest_checksum), shell = True)
+		extract_checksum_entries(archive_dest_checksum_tmp, archive_dest_checksum, archive_filename)
 		return True
 
 	def check(self, ctx, package_version):
@@ -563,17 +3447,22 @@ class Qt5Builder(Builder):
 		basename = 'qt-everywhere-opensource-src-' + package_version
 
 		staging = os.path.join(ctx.staging_dir, basename)
-		olddir = os.getcwd()
-		os.chdir(staging)
+		# Qt is built out of tree ("shadow build").
+		builddir = self.get_build_dir(staging, '_build')
+		config_args = ['-opensource', '-confirm-license', '-prefix', ctx.inst_dir] + ctx.get_variant_options('qt')
 
-		success = True
-		success = success and (0 == ctx.call_with_env('./configure -opensource -confirm-license -prefix "{}"'.format(ctx.inst_dir)))
-		success = success and (0 == ctx.call_with_env('make "-j{}"'.format(ctx.num_jobs)))
-		success = success and (0 == ctx.call_with_env('make install "-j{}"'.format(ctx.num_jobs)))
+		def build():
+			with locked_file(self.get_source_lock(staging)):
+				if not self.clean_in_tree_build(staging, ['config.status', os.path.join('qtbase', '.qmake.cache')]):
+					return False
+			mkdir_p(builddir)
+			success = True
+			success = success and (0 == ctx.call_with_env([os.path.join(staging, 'configure')] + config_args, cwd = builddir))
+			success = success and (0 == ctx.call_with_env(['make'] + ctx.make_jobs_arg(), cwd = builddir))
+			success = success and self.staged_install(basename, lambda destdir: 0 == ctx.call_with_env(['make', 'install', 'INSTALL_ROOT=' + destdir] + ctx.make_jobs_arg(), cwd = builddir))
+			return success
 
-		os.chdir(olddir)
-
-		return True
+		return self.run_step(basename, 'build', [ctx.inst_dir, builddir] + config_args, staging, build)
 
 
 class DaalaBuilder(Builder):
@@ -625,7 +3514,9 @@ class VPXBuilder(Builder):
 
 	def build(self, ctx, package_version):
 		basename = 'libvpx-{}'.format(package_version)
-		return self.do_config_make_build(basename = basename, use_autogen = False, extra_cflags = '-fPIC -DPIC', extra_cxxflags = '-fPIC -DPIC') and self.do_make_install(basename)
+		# libvpx has a hand-written configure script, which does not support
+		# autoconf's --cache-file.
+		return self.do_config_make_build(basename = basename, use_autogen = False, extra_cflags = '-fPIC -DPIC', extra_cxxflags = '-fPIC -DPIC', use_configure_cache = False) and self.do_make_install(basename)
 
 
 
@@ -696,6 +3587,7 @@ class OrcBuilder(Builder):
 
 class GLibBuilder(Builder):
 	glib_source="http://ftp.gnome.org/pub/gnome/sources/glib"
+	source_mirrors = {glib_source: ['https://download.gnome.org/sources/glib']}
 	glib_ext="tar.xz"
 
 	def __init__(self, ctx):
@@ -719,7 +3611,7 @@ class GLibBuilder(Builder):
 
 		if not self.fetch_package_file(archive_filename, archive_dest, archive_dest_checksum_tmp, archive_link, archive_link_checksum):
 			return False
-		subprocess.call('grep "{}" "{}" >"{}"'.format(archive_filename, archive_dest_checksum_tmp, archive_dest_checksum), shell = True)
+		extract_checksum_entries(archive_dest_checksum_tmp, archive_dest_checksum, archive_filename)
 		return True
 
 	def check(self, ctx, package_version):
@@ -728,7 +3620,7 @@ class GLibBuilder(Builder):
 		archive_dest = os.path.join(ctx.dl_dir, archive_filename)
 		archive_dest_checksum = archive_dest + '.sha256sum'
 
-		return self.check_package(name = pkg, basename = basename, hashcall = 'sha256sum', dest_hash = archive_dest_checksum)
+		return self.check_package(name = 'glib', basename = basename, hashcall = 'sha256sum', dest_hash = archive_dest_checksum)
 
 	def unpack(self, ctx, package_version):
 		basename = 'glib-{}'.format(package_version)
@@ -756,7 +3648,9 @@ class GLibBuilder(Builder):
 
 class BlueZBuilder(Builder):
 	bluez_source="https://www.kernel.org/pub/linux/bluetooth"
+	source_mirrors = {bluez_source: ['https://mirrors.edge.kernel.org/pub/linux/bluetooth']}
 	bluez_ext="tar.xz"
+	dependencies = ['glib']
 
 	def __init__(self, ctx):
 		super(BlueZBuilder, self).__init__(ctx)
@@ -776,7 +3670,7 @@ class BlueZBuilder(Builder):
 		if not self.fetch_package_file(archive_filename, archive_dest, archive_dest_checksum_tmp, archive_link, archive_link_sha256sum):
 			return False
 
-		subprocess.call('grep "{}" "{}" >"{}"'.format(archive_filename, archive_dest_checksum_tmp, archive_dest_checksum), shell = True)
+		extract_checksum_entries(archive_dest_checksum_tmp, archive_dest_checksum, archive_filename)
 		return True
 
 	def check(self, ctx, package_version):
@@ -784,7 +3678,7 @@ class BlueZBuilder(Builder):
 		archive_filename = basename + '.' + BlueZBuilder.bluez_ext
 		archive_dest = os.path.join(ctx.dl_dir, archive_filename)
 		archive_dest_checksum = os.path.join(ctx.dl_dir, 'bluez-sha256sums')
-		return self.check_package(name = 'opus', basename = basename, hashcall = 'sha256sum', dest_hash = archive_dest_checksum)
+		return self.check_package(name = 'bluez', basename = basename, hashcall = 'sha256sum', dest_hash = archive_dest_checksum)
 
 	def unpack(self, ctx, package_version):
 		basename = 'bluez-{}'.format(package_version)
@@ -827,25 +3721,27 @@ class X265Builder(Builder):
 	def build(self, ctx, package_version):
 		basename = 'x265_{}'.format(package_version)
 
-		olddir = os.getcwd()
-		staging = os.path.join(ctx.staging_dir, basename, 'build')
-		os.chdir(staging)
-
-		success = True
-		success = success and (0 == ctx.call_with_env('cmake ../source -DCMAKE_INSTALL_PREFIX="{}"'.format(ctx.inst_dir)))
-		success = success and (0 == ctx.call_with_env('make'))
-		success = success and (0 == ctx.call_with_env('make install'))
+		staging = self.get_build_dir(os.path.join(ctx.staging_dir, basename), 'build')
+		variant_options = ctx.get_variant_options('cmake')
 
-		os.chdir(olddir)
+		def build():
+			mkdir_p(staging)
+			success = True
+			success = success and (0 == ctx.call_with_env(['cmake', '../source', '-DCMAKE_INSTALL_PREFIX=' + ctx.inst_dir] + variant_options + ctx.get_cmake_launcher_options(), cwd = staging))
+			success = success and (0 == ctx.call_with_env(['make'], cwd = staging))
+			success = success and self.staged_install(basename, lambda destdir: 0 == ctx.call_with_env(['make', 'install', 'DESTDIR=' + destdir], cwd = staging))
+			return success
 
-		return success
+		return self.run_step(basename, 'build', [ctx.inst_dir] + variant_options, os.path.join(ctx.staging_dir, basename), build)
 
 
 
 class SoupBuilder(Builder):
 	soup_source="http://ftp.gnome.org/pub/GNOME/sources/libsoup"
+	source_mirrors = {soup_source: ['https://download.gnome.org/sources/libsoup']}
 	git_source="https://gitlab.gnome.org/GNOME/libsoup.git"
 	soup_ext="tar.xz"
+	dependencies = ['glib']
 
 	def __init__(self, ctx):
 		super(SoupBuilder, self).__init__(ctx)
@@ -869,7 +3765,7 @@ class SoupBuilder(Builder):
 			archive_dest_checksum_tmp = archive_dest_checksum + '.tmp'
 			if not self.fetch_package_file(archive_filename, archive_dest, archive_dest_checksum_tmp, archive_link, archive_link_checksum):
 				return False
-			subprocess.call('grep "{}" "{}" >"{}"'.format(archive_filename, archive_dest_checksum_tmp, archive_dest_checksum), shell = True)
+			extract_checksum_entries(archive_dest_checksum_tmp, archive_dest_checksum, archive_filename)
 		return True
 
 	def check(self, ctx, package_version):
@@ -880,7 +3776,7 @@ class SoupBuilder(Builder):
 		archive_dest = os.path.join(ctx.dl_dir, archive_filename)
 		archive_dest_checksum = archive_dest + ".sha256sum"
 
-		return self.check_package(name = pkg, basename = basename, hashcall = 'sha256sum', dest_hash = archive_dest_checksum)
+		return self.check_package(name = 'libsoup', basename = basename, hashcall = 'sha256sum', dest_hash = archive_dest_checksum)
 
 	def unpack(self, ctx, package_version):
 		if package_version == 'git':
@@ -925,22 +3821,34 @@ class BoostBuilder(Builder):
 	def build(self, ctx, package_version):
 		basename = 'boost_{}'.format(package_version).replace('.', '_')
 
-		olddir = os.getcwd()
 		staging = self.get_staging_dir(basename, None)
-		os.chdir(staging)
+		# b2 puts the objects into the build directory, and gets the prefix
+		# on the command line, so the variants can share the bootstrapped tree.
+		builddir = self.get_build_dir(staging, '_build')
+		b2_args = ['--build-dir=' + builddir] + ctx.get_variant_options('b2')
 
-		print(staging)
-		success = True
-		success = success and (0 == ctx.call_with_env('./bootstrap.sh --prefix={}'.format(ctx.inst_dir)))
-		success = success and (0 == ctx.call_with_env('./b2 install -j{}'.format(self.ctx.num_jobs)))
+		def install(destdir):
+			# b2 does not support DESTDIR; the prefix is
+			# placed in the staging directory instead.
+			prefix = os.path.join(destdir, ctx.inst_dir.lstrip(os.sep))
+			with self.ctx.job_slots() as jobs_arg:
+				return 0 == ctx.call_with_env(['./b2'] + b2_args + ['--prefix=' + prefix, 'install'] + jobs_arg, cwd = staging)
 
-		os.chdir(olddir)
-		return success
+		def build():
+			success = True
+			with locked_file(self.get_source_lock(staging)):
+				if not os.path.exists(os.path.join(staging, 'b2')):
+					success = success and (0 == ctx.call_with_env(['./bootstrap.sh', '--prefix=' + ctx.inst_dir], cwd = staging))
+			success = success and self.staged_install(basename, install)
+			return success
+
+		return self.run_step(basename, 'build', [ctx.inst_dir] + b2_args, staging, build)
 
 
 class LibniceBuilder(Builder):
 	libnice_source="https://libnice.freedesktop.org/releases"
 	libnice_ext="tar.gz"
+	dependencies = ['glib', 'gstreamer-1.0']
 
 	def __init__(self, ctx):
 		super(LibniceBuilder, self).__init__(ctx)
@@ -990,6 +3898,7 @@ class PipewireBuilder(Builder):
 	pipewire_source="https://gitlab.freedesktop.org/pipewire/pipewire/-/archive"
 	git_source="https://github.com/PipeWire/pipewire.git"
 	pipewire_ext="tar.bz2"
+	dependencies = ['glib', 'gstreamer-1.0']
 
 	def __init__(self, ctx):
 		super(PipewireBuilder, self).__init__(ctx)
@@ -1034,6 +3943,7 @@ class WireplumberBuilder(Builder):
 	wireplumber_source="https://gitlab.freedesktop.org/pipewire/wireplumber/-/archive"
 	git_source="https://gitlab.freedesktop.org/pipewire/wireplumber.git"
 	wireplumber_ext="tar.bz2"
+	dependencies = ['glib', 'pipewire']
 
 	def __init__(self, ctx):
 		super(WireplumberBuilder, self).__init__(ctx)
@@ -1113,18 +4023,24 @@ class FFmpegBuilder(Builder):
 	def build(self, ctx, package_version):
 		basename = 'ffmpeg-{}'.format(package_version)
 
-		olddir = os.getcwd()
 		staging = os.path.join(ctx.staging_dir, basename)
-		os.chdir(staging)
-
-		success = True
-		success = success and (0 == ctx.call_with_env('./configure --enable-shared --disable-static --enable-libx264 --enable-encoder=libx264 --enable-gpl --enable-libdvdnav --enable-libdvdread --prefix="{}"'.format(ctx.inst_dir)))
-		success = success and (0 == ctx.call_with_env('make "-j{}"'.format(ctx.num_jobs)))
-		success = success and (0 == ctx.call_with_env('make install "-j{}"'.format(ctx.num_jobs)))
-
-		os.chdir(olddir)
+		builddir = self.get_build_dir(staging, '_build')
+		config_args = ['--enable-shared', '--disable-static', '--enable-libx264', '--enable-encoder=libx264', '--enable-gpl', '--enable-libdvdnav', '--enable-libdvdread', '--prefix=' + ctx.inst_dir] + ctx.get_variant_options('ffmpeg')
+
+		def build():
+			# FFmpeg's configure refuses out-of-tree builds if config.h
+			# exists in the source tree.
+			with locked_file(self.get_source_lock(staging)):
+				if not self.clean_in_tree_build(staging, ['config.h']):
+					return False
+			mkdir_p(builddir)
+			success = True
+			success = success and (0 == ctx.call_with_env([os.path.join(staging, 'configure')] + config_args, cwd = builddir))
+			success = success and (0 == ctx.call_with_env(['make'] + ctx.make_jobs_arg(), cwd = builddir))
+			success = success and self.staged_install(basename, lambda destdir: 0 == ctx.call_with_env(['make', 'install', 'DESTDIR=' + destdir] + ctx.make_jobs_arg(), cwd = builddir))
+			return success
 
-		return success
+		return self.run_step(basename, 'build', [ctx.inst_dir, builddir] + config_args, staging, build)
 
 
 
@@ -1156,19 +4072,18 @@ class AOMBuilder(Builder):
 	def build(self, ctx, package_version):
 		basename = 'aom-{}'.format(package_version)
 
-		olddir = os.getcwd()
-		staging = os.path.join(ctx.staging_dir, basename, 'aom_build')
-		mkdir_p(staging)
-		os.chdir(staging)
+		staging = self.get_build_dir(os.path.join(ctx.staging_dir, basename), 'aom_build')
+		variant_options = ctx.get_variant_options('cmake')
 
-		success = True
-		success = success and (0 == ctx.call_with_env('cmake .. -DBUILD_SHARED_LIBS=1 -DCMAKE_INSTALL_PREFIX="{}"'.format(ctx.inst_dir), 'export CFLAGS="$CFLAGS {0}" ; export CXXFLAGS="$CXXFLAGS {0}" '.format('-fPIC -DPIC')))
-		success = success and (0 == ctx.call_with_env('make "-j{}"'.format(ctx.num_jobs)))
-		success = success and (0 == ctx.call_with_env('make install "-j{}"'.format(ctx.num_jobs)))
-
-		os.chdir(olddir)
+		def build():
+			mkdir_p(staging)
+			success = True
+			success = success and (0 == ctx.call_with_env(['cmake', '..', '-DBUILD_SHARED_LIBS=1', '-DCMAKE_INSTALL_PREFIX=' + ctx.inst_dir] + variant_options + ctx.get_cmake_launcher_options(), {'CFLAGS': '$CFLAGS -fPIC -DPIC', 'CXXFLAGS': '$CXXFLAGS -fPIC -DPIC'}, cwd = staging))
+			success = success and (0 == ctx.call_with_env(['make'] + ctx.make_jobs_arg(), cwd = staging))
+			success = success and self.staged_install(basename, lambda destdir: 0 == ctx.call_with_env(['make', 'install', 'DESTDIR=' + destdir] + ctx.make_jobs_arg(), cwd = staging))
+			return success
 
-		return success
+		return self.run_step(basename, 'build', [ctx.inst_dir] + variant_options, os.path.join(ctx.staging_dir, basename), build)
 
 
 
@@ -1277,73 +4192,191 @@ class TinycompressBuilder(Builder):
 
 
 
-rootdir = os.path.dirname(os.path.realpath(__file__))
-ctx = Context(rootdir)
-ctx.package_builders['gstreamer-1.0'] = GStreamer10Builder(ctx)
-ctx.package_builders['opus'] = OpusBuilder(ctx)
-ctx.package_builders['efl'] = EFLBuilder(ctx)
-ctx.package_builders['qt5'] = Qt5Builder(ctx)
-ctx.package_builders['daala'] = DaalaBuilder(ctx)
-ctx.package_builders['vpx'] = VPXBuilder(ctx)
-ctx.package_builders['orc'] = OrcBuilder(ctx)
-ctx.package_builders['glib'] = GLibBuilder(ctx)
-ctx.package_builders['bluez'] = BlueZBuilder(ctx)
-ctx.package_builders['x265'] = X265Builder(ctx)
-ctx.package_builders['soup'] = SoupBuilder(ctx)
-ctx.package_builders['boost'] = BoostBuilder(ctx)
-ctx.package_builders['libnice'] = LibniceBuilder(ctx)
-ctx.package_builders['pipewire'] = PipewireBuilder(ctx)
-ctx.package_builders['wireplumber'] = WireplumberBuilder(ctx)
-ctx.package_builders['ffmpeg'] = FFmpegBuilder(ctx)
-ctx.package_builders['aom'] = AOMBuilder(ctx)
-ctx.package_builders['dav1d'] = Dav1dBuilder(ctx)
-ctx.package_builders['openh264'] = OpenH264Builder(ctx)
-ctx.package_builders['tinycompress'] = TinycompressBuilder(ctx)
-
-
-desc_lines = ['supported packages:']
-for i in ctx.package_builders.keys():
-	line = '    {} - {}'.format(i, ctx.package_builders[i].desc())
-	desc_lines += [line]
-desc_lines += ['', 'Example call: {} -p orc=0.4.17 gstreamer-1.0=1.1.1'.format(sys.argv[0])]
-
-parser = argparse.ArgumentParser(description = '\n'.join(desc_lines), formatter_class = argparse.RawTextHelpFormatter)
-parser.add_argument('-j', '--jobs', dest = 'num_jobs', metavar = 'JOBS', type = int, action = 'store', default = 1, help = 'Specifies the number of jobs to run simultaneously when compiling')
-parser.add_argument('-p', '--packages', dest = 'pkgs_to_build', metavar = 'PKG=VERSION', type = str, action = 'store', default = [], nargs = '*', help = 'Package(s) to build; VERSION is either a valid version number, or "git", in which case sources are fetched from git upstream instead')
-parser.add_argument('-g', '--local-git', dest = 'local_git', action = 'store_true', help = 'When building from tarballs instead of from a git repository, create a local git repository (or multiple repositories if the package is made of sub-packages, like GStreamer); useful for tracking local modifications')
-
-if len(sys.argv) == 1:
-	parser.print_help()
-	sys.exit(1)
-args = parser.parse_args()
-
-ctx.num_jobs = args.num_jobs
-ctx.local_git = args.local_git
-
-packages = []
-
-for s in args.pkgs_to_build:
-	delimiter_pos = s.find('=')
-	if delimiter_pos == -1:
-		error('invalid package specified: "{}" (must be in format <PKG>=<VERSION>', s)
-		exit(-1)
-	pkg = s[0:delimiter_pos]
-	version = s[delimiter_pos+1:]
-	packages += [[pkg, version]]
-
-invalid_packages_found = False
-for pkg in packages:
-	package_name = pkg[0]
-	package_version = pkg[1]
+def main():
+	rootdir = os.path.dirname(os.path.realpath(__file__))
+	ctx = Context(rootdir)
+	ctx.package_builders['gstreamer-1.0'] = GStreamer10Builder(ctx)
+	ctx.package_builders['opus'] = OpusBuilder(ctx)
+	ctx.package_builders['efl'] = EFLBuilder(ctx)
+	ctx.package_builders['qt5'] = Qt5Builder(ctx)
+	ctx.package_builders['daala'] = DaalaBuilder(ctx)
+	ctx.package_builders['vpx'] = VPXBuilder(ctx)
+	ctx.package_builders['orc'] = OrcBuilder(ctx)
+	ctx.package_builders['glib'] = GLibBuilder(ctx)
+	ctx.package_builders['bluez'] = BlueZBuilder(ctx)
+	ctx.package_builders['x265'] = X265Builder(ctx)
+	ctx.package_builders['soup'] = SoupBuilder(ctx)
+	ctx.package_builders['boost'] = BoostBuilder(ctx)
+	ctx.package_builders['libnice'] = LibniceBuilder(ctx)
+	ctx.package_builders['pipewire'] = PipewireBuilder(ctx)
+	ctx.package_builders['wireplumber'] = WireplumberBuilder(ctx)
+	ctx.package_builders['ffmpeg'] = FFmpegBuilder(ctx)
+	ctx.package_builders['aom'] = AOMBuilder(ctx)
+	ctx.package_builders['dav1d'] = Dav1dBuilder(ctx)
+	ctx.package_builders['openh264'] = OpenH264Builder(ctx)
+	ctx.package_builders['tinycompress'] = TinycompressBuilder(ctx)
+
+
+	desc_lines = ['supported packages:']
+	for i in ctx.package_builders.keys():
+		line = '    {} - {}'.format(i, ctx.package_builders[i].desc())
+		desc_lines += [line]
+	desc_lines += ['', 'Example call: {} -p orc=0.4.17 gstreamer-1.0=1.1.1'.format(sys.argv[0])]
+
+	parser = argparse.ArgumentParser(description = '\n'.join(desc_lines), formatter_class = argparse.RawTextHelpFormatter)
+	parser.add_argument('-j', '--jobs', dest = 'num_jobs', metavar = 'JOBS', type = int, action = 'store', default = 1, help = 'Specifies the number of jobs to run simultaneously when compiling; this is a limit for the whole run, shared by all packages that are built at the same time')
+	parser.add_argument('--fetch-jobs', dest = 'fetch_jobs', metavar = 'JOBS', type = int, action = 'store', default = 4, help = 'Specifies the number of downloads and git clones to run simultaneously during the fetch phase')
+	parser.add_argument('--mirror-config', dest = 'mirror_config', metavar = 'FILE', action = 'store', default = os.environ.get('BUILD_PY_MIRROR_CONFIG'), help = 'File with additional download mirrors; every line contains the beginning of the upstream download links (for example https://gstreamer.freedesktop.org/src), followed by mirrors with the same directory layout (default: value of the BUILD_PY_MIRROR_CONFIG environment variable, or mirrors.conf in the root directory if it exists)')
+	parser.add_argument('--download-segments', dest = 'download_segments', metavar = 'N', type = int, action = 'store', default = 4, help = 'Download archives in up to N segments at the same time, using HTTP range requests; interrupted downloads are resumed in the next run (default: 4)')
+	parser.add_argument('-P', '--package-jobs', dest = 'package_jobs', metavar = 'JOBS', type = int, action = 'store', default = 1, help = 'Specifies the number of packages to build simultaneously; packages are started as soon as the packages they depend on are installed')
+	parser.add_argument('--cache-dir', dest = 'cache_dir', metavar = 'DIR', type = str, action = 'store', default = os.environ.get('BUILD_PY_CACHE_DIR'), help = 'Directory of a download cache that can be shared between several root directories (default: value of the BUILD_PY_CACHE_DIR environment variable; if neither is set, no cache is used)')
+	parser.add_argument('--cache-max-size', dest = 'cache_max_size', metavar = 'SIZE', type = str, action = 'store', default = '20G', help = 'Maximum size of the download cache; least recently used files are evicted once it is exceeded (default: 20G)')
+	parser.add_argument('--reverify', dest = 'reverify', action = 'store_true', help = 'Compute the checksums of all downloaded files again, instead of relying on the digests that were computed when the files were downloaded or last verified')
+	parser.add_argument('-f', '--force-rebuild', dest = 'force_rebuild', action = 'store_true', help = 'Rebuild everything, even build steps whose inputs did not change since they were last done successfully')
+	parser.add_argument('-i', '--incremental', dest = 'incremental', action = 'store_true', help = 'Keep existing build directories and configurations, and only reconfigure if the configuration options changed; useful when rebuilding after modifying the sources')
+	parser.add_argument('--git-clone', dest = 'git_clone_strategy', metavar = 'STRATEGY', type = str, action = 'store', default = 'full', choices = ['full', 'shallow', 'blobless'], help = 'How git repositories are cloned: "full" clones the entire history, "shallow" only the checked out commit, "blobless" the entire history but only the file contents of the checked out commit (default: full)')
+	parser.add_argument('--git-mirror-dir', dest = 'git_mirror_dir', metavar = 'DIR', type = str, action = 'store', default = os.environ.get('BUILD_PY_GIT_MIRROR_DIR'), help = 'Directory with bare mirrors of the upstream git repositories; if set, each run fetches new commits into the mirrors and clones or updates the checkouts in the staging directory from there, ignoring --git-clone (default: value of the BUILD_PY_GIT_MIRROR_DIR environment variable; if neither is set, no mirrors are used)')
+	parser.add_argument('--stream-unpack', dest = 'stream_unpack', action = 'store_true', help = 'Unpack archives while they are being downloaded, instead of reading them again after the download finished; the unpacked trees are only used if the archive matches its checksum')
+	parser.add_argument('--source-store', dest = 'source_store', metavar = 'DIR', type = str, action = 'store', default = os.environ.get('BUILD_PY_SOURCE_STORE'), help = 'Directory of a store of pristine unpacked source trees; archives are only unpacked once, and copied from there into the staging directory as reflinks where the filesystem supports it (default: value of the BUILD_PY_SOURCE_STORE environment variable; if neither is set, no store is used)')
+	parser.add_argument('--source-store-hardlinks', dest = 'source_store_hardlinks', action = 'store_true', help = 'Hardlink the files of the source store into the staging directory if the filesystem does not support reflinks, instead of copying them; the hardlinked files are read-only')
+	parser.add_argument('--ccache', dest = 'ccache', action = 'store_true', help = 'Compile C and C++ code through ccache')
+	parser.add_argument('--ccache-dir', dest = 'ccache_dir', metavar = 'DIR', type = str, action = 'store', default = os.environ.get('BUILD_PY_CCACHE_DIR', os.path.join(rootdir, 'ccache')), help = 'Directory of the ccache cache; can be shared between several root directories (default: value of the BUILD_PY_CCACHE_DIR environment variable, or ccache/ in the root directory)')
+	parser.add_argument('--ccache-max-size', dest = 'ccache_max_size', metavar = 'SIZE', type = str, action = 'store', default = '10G', help = 'Maximum size of the ccache cache (default: 10G)')
+	parser.add_argument('--configure-cache', dest = 'configure_cache', action = 'store_true', help = 'Share the results of the checks that configure scripts do between all packages whose configure script was generated by autoconf (autoconf\'s --cache-file), per toolchain; results that may depend on the installed packages are checked again once the installation changed. If configure fails with the shared results, it is run again without them')
+	parser.add_argument('--gst-superproject', dest = 'gst_superproject', action = 'store_true', help = 'Build the modules of GStreamer releases (1.16 and newer) as subprojects of one Meson project, so ninja builds all of them in one go, instead of building them one by one')
+	parser.add_argument('--variant', dest = 'variants', metavar = 'VARIANT', type = str, action = 'append', default = [], choices = sorted(build_variants.keys()), help = 'Build the packages in the given variant ({}) instead of the default build; can be given several times. Each variant has its own compiler flags, and is installed into installation-<VARIANT>/ (with env-<VARIANT>.sh for using it). All variants are built at the same time, out of tree, from the same source trees, which are fetched and unpacked only once; -j is the limit for all of them together'.format(', '.join(sorted(build_variants.keys()))))
+	parser.add_argument('--report', dest = 'report', metavar = 'FILE', action = 'store', default = None, help = 'Write the JSON report with the time, CPU, memory and I/O usage of all build phases to FILE (default: reports/build-<date>-<time>.json)')
+	parser.add_argument('--history', dest = 'history', metavar = 'FILE', action = 'store', default = os.environ.get('BUILD_PY_HISTORY', os.path.join(rootdir, 'reports', 'history.sqlite')), help = 'SQLite database with the durations of past builds, which is used for predicting the build time and for flagging phases that got slower (default: value of the BUILD_PY_HISTORY environment variable, or reports/history.sqlite)')
+	parser.add_argument('--no-history', dest = 'no_history', action = 'store_true', help = 'Neither use nor record the build history')
+	parser.add_argument('--predict', dest = 'predict', action = 'store_true', help = 'Only print the predicted build time of the given packages, based on the build history, and exit')
+	parser.add_argument('--uninstall', dest = 'pkgs_to_uninstall', metavar = 'PKG', type = str, action = 'store', default = [], nargs = '*', help = 'Remove the installed files of the given package(s) from the installation directory (and from the installation directories of the variants given with --variant), and exit; files that other packages installed as well are kept')
+	parser.add_argument('-p', '--packages', dest = 'pkgs_to_build', metavar = 'PKG=VERSION', type = str, action = 'store', default = [], nargs = '*', help = 'Package(s) to build; VERSION is either a valid version number, or "git", in which case sources are fetched from git upstream instead')
+	parser.add_argument('-g', '--local-git', dest = 'local_git', action = 'store_true', help = 'When building from tarballs instead of from a git repository, create a local git repository (or multiple repositories if the package is made of sub-packages, like GStreamer); useful for tracking local modifications')
+
+	if len(sys.argv) == 1:
+		parser.print_help()
+		sys.exit(1)
+	args = parser.parse_args()
+
+	ctx.num_jobs = args.num_jobs
+	ctx.fetch_jobs = max(1, args.fetch_jobs)
+	ctx.download_segments = max(1, args.download_segments)
+	ctx.package_jobs = max(1, args.package_jobs)
+	ctx.ignore_stamps = args.force_rebuild
+	ctx.reverify = args.reverify
+	ctx.incremental = args.incremental
+	ctx.use_configure_cache = args.configure_cache
+	ctx.git_clone_strategy = args.git_clone_strategy
+	ctx.stream_unpack = args.stream_unpack
+	if args.git_mirror_dir:
+		ctx.git_mirrors = GitMirrorStore(args.git_mirror_dir)
+	variants = list(collections.OrderedDict.fromkeys(args.variants))
+	ctx.setup_jobserver(len(variants))
+	ctx.write_env_script()
+	mirror_config = args.mirror_config
+	if (not mirror_config) and os.path.exists(os.path.join(rootdir, 'mirrors.conf')):
+		mirror_config = os.path.join(rootdir, 'mirrors.conf')
 	try:
-		package_builder = ctx.package_builders[package_name]
-		print('package: "{}" version: "{}"'.format(package_name, package_version))
-	except KeyError:
-		error('invalid package "{}"'.format(package_name))
-		invalid_packages_found = True
-if invalid_packages_found:
-	error('invalid packages specified - cannot continue')
-	sys.exit(1)
-
-for pkg in packages:
-	ctx.build_package(pkg[0], pkg[1])
+		ctx.setup_mirrors(mirror_config)
+	except (IOError, OSError) as e:
+		error('could not read mirror configuration: {}'.format(e))
+		sys.exit(1)
+	if args.cache_dir:
+		try:
+			ctx.download_cache = DownloadCache(args.cache_dir, parse_size(args.cache_max_size))
+		except ValueError as e:
+			error(str(e))
+			sys.exit(1)
+	ctx.local_git = args.local_git
+	if args.source_store:
+		ctx.source_store = SourceStore(args.source_store, args.source_store_hardlinks)
+	ctx.package_builders['gstreamer-1.0'].use_superproject = args.gst_superproject
+	if args.ccache:
+		try:
+			parse_size(args.ccache_max_size)
+		except ValueError as e:
+			error(str(e))
+			sys.exit(1)
+		if not ctx.setup_ccache(args.ccache_dir, args.ccache_max_size):
+			error('could not set up ccache')
+			sys.exit(1)
+
+	packages = []
+
+	for s in args.pkgs_to_build:
+		delimiter_pos = s.find('=')
+		if delimiter_pos == -1:
+			error('invalid package specified: "{}" (must be in format <PKG>=<VERSION>', s)
+			exit(-1)
+		pkg = s[0:delimiter_pos]
+		version = s[delimiter_pos+1:]
+		packages += [[pkg, version]]
+
+	invalid_packages_found = False
+	for pkg in packages:
+		package_name = pkg[0]
+		package_version = pkg[1]
+		try:
+			package_builder = ctx.package_builders[package_name]
+			print('package: "{}" version: "{}"'.format(package_name, package_version))
+		except KeyError:
+			error('invalid package "{}"'.format(package_name))
+			invalid_packages_found = True
+	if invalid_packages_found:
+		error('invalid packages specified - cannot continue')
+		sys.exit(1)
+
+	if not args.no_history:
+		ctx.history = BuildHistory(args.history)
+
+	# The packages are fetched with ctx, and built with the contexts of
+	# the variants (or with ctx itself if no variants are given).
+	if variants:
+		build_contexts = [ctx.create_variant_context(variant) for variant in variants]
+	else:
+		build_contexts = [ctx]
+
+	if args.pkgs_to_uninstall:
+		success = True
+		for package_name in args.pkgs_to_uninstall:
+			for build_ctx in build_contexts:
+				success = build_ctx.uninstall_package(package_name) and success
+		sys.exit(0 if success else 1)
+
+	if args.predict:
+		if not ctx.history:
+			error('--predict cannot be used together with --no-history')
+			sys.exit(1)
+		for build_ctx in build_contexts:
+			build_ctx.predict_build(packages, build_ctx.get_build_dependencies(packages))
+		sys.exit(0)
+
+	# The metrics report is written at exit, so it covers failed runs as well.
+	if args.report:
+		report_filename = os.path.abspath(args.report)
+	else:
+		report_filename = os.path.join(ctx.reports_dir, 'build-{}.json'.format(time.strftime('%Y%m%d-%H%M%S')))
+	def write_metrics_report():
+		ctx.metrics.write_report(report_filename)
+		msg('metrics report written to {}'.format(report_filename))
+	atexit.register(write_metrics_report)
+
+	print('')
+	msg('fetching all packages', 6)
+	if not ctx.fetch_packages(packages):
+		error('fetching packages failed')
+		exit(-1)
+
+	for build_ctx in build_contexts:
+		build_ctx.write_env_script()
+	if len(build_contexts) > 1:
+		success = run_concurrently([functools.partial(build_ctx.build_packages, packages) for build_ctx in build_contexts])
+	else:
+		success = build_contexts[0].build_packages(packages)
+	if not success:
+		error('building packages failed')
+		exit(-1)
+
+
+if __name__ == '__main__':
+	main()